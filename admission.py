@@ -0,0 +1,187 @@
+# =============================================================================
+# 受け付け制御（同時実行数・待ち行列の上限・期限・クライアント切断時の中断）
+# =============================================================================
+# 生成は1つのモデルを共有するので、リクエストを無制限に受け付けると全員の
+# 待ち時間が延び続ける。また、クライアントがタイムアウトであきらめた後も
+# 生成を続けると、誰も読まない返答のために容量を使ってしまう。
+#
+#   - 同時に生成できるリクエストは max_concurrency 件まで。それ以上は待ち行列に入る
+#   - 待ち行列が max_queue 件で埋まっていれば、すぐに断る（429 + Retry-After）
+#   - リクエストごとの期限（deadline）を過ぎたら、待ち行列でも生成中でも打ち切る
+#   - クライアントが切断したら、生成を取り消してバッチから外す
+# =============================================================================
+import asyncio  # 待ち行列と切断の監視用
+import math  # Retry-After の切り上げ用
+import threading  # 統計の排他制御用
+import time  # 処理時間の計測用
+from collections import deque  # 到着順の待ち行列
+from typing import Awaitable, Deque, Dict, Optional, TypeVar
+
+T = TypeVar("T")
+
+class AdmissionRejected(Exception):
+    """待ち行列が埋まっていて受け付けられない（429 で返す）"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Server is busy, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+class DeadlineExceeded(Exception):
+    """リクエストの期限を過ぎた"""
+
+class ClientDisconnected(Exception):
+    """処理中にクライアントが切断した"""
+
+class AdmissionSlot:
+    """受け付けたリクエストが持つ実行枠（release() は何度呼んでもよい）"""
+
+    def __init__(self, controller: "AdmissionController"):
+        self._controller = controller
+        self._acquired_at = time.monotonic()
+        self._released = False
+
+    def release(self):
+        """実行枠を返し、待っている次のリクエストに渡す"""
+        if not self._released:
+            self._released = True
+            self._controller._release(time.monotonic() - self._acquired_at)
+
+class AdmissionController:
+    """
+    同時実行数と待ち行列の長さを制限する（待っているリクエストは到着順に実行枠を得る）
+
+    イベントループのスレッドからだけ使う。
+    """
+
+    def __init__(self, max_concurrency: int, max_queue: int):
+        """
+        Args:
+            max_concurrency (int): 同時に実行できるリクエスト数
+            max_queue (int): 実行枠を待てるリクエスト数（超えた分は AdmissionRejected）
+        """
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self._active = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._hold_seconds = 0.0  # 1リクエストが実行枠を持つ時間の移動平均（Retry-After の見積もり用）
+        self._lock = threading.Lock()
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    async def acquire(self, timeout: Optional[float] = None) -> AdmissionSlot:
+        """
+        実行枠を得る（空いていなければ到着順に待つ）
+
+        Args:
+            timeout (Optional[float]): 待つ秒数の上限（None なら無制限）
+
+        Returns:
+            AdmissionSlot: 実行枠（処理が終わったら release() する）
+
+        Raises:
+            AdmissionRejected: 待ち行列が埋まっている
+            DeadlineExceeded: timeout 秒待っても実行枠が空かなかった
+        """
+        if self._active < self.max_concurrency and not self._waiters:
+            self._active += 1
+            return self._admit()
+        if self.queue_full():
+            with self._lock:
+                self.rejected += 1
+            raise AdmissionRejected(self.retry_after())
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout)
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():
+                # 実行枠を渡された直後に取り消された場合は、次のリクエストに渡す
+                self._release(None)
+            else:
+                waiter.cancel()
+                self._waiters.remove(waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                with self._lock:
+                    self.timed_out += 1
+                raise DeadlineExceeded("Deadline exceeded while waiting in the queue") from None
+            raise
+        return self._admit()
+
+    def queue_full(self) -> bool:
+        """待ち行列が埋まっているか（acquire() を呼ぶと AdmissionRejected になる）"""
+        return len(self._waiters) >= self.max_queue
+
+    def retry_after(self) -> int:
+        """待ち行列がはけるまでの見積もり秒数（最低1秒）"""
+        rounds = (len(self._waiters) + 1) / max(self.max_concurrency, 1)
+        return max(1, math.ceil(self._hold_seconds * rounds))
+
+    def _admit(self) -> AdmissionSlot:
+        with self._lock:
+            self.admitted += 1
+        return AdmissionSlot(self)
+
+    def _release(self, held_seconds: Optional[float]):
+        """実行枠を返す（待っているリクエストがあれば、そのまま渡す）"""
+        if held_seconds is not None:
+            self._hold_seconds = held_seconds if not self._hold_seconds else 0.9 * self._hold_seconds + 0.1 * held_seconds
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._active -= 1
+
+    def stats(self) -> Dict[str, float]:
+        """実行中・待機中の件数と、受け付け・拒否・期限切れの累計を返す"""
+        with self._lock:
+            return {
+                "max_concurrency": self.max_concurrency,
+                "max_queue": self.max_queue,
+                "active": self._active,
+                "waiting": len(self._waiters),
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "timed_out": self.timed_out,
+                "avg_hold_seconds": round(self._hold_seconds, 3),
+            }
+
+async def watch_request(request, awaitable: Awaitable[T], deadline: Optional[float], poll_seconds: float = 0.25) -> T:
+    """
+    処理を実行しながら、クライアントの切断と期限を監視する
+
+    切断または期限切れの場合は処理を取り消す（スケジューラの生成なら、
+    次のデコードステップでバッチから外れる）。
+
+    Args:
+        request: Starlette の Request（is_disconnected() で切断を調べる）
+        awaitable (Awaitable[T]): 実行する処理（非同期ジェネレータの __anext__() でもよい）
+        deadline (Optional[float]): 期限（イベントループの時刻、None なら期限なし）
+        poll_seconds (float): 切断を調べる間隔（秒）
+
+    Returns:
+        T: 処理の結果
+
+    Raises:
+        ClientDisconnected: クライアントが切断した
+        DeadlineExceeded: 期限を過ぎた
+    """
+    loop = asyncio.get_running_loop()
+    task = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            wait = poll_seconds if deadline is None else min(poll_seconds, max(0.0, deadline - loop.time()))
+            done, _ = await asyncio.wait({task}, timeout=wait)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                raise ClientDisconnected()
+            if deadline is not None and loop.time() >= deadline:
+                raise DeadlineExceeded("Deadline exceeded")
+    finally:
+        if not task.done():
+            task.cancel()
+            # 取り消しが終わるまで待つ（非同期ジェネレータの __anext__ なら、その後に閉じられる）
+            await asyncio.wait({task})
@@ -1,8 +1,20 @@
 # app.py - 改良版Streamlit UI
 import requests
+from requests.adapters import HTTPAdapter  # 接続プールの大きさの設定用
 import streamlit as st
 import random
-import re
+import json
+from concurrent.futures import ThreadPoolExecutor  # 次のランダムペルソナの先読み用
+
+from streaming import strip_think  # 思考部分の除去（サーバーと同じフィルタ）
+
+SERVER_URL = "http://localhost:8080"  # FastAPI サーバー
+PERSONA_FIELDS = "persona,occupation,age,region"  # 表示に使うペルソナの項目
+PERSONA_TTL_SECONDS = 600  # ペルソナ情報・検索結果をキャッシュする秒数
+STATS_TTL_SECONDS = 300  # 統計情報・サーバー設定をキャッシュする秒数
+DEFAULT_HISTORY_TOKEN_BUDGET = 1024  # サーバーから取得できない場合のプロンプトの最大トークン数
+HISTORY_CHARS_PER_TOKEN = 4  # 送る履歴の文字数の目安（トークン数の上限×この値。サーバーで上限に合わせて切り詰める）
+RECENT_TURNS = 20  # 常に表示する直近の発言数（それより前は必要なときだけ表示）
 
 # ページ設定
 st.set_page_config(
@@ -11,6 +23,85 @@ st.set_page_config(
     layout="wide"
 )
 
+# =============================================================================
+# サーバーとの通信（接続の使い回し・TTL付きキャッシュ・先読み）
+# =============================================================================
+
+@st.cache_resource
+def http_client() -> requests.Session:
+    """
+    サーバーとの接続を使い回す HTTP クライアント（再実行・ブラウザのセッションをまたいで共有）
+    レスポンスの gzip は requests が自動で展開する
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+@st.cache_resource
+def prefetch_pool() -> ThreadPoolExecutor:
+    """ペルソナ情報を先読みするスレッド（全セッションで共有）"""
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="persona-prefetch")
+
+def get_persona(client: requests.Session, index: int) -> dict:
+    """ペルソナ情報（表示に使う項目だけ）を取得する（エラー時は requests の例外）"""
+    response = client.get(f"{SERVER_URL}/personas/{index}", params={"fields": PERSONA_FIELDS}, timeout=10)
+    response.raise_for_status()
+    return response.json()
+
+@st.cache_data(ttl=PERSONA_TTL_SECONDS, show_spinner=False)
+def fetch_persona(index: int) -> dict:
+    """ペルソナ情報を取得する（同じ番号は TTL の間キャッシュ。エラーはキャッシュしない）"""
+    return get_persona(http_client(), index)
+
+@st.cache_data(ttl=PERSONA_TTL_SECONDS, show_spinner=False)
+def search_persona(conditions: dict):
+    """条件に合う最初のペルソナの番号を返す（なければ None）"""
+    response = http_client().get(f"{SERVER_URL}/personas/search", params={**conditions, "limit": 1}, timeout=10)
+    response.raise_for_status()
+    results = response.json()["results"]
+    return results[0]["id"] if results else None
+
+@st.cache_data(ttl=STATS_TTL_SECONDS, show_spinner=False)
+def fetch_stats() -> dict:
+    """データセットの統計情報（/stats）を取得する"""
+    response = http_client().get(f"{SERVER_URL}/stats", timeout=10)
+    response.raise_for_status()
+    return response.json()
+
+@st.cache_data(ttl=STATS_TTL_SECONDS, show_spinner=False)
+def fetch_history_token_budget() -> int:
+    """サーバーがプロンプトに使う最大トークン数を取得する"""
+    response = http_client().get(f"{SERVER_URL}/", timeout=5)
+    response.raise_for_status()
+    return int(response.json().get("history_token_budget") or DEFAULT_HISTORY_TOKEN_BUDGET)
+
+def prefetch_random_persona():
+    """次のランダム選択で使うペルソナを先に決め、その情報をバックグラウンドで取得しておく"""
+    index = random.randint(0, 999999)
+    st.session_state.next_random = (index, prefetch_pool().submit(get_persona, http_client(), index))
+
+def history_window(history: list) -> list:
+    """
+    サーバーがプロンプトに使う範囲の履歴だけを返す（会話が長くなっても送る量が増えないように）
+
+    サーバーは新しい発言からトークン数の上限に収まるだけ残すので、
+    文字数で多めに見積もった分（上限×HISTORY_CHARS_PER_TOKEN 文字）まで新しい順に残す。
+    """
+    try:
+        budget = fetch_history_token_budget()
+    except requests.exceptions.RequestException:
+        budget = DEFAULT_HISTORY_TOKEN_BUDGET
+    limit = budget * HISTORY_CHARS_PER_TOKEN
+    window, chars = [], 0
+    for turn in reversed(history):
+        if window and chars + len(turn["content"]) > limit:
+            break
+        window.append(turn)
+        chars += len(turn["content"])
+    return window[::-1]
+
 # Google Fonts (Noto Sans JP) を読み込み
 st.markdown("""
 <link rel="preconnect" href="https://fonts.googleapis.com">
@@ -46,16 +137,16 @@ with st.sidebar:
     )
 
     if persona_method == "おすすめペルソナから選択":
-        # 定義済みのおすすめペルソナ
+        # おすすめペルソナ（検索条件で定義し、条件に合う最初のペルソナを使う）
         recommended_personas = {
-            "東京の介護福祉士（72歳女性）": 0,
-            "大阪の教師（45歳男性）": 1000,
-            "札幌の看護師（30歳女性）": 2000,
-            "福岡の営業（28歳男性）": 3000,
-            "名古屋の主婦（55歳女性）": 4000,
-            "仙台の学生（22歳女性）": 5000,
-            "広島の医師（40歳男性）": 6000,
-            "京都の芸術家（35歳女性）": 7000
+            "東京の介護福祉士（72歳女性）": {"prefecture": "東京", "occupation": "介護", "sex": "女", "age_min": 70, "age_max": 75},
+            "大阪の教師（45歳男性）": {"prefecture": "大阪", "occupation": "教", "sex": "男", "age_min": 43, "age_max": 47},
+            "札幌の看護師（30歳女性）": {"prefecture": "北海道", "occupation": "看護", "sex": "女", "age_min": 28, "age_max": 32},
+            "福岡の営業（28歳男性）": {"prefecture": "福岡", "occupation": "営業", "sex": "男", "age_min": 26, "age_max": 30},
+            "名古屋の主婦（55歳女性）": {"prefecture": "愛知", "occupation": "主婦", "sex": "女", "age_min": 53, "age_max": 57},
+            "仙台の学生（22歳女性）": {"prefecture": "宮城", "occupation": "学生", "sex": "女", "age_min": 20, "age_max": 24},
+            "広島の医師（40歳男性）": {"prefecture": "広島", "occupation": "医師", "sex": "男", "age_min": 38, "age_max": 42},
+            "京都の芸術家（35歳女性）": {"prefecture": "京都", "occupation": "芸術", "sex": "女", "age_min": 33, "age_max": 37}
         }
 
         selected_persona = st.selectbox(
@@ -63,11 +154,32 @@ with st.sidebar:
             list(recommended_personas.keys()),
             index=0
         )
-        st.session_state.persona_index = recommended_personas[selected_persona]
+
+        # 検索結果は条件ごとにキャッシュし、選び直すたびに検索しない
+        recommended_id = None
+        try:
+            recommended_id = search_persona(recommended_personas[selected_persona])
+        except Exception as e:
+            st.error(f"接続エラー: {e}")
+
+        if recommended_id is not None:
+            st.session_state.persona_index = recommended_id
+            st.write(f"現在のペルソナ番号: {st.session_state.persona_index}")
+        else:
+            st.warning("条件に合うペルソナが見つかりませんでした")
 
     elif persona_method == "ランダム選択":
+        # 次に選ぶペルソナは先に決めて情報を取得しておき、ボタンを押したらすぐ表示する
+        if "next_random" not in st.session_state:
+            prefetch_random_persona()
         if st.button("🎲 ランダムペルソナを選択", type="primary"):
-            st.session_state.persona_index = random.randint(0, 999999)
+            index, prefetched = st.session_state.next_random
+            st.session_state.persona_index = index
+            try:
+                st.session_state.current_persona = prefetched.result(timeout=10)
+            except Exception:
+                st.session_state.current_persona = None  # 「ペルソナ情報を取得」で取り直せる
+            prefetch_random_persona()
         st.write(f"現在のペルソナ番号: {st.session_state.persona_index}")
 
     else:  # 番号で直接指定
@@ -79,11 +191,22 @@ with st.sidebar:
     # 現在のペルソナ情報を取得ボタン
     if st.button("📋 ペルソナ情報を取得"):
         try:
-            response = requests.get(f"http://localhost:8080/personas/{st.session_state.persona_index}")
-            if response.status_code == 200:
-                st.session_state.current_persona = response.json()
-            else:
-                st.error(f"ペルソナ取得エラー: {response.status_code}")
+            # 表示に使う項目だけを取得する（同じ番号はキャッシュから）
+            st.session_state.current_persona = fetch_persona(int(st.session_state.persona_index))
+        except requests.exceptions.HTTPError as e:
+            st.error(f"ペルソナ取得エラー: {e.response.status_code}")
+        except Exception as e:
+            st.error(f"接続エラー: {e}")
+
+    # データセットの統計（TTL の間はキャッシュから表示）
+    with st.expander("📊 データセット統計"):
+        try:
+            stats = fetch_stats()
+            st.write(f"総ペルソナ数: {stats['total_personas']:,}")
+            st.write("職業TOP10: " + "、".join(f"{name}（{count:,}）" for name, count in stats["top_occupations"]))
+            st.bar_chart(stats["age_groups"])
+        except requests.exceptions.HTTPError as e:
+            st.info(f"統計情報はまだ取得できません（{e.response.status_code}）")
         except Exception as e:
             st.error(f"接続エラー: {e}")
 
@@ -118,43 +241,103 @@ with col1:
         max_tokens = st.slider("最大トークン数", 50, 5000, 2000)
         temperature = st.slider("創造性（Temperature）", 0.0, 1.0, 0.7, 0.1)
         top_p = st.slider("語彙選択幅（Top-p）", 0.0, 1.0, 0.9, 0.1)
+        enable_thinking = st.checkbox("思考モード（返答の前に考える）", value=True)
+        thinking_budget = st.slider("思考の最大トークン数", 0, 2000, 512, 64, disabled=not enable_thinking)
+
+# 会話履歴の表示
+def render_history():
+    """会話履歴をチャット形式で表示する（直近 RECENT_TURNS 件より前は切り替えたときだけ）"""
+    if st.session_state.history:
+        history = st.session_state.history
+        older = len(history) - RECENT_TURNS
+        if older > 0 and not st.toggle(f"以前の発言を表示（{older}件）", key="show_older_turns"):
+            history = history[-RECENT_TURNS:]
+        for turn in history:
+            if turn["role"] == "user":
+                with st.chat_message("user", avatar="👤"):
+                    st.write(turn["content"])
+            else:
+                with st.chat_message("assistant", avatar="🤖"):
+                    st.write(turn["content"])
+    else:
+        st.info("👋 こんにちは！チャットを開始するには下のメッセージボックスに入力してください。")
+
+# Server-Sent Events の読み取り
+def iter_sse(response):
+    """
+    /chat/stream のレスポンスを (イベント名, データ) の組に分解する
+    イベントは空行で区切られ、"event:" 行と "data:" 行（JSON）からなる
+    """
+    response.encoding = "utf-8"
+    event, data_lines = "message", []
+    for line in response.iter_lines(decode_unicode=True):
+        if not line:
+            if data_lines:
+                yield event, json.loads("\n".join(data_lines))
+            event, data_lines = "message", []
+        elif line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            data_lines.append(line[len("data:"):].lstrip())
+
+history_rendered = False
 
 # チャット処理
 if send_button and user_input:
     # ユーザーメッセージを履歴に追加
     st.session_state.history.append({"role": "user", "content": user_input})
 
-    # APIリクエスト送信
+    # APIリクエスト送信（履歴はサーバーがプロンプトに使う範囲だけ）
     payload = {
-        "messages": st.session_state.history,
+        "messages": history_window(st.session_state.history),
         "persona_index": st.session_state.persona_index,
         "max_new_tokens": max_tokens,
         "temperature": temperature,
-        "top_p": top_p
+        "top_p": top_p,
+        "enable_thinking": enable_thinking,
+        "thinking_budget": thinking_budget
     }
 
-    try:
-        with st.spinner("🤖 AI が返答を生成中..."):
-            response = requests.post("http://localhost:8080/chat", json=payload, timeout=120)
+    # これまでの履歴と、返答を書き込んでいく吹き出しを先に表示
+    with chat_container:
+        render_history()
+        with st.chat_message("assistant", avatar="🤖"):
+            reply_placeholder = st.empty()
+            reply_placeholder.markdown("🤖 AI が返答を生成中...")
+    history_rendered = True
 
-        if response.status_code == 200:
-            response_data = response.json()
-            reply = response_data.get("reply", "エラー: レスポンスが空です")
-
-            # <think> タグとその内容を除去
-            reply = re.sub(r'<think>.*?</think>', '', reply, flags=re.DOTALL)
-            reply = re.sub(r'</?think>', '', reply)  # 閉じタグが残っている場合の対応
-            reply = reply.strip()
-
-            # AI応答を履歴に追加
-            st.session_state.history.append({"role": "assistant", "content": reply})
-
-            # ペルソナ情報を更新
-            if response_data.get("persona_info"):
-                st.session_state.current_persona = response_data["persona_info"]
+    try:
+        # 返答をトークン単位で受け取り、届いた分から表示する
+        # （timeout はトークン間の待ち時間の上限。生成全体の時間ではない）
+        with http_client().post(f"{SERVER_URL}/chat/stream", json=payload, stream=True, timeout=120) as response:
+            if response.status_code == 200:
+                reply = ""
+                for event, data in iter_sse(response):
+                    if event == "token":
+                        reply += data.get("text", "")
+                        reply_placeholder.markdown(reply + "▌")
+                    elif event == "persona":
+                        # ペルソナ情報を更新
+                        st.session_state.current_persona = data
+                    elif event == "error":
+                        raise RuntimeError(data.get("detail", "不明なエラー"))
+
+                # 思考部分はサーバー側で除去済み（残っていてもサーバーと同じフィルタで取り除く）
+                reply = strip_think(reply) or "エラー: レスポンスが空です"
+                reply_placeholder.markdown(reply)
+
+                # AI応答を履歴に追加
+                st.session_state.history.append({"role": "assistant", "content": reply})
+
+            elif response.status_code == 429:
+                # 同時実行数の上限に達している（Retry-After 秒後に再送できる）
+                reply_placeholder.empty()
+                retry_after = response.headers.get("Retry-After", "数")
+                st.warning(f"⏳ サーバーが混雑しています。{retry_after}秒ほど待ってからもう一度送信してください。")
 
-        else:
-            st.error(f"🚫 サーバーエラー: {response.status_code}")
+            else:
+                reply_placeholder.empty()
+                st.error(f"🚫 サーバーエラー: {response.status_code}")
 
     except requests.exceptions.Timeout:
         st.error("⏰ リクエストタイムアウト（120秒）。サーバーが応答しません。")
@@ -164,17 +347,9 @@ if send_button and user_input:
         st.error(f"❌ 処理エラー: {e}")
 
 # 会話履歴表示（上部のコンテナに配置）
-with chat_container:
-    if st.session_state.history:
-        for i, turn in enumerate(st.session_state.history):
-            if turn["role"] == "user":
-                with st.chat_message("user", avatar="👤"):
-                    st.write(turn["content"])
-            else:
-                with st.chat_message("assistant", avatar="🤖"):
-                    st.write(turn["content"])
-    else:
-        st.info("👋 こんにちは！チャットを開始するには下のメッセージボックスに入力してください。")
+if not history_rendered:
+    with chat_container:
+        render_history()
 
 # サイドバー：ペルソナ情報表示
 with col2:
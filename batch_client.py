@@ -0,0 +1,61 @@
+# =============================================================================
+# 一括生成のクライアント（POST /chat/batch）
+# =============================================================================
+# 1行に1つのチャットリクエストを書いた JSONL ファイルをサーバーに送り、
+# 返ってくる結果（NDJSON、入力と同じ順番）をファイルに書き出す:
+#   python batch_client.py requests.jsonl --output replies.jsonl
+#
+# 入力の各行は /chat と同じ形式（任意で "id" を付けると結果にもそのまま付く）:
+#   {"id": "q1", "messages": [{"role": "user", "content": "自己紹介をお願いします。"}], "persona_index": 0}
+# 失敗した行は {"index": ..., "error": {...}} になり、他の行の処理は続く。
+# =============================================================================
+import argparse  # コマンドライン引数の解析用
+import json  # 結果の解析用
+import sys  # 標準入出力・進み具合の表示用
+import time  # 所要時間の計測用
+
+import requests  # HTTP通信用
+
+def main():
+    parser = argparse.ArgumentParser(description="JSONL のチャットリクエストをまとめて生成する（POST /chat/batch）")
+    parser.add_argument("input", help="入力の JSONL ファイル（- で標準入力）")
+    parser.add_argument("--output", default="-", help="結果の書き出し先（- で標準出力）")
+    parser.add_argument("--url", default="http://localhost:8080", help="サーバーのURL")
+    parser.add_argument("--timeout", type=float, default=None, help="タイムアウト（秒、省略時は無制限）")
+    args = parser.parse_args()
+
+    source = sys.stdin.buffer if args.input == "-" else open(args.input, "rb")
+    output = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+    started = time.perf_counter()
+    count = errors = 0
+    try:
+        # 入力はファイルのまま送り（全体をメモリに読み込まない）、結果は届いた行から書き出す
+        with requests.post(
+            f"{args.url}/chat/batch",
+            data=source,
+            headers={"Content-Type": "application/x-ndjson"},
+            stream=True,
+            timeout=args.timeout,
+        ) as response:
+            if response.status_code != 200:
+                print(f"Error {response.status_code}: {response.text}", file=sys.stderr)
+                sys.exit(1)
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                output.write(line.decode("utf-8") + "\n")
+                count += 1
+                if "error" in json.loads(line):
+                    errors += 1
+                if count % 100 == 0:
+                    print(f"{count} done ({count / (time.perf_counter() - started):.1f}/s)", file=sys.stderr)
+    finally:
+        if source is not sys.stdin.buffer:
+            source.close()
+        if output is not sys.stdout:
+            output.close()
+
+    print(f"{count} results ({errors} errors) in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
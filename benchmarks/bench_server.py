@@ -0,0 +1,41 @@
+# =============================================================================
+# ベンチマーク用のサーバー（小さなモデルと合成ペルソナで server.py を起動する）
+# =============================================================================
+# load_test.py が別プロセスとして起動する（メモリ使用量をサーバーだけで測るため）。
+# 単独でも起動できる:
+#   python benchmarks/bench_server.py --port 8090
+# =============================================================================
+import argparse  # コマンドライン引数の解析用
+import logging  # ログ出力用
+import os  # 作業ディレクトリの作成用
+import tempfile  # 作業ディレクトリ（キャッシュの保存先）用
+
+import uvicorn  # ASGIサーバー
+
+from common import configure_environment, patch_server  # 合成データと小さなモデル
+
+def main():
+    parser = argparse.ArgumentParser(description="小さなモデルと合成ペルソナでチャットサーバーを起動する")
+    parser.add_argument("--host", default="127.0.0.1", help="待ち受けるアドレス")
+    parser.add_argument("--port", type=int, default=8090, help="待ち受けるポート")
+    parser.add_argument("--personas", type=int, default=2000, help="合成ペルソナ数")
+    parser.add_argument("--layers", type=int, default=2, help="モデルの層の数")
+    parser.add_argument("--hidden-size", type=int, default=64, help="モデルの隠れ層の次元（16の倍数）")
+    parser.add_argument("--draft-layers", type=int, default=1, help="NEMO_DRAFT_MODEL を指定したときの下書きモデルの層の数")
+    parser.add_argument("--seed", type=int, default=0, help="合成データとモデルの重みの乱数のシード")
+    parser.add_argument("--work-dir", default=None, help="キャッシュの保存先（省略時は一時ディレクトリ）")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="nemo_bench_")
+    os.makedirs(work_dir, exist_ok=True)
+    configure_environment(work_dir)
+
+    import server  # 環境変数を設定してから import する（設定は import 時に読まれる）
+
+    patch_server(server, personas=args.personas, layers=args.layers, hidden_size=args.hidden_size, seed=args.seed,
+                 draft_layers=args.draft_layers)
+    uvicorn.run(server.app, host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+# =============================================================================
+# ベンチマーク共通部品（小さなモデル・合成ペルソナ・サーバーの起動）
+# =============================================================================
+# 負荷試験はネットワークに接続せずに何度でも同じ条件で実行できるようにするため、
+# 本物の Qwen3 とデータセットの代わりに以下を使う:
+#   - 文字単位のトークナイザー（Qwen3 と同じ特殊トークンを持つ）
+#   - ランダムな重みの小さな Qwen3 モデル（乱数のシードを固定）
+#   - 乱数のシードを固定した合成ペルソナのデータセット
+#
+# patch_server() はサーバーの読み込み関数をこれらに置き換えるので、
+# サーバー側のコード（スケジューラ・キャッシュ・統計・検索など）はそのまま動く。
+# =============================================================================
+import os  # 環境変数の設定用
+import random  # 合成データの生成用
+import sys  # リポジトリのルートを import パスに追加する用
+from typing import List
+
+import torch  # PyTorch（モデルの乱数シード固定）
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers  # 文字単位のトークナイザー
+from transformers import PreTrainedTokenizerFast, Qwen3Config, Qwen3ForCausalLM  # 小さな Qwen3 モデル
+
+# benchmarks/ から実行してもサーバーのモジュールを import できるようにする
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from persona_prompts import build_persona_prompt  # システムプロンプトのテンプレート（語彙に含める文字用）
+
+# Qwen3 の会話形式で使う特殊トークン
+SPECIAL_TOKENS = ["<|endoftext|>", "<|im_start|>", "<|im_end|>", "<think>", "</think>"]
+
+OCCUPATIONS = ["教師", "看護師", "医師", "営業", "会社員", "農家", "エンジニア", "公務員", "主婦", "学生", "調理師", "デザイナー"]
+REGIONS = {
+    "北海道": ["北海道"],
+    "東北": ["宮城県", "青森県", "福島県"],
+    "関東": ["東京都", "神奈川県", "埼玉県", "千葉県"],
+    "中部": ["愛知県", "静岡県", "新潟県"],
+    "近畿": ["大阪府", "京都府", "兵庫県"],
+    "中国": ["広島県", "岡山県"],
+    "四国": ["愛媛県", "香川県"],
+    "九州": ["福岡県", "熊本県", "沖縄県"],
+}
+HOBBIES = ["旅行", "読書", "料理", "釣り", "登山", "映画", "音楽", "園芸", "写真", "将棋"]
+
+# 負荷試験で送るユーザーの発言とアシスタントの返答（履歴の組み立て用）
+USER_MESSAGES = [
+    "こんにちは！自己紹介をお願いします。",
+    "お仕事について教えてください。",
+    "休みの日は何をしていますか？",
+    "最近うれしかったことはありますか？",
+    "地元のおすすめの場所を教えてください。",
+    "子どもの頃の夢は何でしたか？",
+]
+ASSISTANT_MESSAGES = [
+    "はい、よろしくお願いします。毎日いろいろなことがあります。",
+    "そうですね、仕事は大変ですがやりがいがあります。",
+    "休みの日は家でゆっくりすることが多いです。",
+]
+
+def synthetic_personas(count: int, seed: int = 0) -> dict:
+    """
+    合成ペルソナを列ごとのリストで作る（datasets.Dataset.from_dict に渡せる形式）
+
+    Args:
+        count (int): ペルソナ数
+        seed (int): 乱数のシード
+
+    Returns:
+        dict: {列名: 値のリスト}
+    """
+    rng = random.Random(seed)
+    columns = {name: [] for name in ("persona", "occupation", "age", "region", "prefecture", "sex")}
+    for i in range(count):
+        occupation = rng.choice(OCCUPATIONS)
+        region = rng.choice(list(REGIONS))
+        hobbies = "と".join(rng.sample(HOBBIES, 2))
+        columns["persona"].append(f"人物{i}は{region}に住む{occupation}です。趣味は{hobbies}で、休日はよく出かけます。")
+        columns["occupation"].append(occupation)
+        columns["age"].append(rng.randint(18, 90))
+        columns["region"].append(region)
+        columns["prefecture"].append(rng.choice(REGIONS[region]))
+        columns["sex"].append(rng.choice(["男", "女"]))
+    return columns
+
+def _vocabulary(texts: List[str]) -> List[str]:
+    """トークナイザーの語彙（ASCII・ひらがな・カタカナと、texts に出てくる文字）"""
+    chars = [chr(c) for c in range(32, 127)] + ["\n"]
+    chars += [chr(c) for c in range(0x3041, 0x3097)] + [chr(c) for c in range(0x30A1, 0x30FB)] + ["ー"]
+    for text in texts:
+        chars.extend(text)
+    return list(dict.fromkeys(chars))
+
+def build_tokenizer(personas: dict) -> PreTrainedTokenizerFast:
+    """
+    文字単位のトークナイザーを作る（語彙にない文字は <|endoftext|> になる）
+
+    Args:
+        personas (dict): synthetic_personas の結果（語彙に含める文字用）
+
+    Returns:
+        PreTrainedTokenizerFast: トークナイザー
+    """
+    texts = personas["persona"] + USER_MESSAGES + ASSISTANT_MESSAGES + [
+        build_persona_prompt({"persona": "", "occupation": "", "age": 0, "region": ""}),
+        build_persona_prompt({}),
+        "".join(OCCUPATIONS) + "".join(REGIONS) + "".join(p for ps in REGIONS.values() for p in ps) + "男女",
+    ]
+    vocab = {token: i for i, token in enumerate(SPECIAL_TOKENS)}
+    for char in _vocabulary(texts):
+        vocab.setdefault(char, len(vocab))
+    backend = Tokenizer(models.WordLevel(vocab, unk_token="<|endoftext|>"))
+    backend.pre_tokenizer = pre_tokenizers.Split("", "isolated")  # 1文字ずつに分割
+    backend.decoder = decoders.Fuse()
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=backend,
+        eos_token="<|im_end|>",
+        pad_token="<|endoftext|>",
+        additional_special_tokens=SPECIAL_TOKENS[1:3],
+    )
+    # Qwen3 と同じく、思考のタグは1トークンだが特殊トークンではない（デコード結果に残る）
+    tokenizer.add_tokens(SPECIAL_TOKENS[3:])
+    return tokenizer
+
+def build_model(tokenizer, layers: int = 2, hidden_size: int = 64, seed: int = 0) -> Qwen3ForCausalLM:
+    """
+    ランダムな重みの小さな Qwen3 モデルを作る
+
+    Args:
+        tokenizer: build_tokenizer のトークナイザー
+        layers (int): 層の数
+        hidden_size (int): 隠れ層の次元（16の倍数）
+        seed (int): 重みの乱数のシード
+
+    Returns:
+        Qwen3ForCausalLM: 評価モードのモデル
+    """
+    torch.manual_seed(seed)
+    config = Qwen3Config(
+        vocab_size=len(tokenizer),
+        hidden_size=hidden_size,
+        intermediate_size=hidden_size * 2,
+        num_hidden_layers=layers,
+        num_attention_heads=hidden_size // 16,
+        num_key_value_heads=max(1, hidden_size // 32),
+        head_dim=16,
+        max_position_embeddings=4096,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id,
+    )
+    return Qwen3ForCausalLM(config).eval()
+
+def patch_server(server, personas: int = 2000, layers: int = 2, hidden_size: int = 64, seed: int = 0, draft_layers: int = 1):
+    """
+    サーバーのデータセット・トークナイザー・モデルの読み込みを合成データと小さなモデルに置き換える
+
+    サーバーの設定（NEMO_* 環境変数）は import 時に読まれるので、server を import する前に
+    configure_environment() を呼んでおくこと。
+
+    Args:
+        server: import 済みの server モジュール
+        personas (int): 合成ペルソナ数
+        layers (int): モデルの層の数
+        hidden_size (int): モデルの隠れ層の次元
+        seed (int): 乱数のシード
+        draft_layers (int): NEMO_DRAFT_MODEL を指定したときの下書きモデルの層の数
+            （同じシードで作るので、本体の先頭 draft_layers 層と同じ重みになる）
+    """
+    import datasets  # 合成データを Dataset にする用
+
+    columns = synthetic_personas(personas, seed)
+    dataset = datasets.Dataset.from_dict(columns)
+    tokenizer = build_tokenizer(columns)
+    model = build_model(tokenizer, layers=layers, hidden_size=hidden_size, seed=seed)
+
+    server.load_dataset = lambda *args, **kwargs: dataset
+    server.AutoTokenizer.from_pretrained = lambda *args, **kwargs: tokenizer
+
+    def from_pretrained(model_id, *args, **kwargs):
+        if model_id == server.MODEL_ID:
+            return model
+        return build_model(tokenizer, layers=draft_layers, hidden_size=hidden_size, seed=seed)
+
+    server.AutoModelForCausalLM.from_pretrained = from_pretrained
+
+def configure_environment(work_dir: str):
+    """
+    キャッシュの保存先を work_dir に向け、事前に作成するファイル（ベクトル・トークン化済み
+    プロンプト）を使わないようにする（実行のたびに同じ条件になる）
+
+    Args:
+        work_dir (str): 作業ディレクトリ
+    """
+    os.environ["NEMO_STATS_CACHE_DIR"] = os.path.join(work_dir, "stats")
+    os.environ["NEMO_PERSONA_STORE_DIR"] = os.path.join(work_dir, "persona_store")
+    os.environ["NEMO_VECTORS_DIR"] = os.path.join(work_dir, "persona_vectors")
+    os.environ["NEMO_PROMPTS_DIR"] = os.path.join(work_dir, "persona_prompts")
+    # 小さなモデルは fp32 で作るので、指定がなければそのまま使う
+    os.environ.setdefault("NEMO_PRECISION", "fp32")
@@ -0,0 +1,184 @@
+# =============================================================================
+# コンパイル済みの生成（CompiledScheduler）と通常の生成の1トークンあたりのレイテンシの比較（CPU）
+# =============================================================================
+# 同じプロンプト（長さを指定）をグリーディで1件ずつ生成し、次の3つを比べる:
+#   - generate: model.generate（eager、KV キャッシュは DynamicCache）
+#   - eager: サーバーの通常の経路（GenerationScheduler）
+#   - compiled: 静的な KV キャッシュ＋torch.compile（CompiledScheduler、プロンプトはバケットにパディング）
+# 最初のトークンまでの時間（TTFT）・デコードの1トークンあたりの時間・出力が一致したかを表示する。
+# 出力の一致は同じサンプリングの処理を通る eager と比べる（model.generate はロジットがほぼ同点の
+# ときに計算の順序の違いで別のトークンを選ぶことがあるため、参考として表示する）。
+# compiled のコンパイル時間（起動時の precompile）は別に表示し、計測には含めない。
+#
+# 既定では小さなランダムな重みのモデル（ネットワーク接続不要、ツールの動作確認用）で測る。
+# 実際のモデルで比べる場合は --model を指定する:
+#   python benchmarks/compile_bench.py --model Qwen/Qwen3-1.7B --precision fp32 --prompt-lengths 64 256 1024
+# =============================================================================
+import argparse  # コマンドライン引数の解析用
+import asyncio  # スケジューラの実行用
+import json  # 結果の保存用
+import os  # import パスの設定用
+import statistics  # 中央値の計算用
+import sys  # import パスの設定用
+import time  # 所要時間の計測用
+from typing import Dict, List
+
+import torch  # PyTorch（スレッド数の設定）
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import build_model, build_tokenizer, synthetic_personas  # 小さなモデルと合成ペルソナ
+from compiled_engine import CompiledScheduler  # 計測対象
+from precision import apply_precision, load_options  # 精度の切り替え（サーバーと同じ処理）
+from precision_report import build_prompts  # ペルソナのシステムプロンプト＋ユーザーの発言
+from scheduler import GenerationParams, GenerationScheduler  # サーバーの通常の経路
+
+def load_model(args):
+    """指定の精度でトークナイザーとモデルを用意する（サーバーと同じ読み込み方）"""
+    personas = synthetic_personas(16, args.seed)
+    if args.model:
+        from transformers import AutoModelForCausalLM, AutoTokenizer  # 実際のモデルの読み込み
+
+        tokenizer = AutoTokenizer.from_pretrained(args.model, trust_remote_code=True)
+        model = AutoModelForCausalLM.from_pretrained(
+            args.model, **load_options(args.precision), low_cpu_mem_usage=True, use_safetensors=True, trust_remote_code=True
+        )
+    else:
+        tokenizer = build_tokenizer(personas)
+        model = build_model(tokenizer, layers=args.layers, hidden_size=args.hidden_size, seed=args.seed)
+    model = apply_precision(model, args.precision)
+    model.eval()
+    return tokenizer, model, personas
+
+def make_prompts(tokenizer, personas: dict, lengths: List[int]) -> Dict[int, List[int]]:
+    """ペルソナのプロンプトをつなげたトークン列から、指定の長さのプロンプトを切り出す"""
+    ids: List[int] = []
+    count = 1
+    while len(ids) < max(lengths):
+        ids = [token for prompt in build_prompts(tokenizer, personas, count) for token in prompt]
+        count += 1
+    return {length: ids[:length] for length in lengths}
+
+@torch.inference_mode()
+def run_generate(model, prompt: List[int], max_new_tokens: int) -> dict:
+    """model.generate の TTFT（1トークンだけ生成する時間）と1トークンあたりのデコード時間を測る"""
+    input_ids = torch.tensor([prompt], device=model.device)
+    options = {"do_sample": False, "repetition_penalty": 1.0, "no_repeat_ngram_size": 0}
+    started = time.perf_counter()
+    model.generate(input_ids, max_new_tokens=1, min_new_tokens=1, **options)
+    ttft = time.perf_counter() - started
+    started = time.perf_counter()
+    output = model.generate(input_ids, max_new_tokens=max_new_tokens, min_new_tokens=max_new_tokens, **options)
+    total = time.perf_counter() - started
+    return {
+        "token_ids": output[0, len(prompt):].tolist(),
+        "ttft": ttft,
+        "decode_per_token": max(total - ttft, 0.0) / max(max_new_tokens - 1, 1),
+    }
+
+async def run_scheduler(scheduler, prompt: List[int], max_new_tokens: int) -> dict:
+    """スケジューラで生成し、段階別の所要時間から TTFT と1トークンあたりのデコード時間を求める"""
+    params = GenerationParams(max_new_tokens=max_new_tokens, temperature=0.0, repetition_penalty=1.0, no_repeat_ngram_size=0)
+    result = await scheduler.generate(prompt, params)
+    decoded = max(len(result.token_ids) - 1, 1)
+    return {
+        "token_ids": result.token_ids,
+        "ttft": result.timings["ttft"],
+        "decode_per_token": result.timings["decode"] / decoded,
+    }
+
+def summarize(runs: List[dict]) -> Dict[str, float]:
+    """繰り返した計測の中央値（ミリ秒）"""
+    return {
+        "ttft_ms": round(statistics.median(r["ttft"] for r in runs) * 1000, 2),
+        "decode_ms_per_token": round(statistics.median(r["decode_per_token"] for r in runs) * 1000, 3),
+    }
+
+def matches(a: List[int], b: List[int]) -> bool:
+    """出力が一致するか（終了トークンで止まった場合は短い方の長さまで。model.generate は終了トークンで止めない）"""
+    n = min(len(a), len(b))
+    return a[:n] == b[:n]
+
+async def run_all(args, tokenizer, model, prompts: Dict[int, List[int]]) -> dict:
+    """3つの経路をプロンプト長ごとに計測する"""
+    eager = GenerationScheduler(model, tokenizer, max_batch_size=1, num_threads=args.threads)
+    compiled = CompiledScheduler(
+        model, tokenizer, buckets=args.buckets, max_cache_len=args.max_cache_len, num_threads=args.threads
+    )
+    eager.start()
+    compiled.start()
+    try:
+        started = time.perf_counter()
+        compile_seconds = await compiled.precompile()
+        print(f"precompile: {time.perf_counter() - started:.1f}s {compile_seconds}", file=sys.stderr)
+
+        # 初回だけのコスト（メモリ確保など）を計測に含めない
+        first = next(iter(prompts.values()))
+        run_generate(model, first, 2)
+        await run_scheduler(eager, first, 2)
+        await run_scheduler(compiled, first, 2)
+
+        results = []
+        for length, prompt in prompts.items():
+            runs = {"generate": [], "eager": [], "compiled": []}
+            for _ in range(args.repeats):
+                runs["generate"].append(run_generate(model, prompt, args.max_new_tokens))
+                runs["eager"].append(await run_scheduler(eager, prompt, args.max_new_tokens))
+                runs["compiled"].append(await run_scheduler(compiled, prompt, args.max_new_tokens))
+            reference = runs["eager"][0]["token_ids"]
+            row = {"prompt_length": length}
+            for name, measured in runs.items():
+                row[name] = {**summarize(measured), "matches_eager": matches(measured[0]["token_ids"], reference)}
+            row["decode_speedup"] = round(
+                row["generate"]["decode_ms_per_token"] / row["compiled"]["decode_ms_per_token"], 2
+            ) if row["compiled"]["decode_ms_per_token"] else None
+            results.append(row)
+            print(f"prompt {length}: done", file=sys.stderr)
+        return {"compile_seconds": compile_seconds, "compiled": compiled.compiled, "stats": compiled.stats(), "results": results}
+    finally:
+        await eager.stop()
+        await compiled.stop()
+
+def print_report(report: dict):
+    """プロンプト長ごとの結果を表にして表示する"""
+    print(
+        f"\n{'prompt':>6} | {'ttft ms (generate / eager / compiled)':>38} | "
+        f"{'decode ms/token (generate / eager / compiled)':>46} | {'speedup':>7} | match (compiled / generate)"
+    )
+    for row in report["results"]:
+        ttft = " / ".join(f"{row[name]['ttft_ms']:>8}" for name in ("generate", "eager", "compiled"))
+        decode = " / ".join(f"{row[name]['decode_ms_per_token']:>9}" for name in ("generate", "eager", "compiled"))
+        match = f"{row['compiled']['matches_eager']} / {row['generate']['matches_eager']}"
+        print(f"{row['prompt_length']:>6} | {ttft:>38} | {decode:>46} | {row['decode_speedup']:>6}x | {match}")
+    if not report["compiled"]:
+        print(f"\ntorch.compile failed, compiled shows the static cache without compilation: {report['stats']['compile_error']}")
+    print(f"\nspeedup: model.generate に対する compiled のデコードの1トークンあたりの時間の比（compile: {report['compile_seconds']}）")
+
+def main():
+    parser = argparse.ArgumentParser(description="コンパイル済みの生成と通常の生成の1トークンあたりのレイテンシを比べる")
+    parser.add_argument("--model", default=None, help="Hugging Face のモデルID（省略時は小さなランダムなモデル）")
+    parser.add_argument("--precision", default="fp32", choices=("bf16", "fp32", "int8"), help="推論精度")
+    parser.add_argument("--prompt-lengths", type=int, nargs="+", default=[48, 200, 700], help="プロンプトのトークン数")
+    parser.add_argument("--max-new-tokens", type=int, default=64, help="生成するトークン数")
+    parser.add_argument("--buckets", type=int, nargs="+", default=[64, 128, 256, 512], help="prefill の入力長のバケット")
+    parser.add_argument("--max-cache-len", type=int, default=2048, help="静的な KV キャッシュのトークン数")
+    parser.add_argument("--repeats", type=int, default=3, help="プロンプト長ごとの繰り返し回数（中央値を表示）")
+    parser.add_argument("--layers", type=int, default=4, help="小さなモデルの層の数")
+    parser.add_argument("--hidden-size", type=int, default=256, help="小さなモデルの隠れ層の次元（16の倍数）")
+    parser.add_argument("--threads", type=int, default=0, help="torch のスレッド数（0で既定値）")
+    parser.add_argument("--seed", type=int, default=0, help="合成ペルソナと小さなモデルの乱数のシード")
+    parser.add_argument("--output", default=None, help="結果の JSON の保存先")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    tokenizer, model, personas = load_model(args)
+    prompts = make_prompts(tokenizer, personas, args.prompt_lengths)
+    report = asyncio.run(run_all(args, tokenizer, model, prompts))
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), **report}, f, ensure_ascii=False, indent=2)
+        print(f"\nResults written to {args.output}")
+
+if __name__ == "__main__":
+    main()
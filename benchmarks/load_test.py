@@ -0,0 +1,406 @@
+# =============================================================================
+# チャットサーバーの負荷試験
+# =============================================================================
+# 小さなモデルと合成ペルソナでサーバーを起動し（ネットワーク接続なし）、
+# 同時接続数・会話履歴の長さ・生成トークン数・ペルソナのばらつきを指定した
+# ワークロードを流して、次の値を測る:
+#   - レイテンシ（平均・p50・p95・p99・最大）とスループット（リクエスト/秒）
+#   - 最初のトークンまでの時間（/chat/stream）
+#   - 生成トークン/秒（サーバーの生成トークン数の増分から計算）
+#   - サーバーのメモリ使用量（RSS とその最大値）
+#
+# 結果は JSON に保存し、--compare で前回の結果と比べられる:
+#   python benchmarks/load_test.py --output before.json
+#   python benchmarks/load_test.py --output after.json --compare before.json
+#
+# リクエストの内容は --seed で決まるので、同じ引数なら毎回同じワークロードになる。
+# 起動済みのサーバー（本物のモデル）に対して実行する場合は --url を指定する。
+# =============================================================================
+import argparse  # コマンドライン引数の解析用
+import asyncio  # 同時リクエストの実行用
+import json  # 結果の保存・SSE イベントの解析用
+import os  # ファイルパス・環境変数の操作用
+import platform  # 実行環境の記録用
+import random  # ワークロードの生成用
+import socket  # 空いているポートの取得用
+import subprocess  # ベンチマーク用サーバーの起動用
+import sys  # Python 実行ファイルのパス用
+import tempfile  # ベンチマーク用サーバーのキャッシュの保存先
+import time  # 所要時間の計測用
+from typing import Dict, List, Optional
+
+import httpx  # 非同期HTTPクライアント
+import numpy as np  # パーセンタイルの計算用
+
+from common import ASSISTANT_MESSAGES, ROOT_DIR, USER_MESSAGES  # 会話履歴の組み立て用
+
+SCENARIOS = ("chat", "chat_stream", "stats", "personas")
+STATS_FILTERS = [{}, {"region": "関東"}, {"occupation": "教師"}, {"sex": "女", "age_min": 30, "age_max": 49}]
+PERSONA_FIELDS = "persona,occupation,age,region"
+BULK_PERSONAS = 20  # GET /personas で1度に取得する件数
+
+def percentiles(values: List[float]) -> Optional[Dict[str, float]]:
+    """平均・p50・p95・p99・最大（ミリ秒）を返す"""
+    if not values:
+        return None
+    array = np.asarray(values) * 1000
+    p50, p95, p99 = np.percentile(array, [50, 95, 99])
+    return {
+        "mean": round(float(array.mean()), 2),
+        "p50": round(float(p50), 2),
+        "p95": round(float(p95), 2),
+        "p99": round(float(p99), 2),
+        "max": round(float(array.max()), 2),
+    }
+
+def child_pids(pid: int) -> List[int]:
+    """プロセスの子孫（推論ワーカーなど）のプロセスIDを返す"""
+    children: List[int] = []
+    try:
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children", encoding="utf-8") as f:
+                children.extend(int(child) for child in f.read().split())
+    except OSError:
+        return []
+    return children + [grandchild for child in children for grandchild in child_pids(child)]
+
+def pss_mb(pid: int) -> Optional[float]:
+    """プロセスの PSS（共有ページをプロセス数で割って数えたメモリ、MB）を返す"""
+    try:
+        with open(f"/proc/{pid}/smaps_rollup", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+def process_memory(pid: Optional[int]) -> Optional[Dict[str, float]]:
+    """
+    プロセスの RSS とその最大値（MB）を返す（/proc がない環境では None）
+
+    子プロセス（NEMO_INFERENCE_WORKERS の推論ワーカー）があれば、プロセス全体の PSS の合計も返す
+    （共有メモリの重みを重複して数えない）。
+    """
+    if pid is None:
+        return None
+    try:
+        with open(f"/proc/{pid}/status", encoding="utf-8") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+    except OSError:
+        return None
+    # VmRSS / VmHWM は "123456 kB" の形式
+    memory = {
+        "rss_mb": round(int(fields["VmRSS"].split()[0]) / 1024, 1),
+        "peak_rss_mb": round(int(fields["VmHWM"].split()[0]) / 1024, 1),
+    }
+    children = child_pids(pid)
+    if children:
+        pss = [pss_mb(p) for p in [pid] + children]
+        if all(value is not None for value in pss):
+            memory["processes"] = len(pss)
+            memory["total_pss_mb"] = round(sum(pss), 1)
+    return memory
+
+# =============================================================================
+# ワークロード（シナリオごとのリクエストの一覧）
+# =============================================================================
+
+def chat_payload(rng: random.Random, args) -> dict:
+    """会話履歴の長さとペルソナを指定どおりに選んだチャットのリクエスト"""
+    messages = []
+    for turn in range(args.history_turns):
+        messages.append({"role": "user", "content": USER_MESSAGES[turn % len(USER_MESSAGES)]})
+        messages.append({"role": "assistant", "content": rng.choice(ASSISTANT_MESSAGES)})
+    messages.append({"role": "user", "content": rng.choice(USER_MESSAGES)})
+    return {
+        "messages": messages,
+        "persona_index": rng.randrange(args.persona_spread),
+        "max_new_tokens": args.max_new_tokens,
+        "temperature": args.temperature,
+    }
+
+def build_workload(scenario: str, count: int, rng: random.Random, args) -> List[dict]:
+    """シナリオのリクエストを count 件作る（{"method", "path", "params", "json"}）"""
+    requests = []
+    for i in range(count):
+        if scenario == "chat":
+            requests.append({"method": "POST", "path": "/chat", "json": chat_payload(rng, args)})
+        elif scenario == "chat_stream":
+            requests.append({"method": "POST", "path": "/chat/stream", "json": chat_payload(rng, args)})
+        elif scenario == "stats":
+            requests.append({"method": "GET", "path": "/stats", "params": STATS_FILTERS[i % len(STATS_FILTERS)]})
+        elif scenario == "personas":
+            # 1件ずつの取得と、まとめての取得を交互に行う
+            if i % 2 == 0:
+                path = f"/personas/{rng.randrange(args.personas)}"
+                requests.append({"method": "GET", "path": path, "params": {"fields": PERSONA_FIELDS}})
+            else:
+                ids = ",".join(str(rng.randrange(args.personas)) for _ in range(BULK_PERSONAS))
+                requests.append({"method": "GET", "path": "/personas", "params": {"ids": ids, "fields": PERSONA_FIELDS}})
+        else:
+            raise ValueError(f"Unknown scenario: {scenario}")
+    return requests
+
+# =============================================================================
+# リクエストの実行
+# =============================================================================
+
+async def send(client: httpx.AsyncClient, request: dict) -> dict:
+    """
+    リクエストを1件送り、所要時間（ストリーミングなら最初のトークンまでの時間も）を返す
+    """
+    started = time.perf_counter()
+    if request["path"] != "/chat/stream":
+        response = await client.request(request["method"], request["path"], params=request.get("params"), json=request.get("json"))
+        return {"ok": response.status_code == 200, "status": response.status_code, "latency": time.perf_counter() - started}
+
+    result = {"ok": False, "status": None, "ttft": None, "tokens": None}
+    async with client.stream("POST", request["path"], json=request["json"]) as response:
+        result["status"] = response.status_code
+        event = None
+        async for line in response.aiter_lines():
+            if line.startswith("event:"):
+                event = line[len("event:"):].strip()
+            elif line.startswith("data:"):
+                if event == "token" and result["ttft"] is None:
+                    result["ttft"] = time.perf_counter() - started
+                elif event == "done":
+                    result["tokens"] = json.loads(line[len("data:"):])["generated_tokens"]
+                    result["ok"] = response.status_code == 200
+                elif event == "error":
+                    break
+    result["latency"] = time.perf_counter() - started
+    return result
+
+async def run_requests(client: httpx.AsyncClient, requests: List[dict], concurrency: int) -> List[dict]:
+    """requests を concurrency 本の同時接続で順に送る（結果は送った順）"""
+    results: List[Optional[dict]] = [None] * len(requests)
+    next_index = 0
+
+    async def worker():
+        nonlocal next_index
+        while next_index < len(requests):
+            index = next_index
+            next_index += 1
+            try:
+                results[index] = await send(client, requests[index])
+            except httpx.HTTPError as e:
+                results[index] = {"ok": False, "status": None, "latency": None, "error": str(e) or type(e).__name__}
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return results
+
+async def server_tokens(client: httpx.AsyncClient) -> Optional[int]:
+    """サーバーがこれまでに生成したトークン数（/health のスケジューラの統計）"""
+    response = await client.get("/health")
+    scheduler = response.json().get("scheduler") if response.status_code == 200 else None
+    return scheduler["generated_tokens"] if scheduler else None
+
+async def run_scenario(client: httpx.AsyncClient, scenario: str, args, server_pid: Optional[int]) -> dict:
+    """
+    シナリオを1つ実行して結果をまとめる（最初に --warmup 件を送り、集計には含めない）
+    """
+    rng = random.Random(f"{args.seed}:{scenario}")
+    if args.warmup:
+        await run_requests(client, build_workload(scenario, args.warmup, rng, args), args.concurrency)
+
+    requests = build_workload(scenario, args.requests, rng, args)
+    tokens_before = await server_tokens(client)
+    started = time.perf_counter()
+    results = await run_requests(client, requests, args.concurrency)
+    wall = time.perf_counter() - started
+    tokens_after = await server_tokens(client)
+
+    ok = [r for r in results if r["ok"]]
+    summary = {
+        "requests": len(results),
+        "errors": len(results) - len(ok),
+        "status_codes": dict(sorted(_count(str(r["status"]) for r in results).items())),
+        "wall_seconds": round(wall, 3),
+        "requests_per_second": round(len(ok) / wall, 2) if wall else 0.0,
+        "latency_ms": percentiles([r["latency"] for r in ok]),
+    }
+    if scenario == "chat_stream":
+        summary["ttft_ms"] = percentiles([r["ttft"] for r in ok if r["ttft"] is not None])
+    if scenario in ("chat", "chat_stream") and tokens_before is not None and tokens_after is not None:
+        # サーバー全体で生成したトークン数の増分（同時に生成した分も含めた集計スループット）
+        generated = tokens_after - tokens_before
+        summary["generated_tokens"] = generated
+        summary["tokens_per_second"] = round(generated / wall, 2) if wall else 0.0
+    summary["memory"] = process_memory(server_pid)
+    return summary
+
+def _count(values) -> Dict[str, int]:
+    """値ごとの件数"""
+    counts: Dict[str, int] = {}
+    for value in values:
+        counts[value] = counts.get(value, 0) + 1
+    return counts
+
+# =============================================================================
+# サーバーの起動と結果の表示
+# =============================================================================
+
+def free_port() -> int:
+    """空いているTCPポートを返す"""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_server(args, port: int, work_dir: str) -> subprocess.Popen:
+    """ベンチマーク用サーバーを別プロセスで起動する（キャッシュは work_dir に保存）"""
+    env = dict(os.environ)
+    env["NEMO_MAX_BATCH_SIZE"] = str(args.max_batch_size)
+    env["NEMO_PRECISION"] = args.precision
+    env["NEMO_INFERENCE_WORKERS"] = str(args.workers)
+    if args.draft_layers > 0:
+        # 推測デコード（下書きモデルは本体の先頭 draft_layers 層と同じ重みの小さなモデル）
+        env["NEMO_DRAFT_MODEL"] = "bench-draft"
+    command = [
+        sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_server.py"),
+        "--port", str(port),
+        "--personas", str(args.personas),
+        "--layers", str(args.layers),
+        "--hidden-size", str(args.hidden_size),
+        "--draft-layers", str(args.draft_layers),
+        "--seed", str(args.seed),
+        "--work-dir", work_dir,
+    ]
+    return subprocess.Popen(command, env=env, cwd=ROOT_DIR)
+
+async def wait_ready(client: httpx.AsyncClient, process: Optional[subprocess.Popen], timeout: float) -> float:
+    """/health/ready が200を返すまで待ち、かかった秒数を返す"""
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"Benchmark server exited with code {process.returncode}")
+        try:
+            if (await client.get("/health/ready")).status_code == 200:
+                return time.perf_counter() - started
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.1)
+    raise RuntimeError(f"Server did not become ready within {timeout:.0f}s")
+
+def git_commit() -> Optional[str]:
+    """現在のコミット（結果の比較時にどの版か分かるように記録する）"""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_results(results: dict, previous: Optional[dict] = None):
+    """シナリオごとの結果を表に表示する（previous があれば変化率も）"""
+    def delta(new, old):
+        if new is None or not old:
+            return ""
+        return f" ({(new - old) / old * 100:+.1f}%)"
+
+    print(f"\n{'scenario':<12} {'req/s':>16} {'p50 ms':>18} {'p95 ms':>18} {'p99 ms':>18} {'ttft p50':>18} {'tok/s':>18} {'mem MB':>8}")
+    for name, summary in results["scenarios"].items():
+        old = (previous or {}).get("scenarios", {}).get(name, {})
+        latency = summary["latency_ms"] or {}
+        old_latency = old.get("latency_ms") or {}
+        ttft = (summary.get("ttft_ms") or {}).get("p50")
+        old_ttft = (old.get("ttft_ms") or {}).get("p50")
+        memory = summary.get("memory") or {}
+        columns = [
+            f"{summary['requests_per_second']}{delta(summary['requests_per_second'], old.get('requests_per_second'))}",
+            *(f"{latency.get(p, '-')}{delta(latency.get(p), old_latency.get(p))}" for p in ("p50", "p95", "p99")),
+            f"{ttft if ttft is not None else '-'}{delta(ttft, old_ttft)}",
+            f"{summary.get('tokens_per_second', '-')}{delta(summary.get('tokens_per_second'), old.get('tokens_per_second'))}",
+            f"{memory.get('total_pss_mb', memory.get('rss_mb', '-'))}",
+        ]
+        print(f"{name:<12} {columns[0]:>16} {columns[1]:>18} {columns[2]:>18} {columns[3]:>18} {columns[4]:>18} {columns[5]:>18} {columns[6]:>8}")
+        if summary["errors"]:
+            print(f"{'':<12} errors: {summary['errors']} {summary['status_codes']}")
+
+async def run(args) -> dict:
+    process = None
+    url = args.url
+    work_dir = tempfile.TemporaryDirectory(prefix="nemo_bench_")
+    if url is None:
+        port = free_port()
+        url = f"http://127.0.0.1:{port}"
+        process = start_server(args, port, work_dir.name)
+
+    limits = httpx.Limits(max_connections=args.concurrency + 2, max_keepalive_connections=args.concurrency + 2)
+    try:
+        async with httpx.AsyncClient(base_url=url, timeout=args.timeout, limits=limits) as client:
+            startup_seconds = await wait_ready(client, process, args.startup_timeout)
+            pid = process.pid if process is not None else args.server_pid
+            results = {
+                "config": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+                "environment": {
+                    "commit": git_commit(),
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "cpu_count": os.cpu_count(),
+                },
+                "startup_seconds": round(startup_seconds, 3),
+                "startup_memory": process_memory(pid),
+                "scenarios": {},
+            }
+            for scenario in args.scenarios:
+                results["scenarios"][scenario] = await run_scenario(client, scenario, args, pid)
+                print(f"{scenario}: done ({results['scenarios'][scenario]['wall_seconds']}s)", file=sys.stderr)
+            health = (await client.get("/health")).json()
+            results["server"] = {key: health.get(key) for key in ("scheduler", "prefix_cache", "history")}
+    finally:
+        if process is not None:
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        work_dir.cleanup()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="チャットサーバーの負荷試験（小さなモデルと合成ペルソナ）")
+    parser.add_argument("--scenarios", type=lambda s: [x for x in s.split(",") if x], default=list(SCENARIOS),
+                        help=f"実行するシナリオ（カンマ区切り、{','.join(SCENARIOS)}）")
+    parser.add_argument("--concurrency", type=int, default=8, help="同時接続数")
+    parser.add_argument("--requests", type=int, default=64, help="シナリオごとのリクエスト数")
+    parser.add_argument("--warmup", type=int, default=4, help="集計前に送るリクエスト数")
+    parser.add_argument("--history-turns", type=int, default=2, help="会話履歴のターン数（ユーザーとアシスタントの組）")
+    parser.add_argument("--max-new-tokens", type=int, default=32, help="チャットで生成するトークン数の上限")
+    parser.add_argument("--temperature", type=float, default=0.0, help="生成の temperature（0でグリーディ）")
+    parser.add_argument("--persona-spread", type=int, default=16, help="チャットで使うペルソナの種類（先頭からこの件数）")
+    parser.add_argument("--personas", type=int, default=2000, help="合成ペルソナ数")
+    parser.add_argument("--layers", type=int, default=2, help="モデルの層の数")
+    parser.add_argument("--hidden-size", type=int, default=64, help="モデルの隠れ層の次元（16の倍数）")
+    parser.add_argument("--max-batch-size", type=int, default=8, help="サーバーの NEMO_MAX_BATCH_SIZE")
+    parser.add_argument("--workers", type=int, default=1, help="サーバーの NEMO_INFERENCE_WORKERS（推論ワーカープロセス数）")
+    parser.add_argument("--precision", default="fp32", help="サーバーの NEMO_PRECISION（bf16 / fp32 / int8）")
+    parser.add_argument("--draft-layers", type=int, default=0, help="推測デコードの下書きモデルの層の数（0で推測デコードなし）")
+    parser.add_argument("--seed", type=int, default=0, help="ワークロード・合成データ・モデルの乱数のシード")
+    parser.add_argument("--url", default=None, help="起動済みのサーバーのURL（省略時はベンチマーク用サーバーを起動）")
+    parser.add_argument("--server-pid", type=int, default=None, help="--url のサーバーのプロセスID（メモリ使用量の計測用）")
+    parser.add_argument("--timeout", type=float, default=300.0, help="1リクエストのタイムアウト（秒）")
+    parser.add_argument("--startup-timeout", type=float, default=300.0, help="サーバーの起動を待つ時間（秒）")
+    parser.add_argument("--output", default="benchmark_results.json", help="結果の保存先（JSON）")
+    parser.add_argument("--compare", default=None, help="比較する前回の結果（JSON）")
+    args = parser.parse_args()
+
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+    args.persona_spread = min(args.persona_spread, args.personas)
+
+    results = asyncio.run(run(args))
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+
+    previous = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            previous = json.load(f)
+    print_results(results, previous)
+    print(f"\nResults written to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+# =============================================================================
+# 推論精度（NEMO_PRECISION）ごとの品質・速度・メモリの比較
+# =============================================================================
+# 精度ごとに別プロセスでモデルを読み込み（メモリの計測が前の精度に影響されないように）、
+# 固定のプロンプト（ペルソナのシステムプロンプト＋ユーザーの発言）をグリーディで生成して、
+# 次の値を比べる:
+#   - メモリ: 重みのバイト数、プロセスの RSS とその最大値
+#   - 速度: 最初のトークンまでの時間、デコードのトークン/秒
+#   - 出力の差（基準の精度、既定は fp32 との比較）:
+#       完全一致したプロンプトの割合、先頭から一致したトークン数の平均、
+#       基準の出力を入力したときに次のトークンの予測（argmax）が一致した割合、
+#       基準の出力のトークンの対数確率の差の平均
+#
+# 既定では小さなランダムな重みのモデル（ネットワーク接続不要、ツールの動作確認用）で測る。
+# 実際のモデルで比べる場合は --model を指定する:
+#   python benchmarks/precision_report.py --model Qwen/Qwen3-1.7B --output precision.json
+# =============================================================================
+import argparse  # コマンドライン引数の解析用
+import asyncio  # スケジューラの実行用
+import json  # 結果の保存・ワーカーとの受け渡し用
+import os  # ファイルパスの操作用
+import subprocess  # 精度ごとのワーカーの起動用
+import sys  # Python 実行ファイルのパス用
+import tempfile  # 基準の出力の受け渡し用
+import time  # 読み込み時間の計測用
+from typing import Dict, List, Optional
+
+import torch  # PyTorch（スレッド数・対数確率の計算）
+
+from common import USER_MESSAGES, build_model, build_tokenizer, synthetic_personas  # 小さなモデルと合成ペルソナ
+from load_test import process_memory  # RSS の計測
+from history import generation_prompt  # 返答開始タグ
+from persona_prompts import build_persona_prompt, build_system_block  # システムプロンプト
+from precision import PRECISIONS, apply_precision, load_options, model_bytes  # 精度の切り替え（サーバーと同じ処理）
+from scheduler import GenerationParams, GenerationScheduler  # サーバーと同じ生成ループ
+
+def build_prompts(tokenizer, personas: dict, count: int) -> List[List[int]]:
+    """ペルソナのシステムプロンプトとユーザーの発言からなる固定のプロンプトを作る"""
+    prompts = []
+    for i in range(count):
+        row = {column: values[i] for column, values in personas.items()}
+        message = USER_MESSAGES[i % len(USER_MESSAGES)]
+        text = (
+            build_system_block(build_persona_prompt(row))
+            + f"<|im_start|>user\n{message}<|im_end|>\n"
+            + generation_prompt(enable_thinking=False)
+        )
+        prompts.append(tokenizer.encode(text))
+    return prompts
+
+def load_model(args, precision: str):
+    """指定の精度でトークナイザーとモデルを用意する（サーバーと同じ読み込み方）"""
+    personas = synthetic_personas(args.prompts, args.seed)
+    if args.model:
+        from transformers import AutoModelForCausalLM, AutoTokenizer  # 実際のモデルの読み込み
+
+        tokenizer = AutoTokenizer.from_pretrained(args.model, trust_remote_code=True)
+        model = AutoModelForCausalLM.from_pretrained(
+            args.model, **load_options(precision), low_cpu_mem_usage=True, use_safetensors=True, trust_remote_code=True
+        )
+    else:
+        tokenizer = build_tokenizer(personas)
+        model = build_model(tokenizer, layers=args.layers, hidden_size=args.hidden_size, seed=args.seed)
+    model = apply_precision(model, precision)
+    model.eval()
+    return tokenizer, model, personas
+
+async def generate_all(scheduler: GenerationScheduler, prompts: List[List[int]], max_new_tokens: int) -> List[dict]:
+    """プロンプトを1件ずつグリーディで生成する（繰り返しの制御なし、精度による差だけを見る）"""
+    params = GenerationParams(max_new_tokens=max_new_tokens, temperature=0.0, repetition_penalty=1.0, no_repeat_ngram_size=0)
+    scheduler.start()
+    try:
+        # 初回だけのコスト（メモリ確保など）を計測に含めない
+        await scheduler.generate(prompts[0], GenerationParams(max_new_tokens=4, temperature=0.0))
+        results = []
+        for prompt in prompts:
+            result = await scheduler.generate(prompt, params)
+            results.append({"token_ids": result.token_ids, "timings": result.timings})
+        return results
+    finally:
+        await scheduler.stop()
+
+@torch.no_grad()
+def score_reference(model, prompts: List[List[int]], references: List[List[int]]) -> Dict[str, list]:
+    """
+    基準の出力をそのまま入力し、各位置で次のトークンの予測が一致するかと、基準のトークンの対数確率を求める
+
+    Returns:
+        Dict[str, list]: {"agreement": [プロンプトごとの一致数], "logprobs": [プロンプトごとの対数確率の列]}
+    """
+    agreement, logprobs = [], []
+    for prompt, reference in zip(prompts, references):
+        if not reference:
+            agreement.append(0)
+            logprobs.append([])
+            continue
+        input_ids = torch.tensor([prompt + reference[:-1]], device=model.device)
+        logits = model(input_ids=input_ids).logits[0, len(prompt) - 1:].float()
+        target = torch.tensor(reference, device=logits.device)
+        agreement.append(int((logits.argmax(dim=-1) == target).sum()))
+        logprobs.append(logits.log_softmax(dim=-1).gather(1, target.unsqueeze(1)).squeeze(1).tolist())
+    return {"agreement": agreement, "logprobs": logprobs}
+
+def run_worker(args) -> dict:
+    """1つの精度で読み込み・生成・採点を行い、結果を返す（別プロセスで実行される）"""
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    started = time.perf_counter()
+    tokenizer, model, personas = load_model(args, args.worker)
+    load_seconds = time.perf_counter() - started
+    prompts = build_prompts(tokenizer, personas, args.prompts)
+
+    scheduler = GenerationScheduler(model, tokenizer, max_batch_size=1, num_threads=args.threads)
+    results = asyncio.run(generate_all(scheduler, prompts, args.max_new_tokens))
+    outputs = [r["token_ids"] for r in results]
+
+    references = outputs
+    if args.reference_file:
+        with open(args.reference_file, encoding="utf-8") as f:
+            references = json.load(f)["outputs"]
+    scores = score_reference(model, prompts, references)
+
+    decode_tokens = sum(max(len(r["token_ids"]) - 1, 0) for r in results)
+    decode_seconds = sum(r["timings"]["decode"] for r in results)
+    return {
+        "precision": args.worker,
+        "load_seconds": round(load_seconds, 2),
+        "model_mb": round(model_bytes(model) / 1024 / 1024, 1),
+        "memory": process_memory(os.getpid()),
+        "ttft_ms": round(sum(r["timings"]["ttft"] for r in results) / len(results) * 1000, 1),
+        "decode_tokens_per_second": round(decode_tokens / decode_seconds, 1) if decode_seconds else None,
+        "outputs": outputs,
+        "reference_scores": scores,
+        "texts": [tokenizer.decode(ids, skip_special_tokens=True) for ids in outputs[:3]],
+    }
+
+def run_mode(args, precision: str, reference_file: Optional[str]) -> dict:
+    """精度ごとにワーカーを別プロセスで実行する"""
+    command = [
+        sys.executable, os.path.abspath(__file__),
+        "--worker", precision,
+        "--prompts", str(args.prompts),
+        "--max-new-tokens", str(args.max_new_tokens),
+        "--layers", str(args.layers),
+        "--hidden-size", str(args.hidden_size),
+        "--seed", str(args.seed),
+        "--threads", str(args.threads),
+    ]
+    if args.model:
+        command += ["--model", args.model]
+    if reference_file:
+        command += ["--reference-file", reference_file]
+    completed = subprocess.run(command, stdout=subprocess.PIPE, check=True)
+    return json.loads(completed.stdout.decode("utf-8").strip().splitlines()[-1])
+
+def compare(result: dict, reference: dict) -> Dict[str, float]:
+    """基準の精度との出力の差をまとめる"""
+    outputs, expected = result["outputs"], reference["outputs"]
+    exact = sum(1 for a, b in zip(outputs, expected) if a == b)
+    prefixes = []
+    for a, b in zip(outputs, expected):
+        n = 0
+        while n < min(len(a), len(b)) and a[n] == b[n]:
+            n += 1
+        prefixes.append(n)
+    positions = sum(len(ids) for ids in expected)
+    deltas = [
+        abs(x - y)
+        for own, ref in zip(result["reference_scores"]["logprobs"], reference["reference_scores"]["logprobs"])
+        for x, y in zip(own, ref)
+    ]
+    return {
+        "exact_match": round(exact / len(expected), 3),
+        "mean_prefix_match": round(sum(prefixes) / len(prefixes), 1),
+        "next_token_agreement": round(sum(result["reference_scores"]["agreement"]) / positions, 4) if positions else None,
+        "mean_abs_logprob_delta": round(sum(deltas) / len(deltas), 4) if deltas else None,
+    }
+
+def print_report(results: List[dict], reference: str):
+    """精度ごとの結果を表にして表示する"""
+    print(f"\n{'precision':<9} {'model MB':>9} {'peak RSS':>9} {'ttft ms':>8} {'decode t/s':>11} {'exact':>6} {'prefix':>7} {'agree':>7} {'|dlogp|':>8}")
+    for result in results:
+        memory = result["memory"] or {}
+        diff = result["divergence"]
+        print(
+            f"{result['precision']:<9} {result['model_mb']:>9} {memory.get('peak_rss_mb', '-'):>9} {result['ttft_ms']:>8} "
+            f"{result['decode_tokens_per_second']:>11} {diff['exact_match']:>6} {diff['mean_prefix_match']:>7} "
+            f"{diff['next_token_agreement']:>7} {diff['mean_abs_logprob_delta']:>8}"
+        )
+    print(f"\n出力の差は {reference} との比較（exact: 完全一致の割合、prefix: 先頭から一致したトークン数の平均、"
+          f"agree: 次トークンの予測の一致率、|dlogp|: 対数確率の差の平均）")
+
+def main():
+    parser = argparse.ArgumentParser(description="推論精度ごとのメモリ・速度・出力の差を比べる")
+    parser.add_argument("--modes", nargs="+", default=list(PRECISIONS), choices=PRECISIONS, help="比べる精度")
+    parser.add_argument("--reference", default="fp32", choices=PRECISIONS, help="出力の差の基準にする精度")
+    parser.add_argument("--model", default=None, help="Hugging Face のモデルID（省略時は小さなランダムなモデル）")
+    parser.add_argument("--prompts", type=int, default=8, help="プロンプト数")
+    parser.add_argument("--max-new-tokens", type=int, default=32, help="1プロンプトで生成するトークン数")
+    parser.add_argument("--layers", type=int, default=4, help="小さなモデルの層の数")
+    parser.add_argument("--hidden-size", type=int, default=256, help="小さなモデルの隠れ層の次元（16の倍数）")
+    parser.add_argument("--threads", type=int, default=0, help="torch のスレッド数（0で既定値）")
+    parser.add_argument("--seed", type=int, default=0, help="合成ペルソナと小さなモデルの乱数のシード")
+    parser.add_argument("--output", default=None, help="結果の JSON の保存先")
+    parser.add_argument("--worker", default=None, help=argparse.SUPPRESS)  # 内部用: 1つの精度を実行する
+    parser.add_argument("--reference-file", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_worker(args), ensure_ascii=False))
+        return
+
+    # 基準の精度を先に実行し、その出力を他の精度の採点に使う
+    modes = [args.reference] + [m for m in args.modes if m != args.reference]
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        reference_file = os.path.join(work_dir, "reference.json")
+        for mode in modes:
+            print(f"{mode}: running", file=sys.stderr)
+            result = run_mode(args, mode, reference_file if results else None)
+            if not results:
+                with open(reference_file, "w", encoding="utf-8") as f:
+                    json.dump({"outputs": result["outputs"]}, f)
+            results.append(result)
+    for result in results:
+        result["divergence"] = compare(result, results[0])
+
+    print_report(results, args.reference)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"config": {k: v for k, v in vars(args).items() if k not in ("worker", "reference_file", "output")},
+                       "results": results}, f, ensure_ascii=False, indent=2)
+        print(f"\nResults written to {args.output}")
+
+if __name__ == "__main__":
+    main()
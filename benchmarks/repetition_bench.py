@@ -0,0 +1,137 @@
+# =============================================================================
+# 繰り返しの制御（repetition_penalty・no_repeat_ngram_size）のマイクロベンチマーク
+# =============================================================================
+# デコード1ステップあたりのロジット加工の時間を、次の2つで比べる:
+#   - legacy: 以前のスケジューラの実装（毎ステップ全トークンIDをテンソルにして
+#             ペナルティを掛け、n-gram の禁止トークンを系列全体から Python で探す）
+#   - vectorized: logits_processors.RepetitionProcessor（差分だけを更新し、
+#             バッチ全体にまとめて適用する）
+# モデルは使わず、語彙サイズのランダムなロジットと、繰り返しが起きやすいように
+# 少ない種類から選んだトークン列で測る。両者の結果が一致することも確かめる。
+#   python benchmarks/repetition_bench.py --batch-sizes 1 8 --prompt-lengths 128 1024
+# =============================================================================
+import argparse  # コマンドライン引数の解析用
+import json  # 結果の保存用
+import os  # import パスの設定用
+import sys  # import パスの設定用
+import time  # 所要時間の計測用
+from typing import Dict, List
+
+import torch  # PyTorch（ロジットの加工）
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from logits_processors import RepetitionProcessor, SequenceRepetition  # 計測対象
+
+def legacy_banned_ngram_tokens(ids: List[int], n: int) -> List[int]:
+    """以前の実装: 直近の (n-1) トークンに続けると既出のn-gramになるトークンを列挙する"""
+    if n <= 0 or len(ids) < n:
+        return []
+    prefix = tuple(ids[len(ids) - n + 1:])
+    banned = []
+    for start in range(len(ids) - n + 1):
+        if tuple(ids[start:start + n - 1]) == prefix:
+            banned.append(ids[start + n - 1])
+    return banned
+
+def legacy_apply(scores: torch.Tensor, all_ids: List[List[int]], penalty: float, ngram: int) -> torch.Tensor:
+    """以前の実装: シーケンスごとにペナルティと n-gram の禁止を適用する"""
+    for i, ids in enumerate(all_ids):
+        if penalty != 1.0:
+            seen = torch.tensor(ids, device=scores.device)
+            picked = scores[i].gather(0, seen)
+            picked = torch.where(picked < 0, picked * penalty, picked / penalty)
+            scores[i].scatter_(0, seen, picked)
+        banned = legacy_banned_ngram_tokens(ids, ngram)
+        if banned:
+            scores[i, banned] = -float("inf")
+    return scores
+
+def run_case(batch_size: int, prompt_length: int, steps: int, vocab: int, penalty: float, ngram: int, distinct: int, seed: int) -> Dict[str, float]:
+    """
+    1つの条件（バッチサイズ・プロンプト長）で両方の実装を計測する
+
+    Returns:
+        Dict[str, float]: 1ステップあたりの時間（マイクロ秒）と一致したか
+    """
+    generator = torch.Generator().manual_seed(seed)
+    prompts = torch.randint(0, distinct, (batch_size, prompt_length), generator=generator).tolist()
+    tokens = torch.randint(0, distinct, (steps, batch_size), generator=generator).tolist()
+    logits = [torch.randn(batch_size, vocab, generator=generator) for _ in range(4)]
+
+    # legacy
+    all_ids = [list(p) for p in prompts]
+    legacy_seconds = 0.0
+    legacy_out = []
+    for step in range(steps):
+        scores = logits[step % len(logits)].clone()
+        started = time.perf_counter()
+        scores = legacy_apply(scores, all_ids, penalty, ngram)
+        legacy_seconds += time.perf_counter() - started
+        legacy_out.append(scores.argmax(dim=-1))
+        for ids, token in zip(all_ids, tokens[step]):
+            ids.append(token)
+
+    # vectorized（状態の作成は prefill 時の1回だけなので計測に含めない）
+    processor = RepetitionProcessor()
+    for p in prompts:
+        processor.join(SequenceRepetition(p, penalty, ngram))
+    vectorized_seconds = 0.0
+    vectorized_out = []
+    for step in range(steps):
+        scores = logits[step % len(logits)].clone()
+        started = time.perf_counter()
+        scores = processor(scores)
+        # トークンを選んだ後の状態の更新も1ステップのコストに含める
+        for state, token in zip(processor.states, tokens[step]):
+            state.append(token)
+        vectorized_seconds += time.perf_counter() - started
+        vectorized_out.append(scores.argmax(dim=-1))
+
+    matches = all(torch.equal(a, b) for a, b in zip(legacy_out, vectorized_out))
+    return {
+        "batch_size": batch_size,
+        "prompt_length": prompt_length,
+        "legacy_us": round(legacy_seconds / steps * 1e6, 1),
+        "vectorized_us": round(vectorized_seconds / steps * 1e6, 1),
+        "speedup": round(legacy_seconds / vectorized_seconds, 2) if vectorized_seconds else None,
+        "matches": matches,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="繰り返しの制御のデコード1ステップあたりのコストを比べる")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 8], help="バッチサイズ")
+    parser.add_argument("--prompt-lengths", type=int, nargs="+", default=[128, 512, 2048], help="生成開始時のトークン数")
+    parser.add_argument("--steps", type=int, default=64, help="計測するデコードステップ数")
+    parser.add_argument("--vocab", type=int, default=151936, help="語彙サイズ（既定は Qwen3 系）")
+    parser.add_argument("--repetition-penalty", type=float, default=1.1, help="repetition_penalty")
+    parser.add_argument("--no-repeat-ngram-size", type=int, default=2, help="no_repeat_ngram_size")
+    parser.add_argument("--distinct-tokens", type=int, default=2000, help="トークン列に使う語彙の種類（少ないほど繰り返しが多い）")
+    parser.add_argument("--threads", type=int, default=None, help="torch のスレッド数")
+    parser.add_argument("--seed", type=int, default=0, help="乱数シード")
+    parser.add_argument("--output", default=None, help="結果の JSON の保存先")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    results = []
+    print(f"{'batch':>5} {'prompt':>7} {'legacy us':>10} {'vector us':>10} {'speedup':>8} {'match':>6}")
+    for batch_size in args.batch_sizes:
+        for prompt_length in args.prompt_lengths:
+            result = run_case(
+                batch_size, prompt_length, args.steps, args.vocab,
+                args.repetition_penalty, args.no_repeat_ngram_size, args.distinct_tokens, args.seed,
+            )
+            results.append(result)
+            print(
+                f"{batch_size:>5} {prompt_length:>7} {result['legacy_us']:>10} {result['vectorized_us']:>10} "
+                f"{result['speedup']:>7}x {str(result['matches']):>6}"
+            )
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": results}, f, ensure_ascii=False, indent=2)
+        print(f"\nResults written to {args.output}")
+
+if __name__ == "__main__":
+    main()
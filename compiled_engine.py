@@ -0,0 +1,268 @@
+# =============================================================================
+# 静的な KV キャッシュと torch.compile による生成（プロンプト長のバケット化）
+# =============================================================================
+# 通常のスケジューラは KV キャッシュ（DynamicCache）を1トークンごとに連結して伸ばすため、
+# デコードの1ステップごとに形の違うテンソルの確保と Python のオーバーヘッドがかかり、
+# 呼び出しの間で再利用できるものがない。CompiledScheduler は:
+#   - 最大長（max_cache_len）の KV キャッシュ（StaticCache）を1度だけ確保し、
+#     シーケンスごとに書き込み位置を先頭に戻して使い回す
+#   - モデルのフォワードを torch.compile し、形が固定の計算グラフを再利用する
+#       デコード: 入力 [1, 1] の1グラフ
+#       prefill: プロンプト（プレフィックスキャッシュ・セッションの KV の続き）を
+#                バケット（既定は 64・128・256・512）の長さまで右にパディングして入力する。
+#                最大のバケットより長い部分は、最大のバケットごとに分けて入力する
+#   - 起動時にすべてのバケットとデコードのグラフをコンパイルしておく（precompile）
+# パディングで書き込まれた KV は因果マスクで参照されず、続くデコードで上書きされる。
+#
+# 静的なキャッシュは1シーケンス分なので、同時に生成するのは1シーケンスだけ（バッチサイズ1）。
+# 同時リクエストが少なく、1リクエストのレイテンシを下げたい CPU 環境向けの選択肢。
+# max_cache_len に収まらないリクエストは通常の（コンパイルしない）経路で生成する。
+# サンプリング・繰り返しの制御・思考の打ち切りは GenerationScheduler と共通。
+#
+# 通常の経路（model.generate・スケジューラ）との比較は benchmarks/compile_bench.py で行う。
+# =============================================================================
+import logging  # ログ出力用
+import time  # コンパイル時間の計測用
+from typing import Dict, Optional, Sequence
+
+import torch  # PyTorch（torch.compile）
+from transformers import StaticCache  # 事前に確保する KV キャッシュ
+
+from scheduler import GenerationScheduler, KVTensors, _Sequence  # 生成ループ（サンプリングなどは共通）
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (64, 128, 256, 512)
+
+class CompiledScheduler(GenerationScheduler):
+    """
+    静的な KV キャッシュとコンパイル済みのフォワードで1シーケンスずつ生成するスケジューラ
+
+    公開API（generate・stream・stats など）は GenerationScheduler と同じ。
+    起動後、リクエストを受け付ける前に precompile() を呼ぶ。
+    """
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        buckets: Sequence[int] = DEFAULT_BUCKETS,
+        max_cache_len: int = 2048,
+        compile: bool = True,
+        num_threads: int = 0,
+        prefix_cache=None,
+        metrics=None,
+    ):
+        """
+        Args:
+            model: Hugging Face の CausalLM
+            tokenizer: 対応するトークナイザー
+            buckets (Sequence[int]): prefill の入力長のバケット
+            max_cache_len (int): 静的な KV キャッシュのトークン数（プロンプト＋生成がこれを超えるリクエストは通常の経路）
+            compile (bool): False ならコンパイルせずに静的なキャッシュだけを使う
+            num_threads (int): PyTorch のスレッド数（0ならPyTorchの既定値。プロセス全体の設定）
+            prefix_cache (PrefixCache): システムプロンプトのKVキャッシュ（None で無効）
+            metrics (ServingMetrics): 生成ごとのトークン数・TTFTなどの記録先（None で記録しない）
+        """
+        super().__init__(model, tokenizer, max_batch_size=1, num_threads=num_threads, prefix_cache=prefix_cache, metrics=metrics)
+        self.buckets = tuple(sorted(set(buckets)))
+        if not self.buckets or self.buckets[0] <= 0 or self.buckets[-1] > max_cache_len:
+            raise ValueError(f"Buckets {list(buckets)} must be positive and fit in max_cache_len={max_cache_len}")
+        self.max_cache_len = max_cache_len
+        self.compiled = compile
+        self.cache: Optional[StaticCache] = None  # 推論スレッドで最初に使うときに確保する
+        self._forward = torch.compile(model.forward, dynamic=False) if compile else model.forward
+        # バケットごとに先頭から・続きからの2グラフ＋デコードの1グラフを再コンパイルの上限に収める
+        torch._dynamo.config.recompile_limit = max(torch._dynamo.config.recompile_limit, 2 * len(self.buckets) + 2)
+
+        self._static = False  # 生成中のシーケンスが静的なキャッシュを使っているか
+        self._length = 0  # 静的なキャッシュに書き込んだ（有効な）トークン数
+
+        # 統計情報
+        self._compile_seconds: Dict[str, float] = {}
+        self._compile_error: Optional[str] = None
+        self._static_sequences = 0
+        self._fallback_sequences = 0  # max_cache_len に収まらず通常の経路で生成した数
+        self._padded_tokens = 0  # バケットに合わせるために足したパディングのトークン数
+
+    # -------------------------------------------------------------------------
+    # 公開API
+    # -------------------------------------------------------------------------
+
+    async def precompile(self) -> Dict[str, float]:
+        """
+        すべてのバケットの prefill とデコードのグラフをコンパイルする（推論スレッドで実行）
+
+        コンパイルに失敗した場合は警告を出し、コンパイルせずに静的なキャッシュだけを使う。
+
+        Returns:
+            Dict[str, float]: バケット（と "decode"）ごとのコンパイルにかかった秒数
+        """
+        return await self.run_in_inference_thread(self._precompile)
+
+    def stats(self) -> Dict[str, float]:
+        """スケジューラの稼働状況に、コンパイルと静的なキャッシュの状況を加えて返す"""
+        stats = super().stats()
+        stats.update({
+            "compiled": self.compiled,
+            "compile_error": self._compile_error,
+            "buckets": list(self.buckets),
+            "max_cache_len": self.max_cache_len,
+            "compile_seconds": self._compile_seconds,
+            "static_sequences": self._static_sequences,
+            "fallback_sequences": self._fallback_sequences,
+            "padded_tokens": self._padded_tokens,
+        })
+        return stats
+
+    # -------------------------------------------------------------------------
+    # コンパイル
+    # -------------------------------------------------------------------------
+
+    def _precompile(self) -> Dict[str, float]:
+        """
+        各バケットの長さで prefill を先頭からと続きから（マスクの形が変わる）1回ずつ、
+        続けてデコードを1回実行してグラフを作る
+        """
+        token = self.pad_token_id or 0
+        try:
+            with torch.inference_mode():
+                self._ensure_cache()
+                for bucket in self.buckets:
+                    started = time.perf_counter()
+                    # 続きから: セッション・プレフィックスキャッシュ・長いプロンプトの2つ目以降のチャンク
+                    for position in {0, min(1, self.max_cache_len - bucket)}:
+                        self._length = position
+                        self._run_chunk([token] * bucket)
+                    self._compile_seconds[str(bucket)] = round(time.perf_counter() - started, 3)
+                started = time.perf_counter()
+                self._run_decode(token)
+                self._compile_seconds["decode"] = round(time.perf_counter() - started, 3)
+        except Exception as e:
+            if not self.compiled:
+                raise
+            logger.warning(f"torch.compile failed, using the static cache without compilation: {e}")
+            self._compile_error = str(e)
+            self.compiled = False
+            self._forward = self.model.forward
+            self._compile_seconds = {}
+        self._length = 0
+        self._padded_tokens = 0
+        logger.info(f"Precompiled buckets {list(self.buckets)} in {sum(self._compile_seconds.values()):.1f}s")
+        return self._compile_seconds
+
+    # -------------------------------------------------------------------------
+    # 静的なキャッシュでの prefill・デコード
+    # -------------------------------------------------------------------------
+
+    def _ensure_cache(self):
+        """静的なキャッシュを確保する（推論スレッドの inference_mode の中で呼ぶ）"""
+        if self.cache is not None:
+            return
+        config = self.model.config
+        self.cache = StaticCache(config=config, max_cache_len=self.max_cache_len)
+        self.cache.early_initialization(
+            batch_size=1,
+            num_heads=config.num_key_value_heads,
+            head_dim=getattr(config, "head_dim", None) or config.hidden_size // config.num_attention_heads,
+            dtype=self.model.dtype,
+            device=self.model.device,
+        )
+
+    def _set_length(self, length: int):
+        """静的なキャッシュの書き込み位置を設定する"""
+        for layer in self.cache.layers:
+            layer.cumulative_length.fill_(length)
+
+    def _run_chunk(self, ids: Sequence[int]) -> torch.Tensor:
+        """
+        ids をバケットの長さまでパディングして静的なキャッシュの続きに入力し、最後の実トークンのロジットを返す
+        """
+        bucket = next(b for b in self.buckets if b >= len(ids))
+        device = self.model.device
+        position = self._length
+        input_ids = torch.tensor([list(ids) + [self.pad_token_id or 0] * (bucket - len(ids))], device=device)
+        self._set_length(position)
+        outputs = self._forward(
+            input_ids=input_ids,
+            position_ids=torch.arange(position, position + bucket, device=device).unsqueeze(0),
+            past_key_values=self.cache,
+            use_cache=True,
+            logits_to_keep=torch.tensor([len(ids) - 1], device=device),
+        )
+        # パディングの位置は次に書き込むときに上書きする
+        self._length = position + len(ids)
+        self._set_length(self._length)
+        self._padded_tokens += bucket - len(ids)
+        return outputs.logits[:, -1, :]
+
+    def _run_decode(self, token: int) -> torch.Tensor:
+        """1トークンを静的なキャッシュの続きに入力し、次のトークンのロジットを返す"""
+        device = self.model.device
+        outputs = self._forward(
+            input_ids=torch.tensor([[token]], device=device),
+            position_ids=torch.tensor([[self._length]], device=device),
+            past_key_values=self.cache,
+            use_cache=True,
+        )
+        self._length += 1
+        return outputs.logits[:, -1, :]
+
+    def _static_kv(self) -> KVTensors:
+        """静的なキャッシュの有効な部分を複製して返す（return_cache 用）"""
+        return tuple(
+            (layer.keys[:, :, :self._length].clone(), layer.values[:, :, :self._length].clone())
+            for layer in self.cache.layers
+        )
+
+    def _fits(self, seq: _Sequence) -> bool:
+        """静的なキャッシュに収まるか（プロンプト＋生成、および最後のバケットのパディング分）"""
+        return len(seq.prompt_ids) + max(seq.params.max_new_tokens, self.buckets[-1]) <= self.max_cache_len
+
+    def _prefill(self, seq: _Sequence):
+        """プロンプトをバケットごとに静的なキャッシュへ入力し、最初のトークンを選ぶ"""
+        self._ensure_cache()
+        if not self._fits(seq):
+            self._static = False
+            self._fallback_sequences += 1
+            super()._prefill(seq)
+            return
+        seq.prefill_started_at = time.perf_counter()
+        past, start = self._prompt_past(seq)
+        if past is not None:
+            for layer, (k, v) in zip(self.cache.layers, past):
+                layer.keys[:, :, :start].copy_(k)
+                layer.values[:, :, :start].copy_(v)
+        self._length = start
+
+        ids = seq.prompt_ids[start:]
+        for offset in range(0, len(ids), self.buckets[-1]):
+            logits = self._run_chunk(ids[offset:offset + self.buckets[-1]])
+        self._prefill_tokens += len(ids)
+        self._static = True
+        self._static_sequences += 1
+        if self._first_token(seq, logits):
+            if seq.return_cache:
+                seq.cache = self._static_kv()
+            self._finish(seq)
+            return
+        self._repetition.join(seq.repetition)
+        self._rows.append(seq)
+
+    def _decode(self):
+        """生成中のシーケンスを1トークン進める（静的なキャッシュを使っていなければ通常のデコード）"""
+        if not self._static:
+            super()._decode()
+            return
+        seq = self._rows[0]
+        logits = self._run_decode(seq.next_token)
+        self._steps += 1
+        token = self._sample(logits, self._rows, self._repetition)[0]
+        cancelled = seq.future.cancelled()
+        if cancelled:
+            self._cancelled += 1
+        if cancelled or self._append_token(seq, token):
+            if seq.return_cache:
+                seq.cache = self._static_kv()
+            self._finish(seq)
+            self._retain([])
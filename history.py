@@ -0,0 +1,136 @@
+# =============================================================================
+# トークン数の上限に合わせた会話履歴の圧縮
+# =============================================================================
+# 会話全体の文字列を作ってから末尾を切り詰めると、長い会話では最新のユーザー発言や
+# 返答開始タグ（<|im_start|>assistant）が切れてしまう。
+# ここでは
+#   - ペルソナのシステムプロンプトは常に残す
+#   - 新しい発言から順に、上限に収まるだけ残す（古い発言から捨てる）
+#   - 最後は必ず返答開始タグで終わる
+# という形でプロンプトを組み立てる。
+# 思考モードを無効にする場合は、Qwen3 のチャットテンプレート（enable_thinking=False）と
+# 同じく返答開始タグの後に空の思考ブロックを付け、モデルが思考を書かずに返答を始めるようにする。
+#
+# 発言ごとのトークンIDはキャッシュしておき、同じ履歴が毎ターン送られてきても
+# 新しく追加された発言だけをトークン化する。
+# =============================================================================
+import threading  # 複数スレッドからのキャッシュ更新の排他制御用
+from collections import OrderedDict  # LRU管理用
+from typing import Dict, List, Optional, Sequence, Tuple
+
+ASSISTANT_TAG = "<|im_start|>assistant\n"  # 返答開始タグ
+EMPTY_THINK = "<think>\n\n</think>\n\n"  # 思考を省略させる空の思考ブロック
+
+def generation_prompt(enable_thinking: bool = True) -> str:
+    """返答を始めさせるプロンプトの末尾（思考モードを無効にする場合は空の思考ブロック付き）"""
+    return ASSISTANT_TAG if enable_thinking else ASSISTANT_TAG + EMPTY_THINK
+
+class HistoryCompactor:
+    """
+    システムプロンプト＋会話履歴を、トークン数の上限に収まるように組み立てる
+    """
+
+    def __init__(self, tokenizer, token_budget: int, cache_size: int = 4096):
+        """
+        Args:
+            tokenizer: Hugging Face のトークナイザー
+            token_budget (int): プロンプト全体（システムプロンプト込み）の最大トークン数
+            cache_size (int): トークン化済みの発言を何件までキャッシュするか
+        """
+        self.tokenizer = tokenizer
+        self.token_budget = token_budget
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[Tuple[str, str], List[int]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        # AIの返答を促すための開始タグ（毎回同じなので1度だけトークン化）
+        self._assistant_tag = {
+            enable_thinking: tokenizer.encode(generation_prompt(enable_thinking)) for enable_thinking in (True, False)
+        }
+
+        # 統計情報
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.dropped_turns = 0  # 上限に収まらず捨てた発言の合計
+        self.truncated_turns = 0  # 1発言だけで上限を超え、内容を切り詰めた回数
+
+    def compact(self, system_ids: Sequence[int], turns: Sequence[Tuple[str, str]], enable_thinking: bool = True) -> Tuple[List[int], int]:
+        """
+        上限に収まるプロンプトのトークンIDを組み立てる
+
+        Args:
+            system_ids (Sequence[int]): システムプロンプト部分のトークンID
+            turns (Sequence[Tuple[str, str]]): (role, content) の会話履歴（古い順）
+            enable_thinking (bool): False なら空の思考ブロックを付けて思考を省略させる
+
+        Returns:
+            Tuple[List[int], int]: プロンプトのトークンIDと、捨てた発言の数
+        """
+        assistant_tag = self._assistant_tag[enable_thinking]
+        room = self.token_budget - len(system_ids) - len(assistant_tag)
+        kept: List[List[int]] = []
+
+        # 新しい発言から順に、収まるだけ残す
+        for role, content in reversed(turns):
+            ids = self._turn_ids(role, content)
+            if len(ids) > room:
+                # 最新の発言だけで上限を超える場合は、発言の末尾側を残して切り詰める
+                # （ヘッダーとフッターだけで残りを使い切る場合は、その発言も捨てる）
+                truncated = self._truncate_turn(role, content, room) if not kept else None
+                if truncated is not None:
+                    kept.append(truncated)
+                    self.truncated_turns += 1
+                break
+            kept.append(ids)
+            room -= len(ids)
+
+        dropped = len(turns) - len(kept)
+        self.dropped_turns += dropped
+
+        input_ids = list(system_ids)
+        for ids in reversed(kept):
+            input_ids.extend(ids)
+        input_ids.extend(assistant_tag)
+        return input_ids, dropped
+
+    def stats(self) -> Dict[str, float]:
+        """キャッシュのヒット率と、捨てた発言数を返す"""
+        lookups = self.cache_hits + self.cache_misses
+        return {
+            "token_budget": self.token_budget,
+            "cached_turns": len(self._cache),
+            "cache_hit_rate": round(self.cache_hits / lookups, 4) if lookups else 0.0,
+            "dropped_turns": self.dropped_turns,
+            "truncated_turns": self.truncated_turns,
+        }
+
+    def _turn_ids(self, role: str, content: str) -> List[int]:
+        """1発言分（<|im_start|>role ... <|im_end|>）のトークンIDを返す（キャッシュ付き）"""
+        # user 以外の発言は assistant として扱う
+        role = "user" if role == "user" else "assistant"
+        key = (role, content)
+        with self._lock:
+            ids = self._cache.get(key)
+            if ids is not None:
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+                return ids
+            self.cache_misses += 1
+
+        ids = self.tokenizer.encode(f"<|im_start|>{role}\n{content}<|im_end|>\n")
+        with self._lock:
+            self._cache[key] = ids
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return ids
+
+    def _truncate_turn(self, role: str, content: str, room: int) -> Optional[List[int]]:
+        """発言の内容を末尾側から room トークンに収まるだけ残す（内容が1トークンも入らなければ None）"""
+        role = "user" if role == "user" else "assistant"
+        header = self.tokenizer.encode(f"<|im_start|>{role}\n")
+        footer = self.tokenizer.encode("<|im_end|>\n")
+        keep = room - len(header) - len(footer)
+        if keep <= 0:
+            return None
+        content_ids = self.tokenizer.encode(content)
+        return header + content_ids[max(len(content_ids) - keep, 0):] + footer
@@ -0,0 +1,228 @@
+# =============================================================================
+# 繰り返しの制御（repetition_penalty と no_repeat_ngram_size）
+# =============================================================================
+# 以前のデコードループは1ステップごとに、シーケンスごとに
+#   - 全トークンID（プロンプトを含む）をテンソルに変換してペナルティを掛け、
+#   - 系列全体を Python で走査して n-gram の禁止トークンを探していた。
+# どちらも系列が長くなるほど1トークンあたりのコストが増える。
+#
+# ここでは状態をシーケンスごとに持ち、トークンが1つ増えるたびに差分だけを更新する:
+#   - 既出のトークン: 重複を除いた (行, トークン) の組の添字テンソル（新出のトークンだけ追加）
+#   - n-gram: 先頭 n-1 トークン → 続くトークンの集合 の辞書（追加は O(1)）
+# 適用はバッチ全体に対して、ペナルティの gather/scatter 1回と、禁止トークンの
+# まとめての代入1回で行う（語彙全体 [batch, vocab] の演算はしない）。
+#
+# temperature・top_k・top_p による分布の加工（warp_scores）も、通常のサンプリングと
+# 推測デコードの検証で同じ分布を使うためにここに置く。
+# =============================================================================
+from collections import deque  # 直近 n-1 トークンの保持用
+from typing import Deque, Dict, List, Optional, Sequence, Set, Tuple
+
+import torch  # PyTorch（ロジットの加工）
+
+class SequenceRepetition:
+    """
+    1シーケンス分の繰り返し制御の状態（既出トークンと n-gram の表）
+    """
+
+    def __init__(self, ids: Sequence[int], repetition_penalty: float, ngram_size: int):
+        """
+        Args:
+            ids (Sequence[int]): これまでのトークンID（プロンプトを含む）
+            repetition_penalty (float): 既出トークンのロジットを割る（負なら掛ける）値（1.0で無効）
+            ngram_size (int): 繰り返しを禁止する n-gram のサイズ（0で無効）
+        """
+        self.repetition_penalty = repetition_penalty
+        self.ngram_size = ngram_size
+        self._seen: Set[int] = set()
+        self._fresh: List[int] = []  # バッチ側の添字にまだ加えていない既出トークン
+        self._ngrams: Dict[Tuple[int, ...], Set[int]] = {}
+        self._tail: Deque[int] = deque(maxlen=max(ngram_size - 1, 0))
+        self._count = 0
+        for token in ids:
+            self.append(token)
+
+    def append(self, token: int):
+        """トークンを1つ追加し、既出のトークンと、それで終わる n-gram を記録する"""
+        if self.repetition_penalty != 1.0 and token not in self._seen:
+            self._seen.add(token)
+            self._fresh.append(token)
+        if self.ngram_size <= 0:
+            return
+        self._count += 1
+        if self._count >= self.ngram_size:
+            self._ngrams.setdefault(tuple(self._tail), set()).add(token)
+        if self._tail.maxlen:
+            self._tail.append(token)
+
+    def take_fresh(self) -> List[int]:
+        """前回呼んでから新しく出てきたトークンを返す（返した分は消す）"""
+        fresh, self._fresh = self._fresh, []
+        return fresh
+
+    def banned(self) -> Set[int]:
+        """次に選ぶと既出の n-gram になるトークン"""
+        if self.ngram_size <= 0 or self._count < self.ngram_size - 1:
+            return set()
+        return self._ngrams.get(tuple(self._tail), set())
+
+    def lookahead(self, scores: torch.Tensor, extra: Sequence[int]) -> torch.Tensor:
+        """
+        extra のトークンを追加した後の状態で1行分のロジットに適用する（状態は変えない）
+
+        推測デコードの下書きモデルが、本体と同じ制御の下で続きを提案するのに使う。
+
+        Args:
+            scores (torch.Tensor): [1, vocab] のロジット（その場で書き換える）
+            extra (Sequence[int]): まだ追加していない（下書きの）トークン
+        """
+        if self.repetition_penalty != 1.0:
+            seen = torch.tensor(sorted(self._seen.union(extra)), dtype=torch.long, device=scores.device)
+            if seen.numel():
+                picked = scores[0, seen]
+                scores[0, seen] = torch.where(picked < 0, picked * self.repetition_penalty, picked / self.repetition_penalty)
+        if self.ngram_size <= 0:
+            return scores
+        n = self.ngram_size
+        tail = list(self._tail) + list(extra)
+        if self._count + len(extra) < n - 1:
+            return scores
+        key = tuple(tail[len(tail) - n + 1:]) if n > 1 else ()
+        banned = set(self._ngrams.get(key, ()))
+        # extra を含む n-gram（まだ表に入っていないもの）
+        for i in range(max(len(self._tail) - n + 1, 0), len(tail) - n + 1):
+            if tuple(tail[i:i + n - 1]) == key:
+                banned.add(tail[i + n - 1])
+        if banned:
+            scores[0, list(banned)] = -float("inf")
+        return scores
+
+    def apply(self, scores: torch.Tensor) -> torch.Tensor:
+        """
+        バッチに合流する前（prefill 直後）の1行分のロジットに適用する
+
+        Args:
+            scores (torch.Tensor): [1, vocab] のロジット（その場で書き換える）
+        """
+        processor = RepetitionProcessor()
+        processor.join(self)
+        scores = processor(scores)
+        # 既出トークンはバッチに合流するときにもう一度渡す
+        self._fresh = list(self._seen)
+        return scores
+
+class RepetitionProcessor:
+    """
+    バッチ全体の繰り返し制御（行の並びはスケジューラのバッチと同じ）
+
+    行の追加・削除はスケジューラのバッチ管理（合流・終了したシーケンスの除外）に合わせて呼ぶ。
+    新しく出てきたトークンは、適用するときに各行の状態からまとめて取り込む。
+    """
+
+    def __init__(self):
+        self.states: List[SequenceRepetition] = []
+        self._rows: Optional[torch.Tensor] = None  # 既出の (行, トークン) の行番号
+        self._cols: Optional[torch.Tensor] = None  # 既出の (行, トークン) のトークンID
+        self._penalty: Optional[torch.Tensor] = None  # 組ごとの repetition_penalty
+
+    def join(self, state: SequenceRepetition):
+        """バッチの末尾に行を追加する"""
+        self.states.append(state)
+
+    def retain(self, keep: List[int]):
+        """指定した行だけを残す（既出の組は行番号を詰め直す）"""
+        if not keep:
+            self.clear()
+            return
+        count = len(self.states)
+        self.states = [self.states[i] for i in keep]
+        if self._rows is None:
+            return
+        device = self._rows.device
+        mapping = torch.full((count,), -1, dtype=torch.long, device=device)
+        mapping[torch.tensor(keep, dtype=torch.long, device=device)] = torch.arange(len(keep), device=device)
+        rows = mapping[self._rows]
+        kept = rows >= 0
+        self._rows, self._cols, self._penalty = rows[kept], self._cols[kept], self._penalty[kept]
+
+    def clear(self):
+        """すべての行を削除する"""
+        self.states, self._rows, self._cols, self._penalty = [], None, None, None
+
+    def _collect(self, device):
+        """各行で新しく出てきたトークンを既出の組に加える"""
+        rows: List[int] = []
+        cols: List[int] = []
+        penalty: List[float] = []
+        for i, state in enumerate(self.states):
+            fresh = state.take_fresh()
+            if fresh:
+                rows.extend([i] * len(fresh))
+                cols.extend(fresh)
+                penalty.extend([state.repetition_penalty] * len(fresh))
+        if not cols:
+            return
+        rows_t = torch.tensor(rows, dtype=torch.long, device=device)
+        cols_t = torch.tensor(cols, dtype=torch.long, device=device)
+        penalty_t = torch.tensor(penalty, device=device)
+        if self._rows is None:
+            self._rows, self._cols, self._penalty = rows_t, cols_t, penalty_t
+        else:
+            self._rows = torch.cat([self._rows, rows_t])
+            self._cols = torch.cat([self._cols, cols_t])
+            self._penalty = torch.cat([self._penalty, penalty_t])
+
+    def __call__(self, scores: torch.Tensor) -> torch.Tensor:
+        """
+        バッチのロジットに繰り返しの制御を適用する
+
+        Args:
+            scores (torch.Tensor): [batch, vocab] のロジット（その場で書き換える）
+        """
+        self._collect(scores.device)
+        if self._rows is not None and self._rows.numel():
+            # transformers の RepetitionPenaltyLogitsProcessor と同じ（正なら割り、負なら掛ける）
+            picked = scores[self._rows, self._cols]
+            scores[self._rows, self._cols] = torch.where(picked < 0, picked * self._penalty, picked / self._penalty)
+
+        rows: List[int] = []
+        cols: List[int] = []
+        for i, state in enumerate(self.states):
+            banned = state.banned()
+            if banned:
+                rows.extend([i] * len(banned))
+                cols.extend(banned)
+        if cols:
+            scores[rows, cols] = -float("inf")
+        return scores
+
+def warp_scores(
+    scores: torch.Tensor, temperatures: torch.Tensor, top_p: torch.Tensor, top_k: Optional[torch.Tensor] = None
+) -> torch.Tensor:
+    """
+    temperature・top_k・top_p の順にロジットを加工する（softmax を取るとサンプリングに使う分布になる）
+
+    Args:
+        scores (torch.Tensor): [batch, vocab] のロジット（繰り返しの制御は適用済み）
+        temperatures (torch.Tensor): [batch] 行ごとの temperature（0以下の行は1として扱う）
+        top_p (torch.Tensor): [batch] 行ごとの top_p
+        top_k (Optional[torch.Tensor]): [batch] 行ごとの top_k（0の行は絞らない）
+
+    Returns:
+        torch.Tensor: 加工したロジット（除外した語彙は -inf）
+    """
+    greedy = temperatures <= 0
+    scores = scores / torch.where(greedy, torch.ones_like(temperatures), temperatures).unsqueeze(1)
+
+    # top_k: k 番目に大きいロジットより小さい語彙を除外する
+    if top_k is not None and bool((top_k > 0).any()):
+        k = top_k.clamp(min=0, max=scores.shape[-1])
+        kth = torch.topk(scores, int(k.max()), dim=-1).values.gather(1, (k.clamp(min=1) - 1).unsqueeze(1))
+        scores = scores.masked_fill((scores < kth) & (k > 0).unsqueeze(1), -float("inf"))
+
+    # top_p: 確率の低い順に並べ、累積確率が (1 - top_p) 以下の語彙を除外する
+    sorted_scores, sorted_idx = torch.sort(scores, descending=False, dim=-1)
+    cumulative = sorted_scores.softmax(dim=-1).cumsum(dim=-1)
+    remove = cumulative <= (1 - top_p).unsqueeze(1)
+    remove[:, -1] = False  # 最低1語彙は残す
+    return scores.masked_fill(remove.scatter(1, sorted_idx, remove), -float("inf"))
@@ -0,0 +1,247 @@
+# =============================================================================
+# レイテンシ計測と Prometheus 形式のメトリクス
+# =============================================================================
+# /chat が遅いときに、どの段階（プロンプト組み立て・トークン化・キュー待ち・
+# prefill・デコード・デトークン化・後処理）に時間がかかっているかを調べるため、
+# リクエストごとの段階別の所要時間と、生成ごとのトークン数・最初のトークンまでの
+# 時間・トークン/秒をヒストグラムに記録し、/metrics で Prometheus 形式で返す。
+#
+# 外部ライブラリ（prometheus_client）は使わず、必要な分だけをここで実装する。
+# 無効にした場合は何も記録しないタイマーを返すので、計測のコストはほぼゼロになる。
+# =============================================================================
+import bisect  # ヒストグラムのバケット検索用
+import threading  # 推論スレッドとイベントループからの同時更新の排他制御用
+import time  # 所要時間の計測用
+from contextlib import contextmanager, nullcontext  # 段階ごとの計測用
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# 所要時間（秒）のバケット
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# トークン数のバケット
+TOKEN_BUCKETS = (1, 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+# トークン/秒のバケット
+RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+# 割合（推測デコードの採用率など）のバケット
+RATIO_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    """ラベルを Prometheus の {name="value",...} 形式にする"""
+    parts = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Histogram:
+    """ラベルごとのバケット別件数・合計・件数を持つヒストグラム"""
+
+    def __init__(self, name: str, help_text: str, buckets: Sequence[float], labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.labelnames = tuple(labelnames)
+        self._series: Dict[Tuple[str, ...], List[float]] = {}  # ラベル → [バケット別件数..., 合計, 件数]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str):
+        """値を1つ記録する（labels は labelnames の順）"""
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> List[str]:
+        """Prometheus のテキスト形式の行を返す（バケットは累積件数）"""
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted(self._series.items())
+        for labels, values in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                bucket = _format_labels(self.labelnames, labels, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{bucket} {cumulative}")
+            bucket = _format_labels(self.labelnames, labels, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{bucket} {values[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {values[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {values[-1]}")
+        return lines
+
+class Counter:
+    """ラベルごとの累積カウンタ"""
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels: str, amount: float = 1):
+        """カウンタを増やす"""
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        lines.extend(f"{self.name}{_format_labels(self.labelnames, labels)} {value}" for labels, value in values)
+        return lines
+
+class Gauge:
+    """取得時に関数を呼んで現在値を返すゲージ"""
+
+    def __init__(self, name: str, help_text: str, function: Callable[[], Optional[float]]):
+        self.name = name
+        self.help_text = help_text
+        self.function = function
+
+    def render(self) -> List[str]:
+        value = self.function()
+        if value is None:
+            return []
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+class RequestTimer:
+    """
+    1リクエスト分の段階別の所要時間を記録する
+
+    記録した値はヒストグラムに加えられ、server_timing() で Server-Timing ヘッダーの
+    形式にもできる。
+    """
+
+    def __init__(self, metrics: "ServingMetrics", endpoint: str):
+        self.metrics = metrics
+        self.endpoint = endpoint
+        self.started_at = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """with ブロックの所要時間を段階 name として記録する"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name: str, seconds: float):
+        """段階 name の所要時間を記録する（同じ段階は合計する）"""
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+        self.metrics.stage_seconds.observe(seconds, self.endpoint, name)
+
+    def add_generation(self, timings: Dict[str, float]):
+        """スケジューラが返した生成の段階別時間（キュー待ち・prefill・デコード）を記録する"""
+        for name in ("queue", "prefill", "decode"):
+            if name in timings:
+                self.add(name, timings[name])
+
+    def finish(self, status: str = "ok"):
+        """リクエスト全体の所要時間と件数を記録する"""
+        self.metrics.request_seconds.observe(time.perf_counter() - self.started_at, self.endpoint)
+        self.metrics.requests.inc(self.endpoint, status)
+
+    def server_timing(self) -> str:
+        """Server-Timing ヘッダーの値（例: encode;dur=1.2, prefill;dur=35.0）"""
+        total = time.perf_counter() - self.started_at
+        parts = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.stages.items()]
+        parts.append(f"total;dur={total * 1000:.1f}")
+        return ", ".join(parts)
+
+class _NullTimer:
+    """計測が無効な場合のタイマー（何も記録しない）"""
+
+    stages: Dict[str, float] = {}
+
+    def stage(self, name: str):
+        return nullcontext()
+
+    def add(self, name: str, seconds: float):
+        pass
+
+    def add_generation(self, timings: Dict[str, float]):
+        pass
+
+    def finish(self, status: str = "ok"):
+        pass
+
+    def server_timing(self) -> str:
+        return ""
+
+class ServingMetrics:
+    """
+    サーバー全体のメトリクス（段階別の所要時間・トークン数・TTFT・トークン/秒など）
+    """
+
+    def __init__(self, enabled: bool = True):
+        """
+        Args:
+            enabled (bool): False なら何も記録しない
+        """
+        self.enabled = enabled
+        self.stage_seconds = Histogram(
+            "nemo_stage_seconds", "Time spent in each request stage", LATENCY_BUCKETS, ("endpoint", "stage"))
+        self.request_seconds = Histogram(
+            "nemo_request_seconds", "End-to-end request latency", LATENCY_BUCKETS, ("endpoint",))
+        self.queue_seconds = Histogram(
+            "nemo_queue_wait_seconds", "Time a generation waited before prefill", LATENCY_BUCKETS)
+        self.ttft_seconds = Histogram(
+            "nemo_time_to_first_token_seconds", "Time from enqueue to the first generated token", LATENCY_BUCKETS)
+        self.tokens_per_second = Histogram(
+            "nemo_decode_tokens_per_second", "Per-generation decode speed", RATE_BUCKETS)
+        self.prompt_tokens = Histogram(
+            "nemo_prompt_tokens", "Prompt length of each generation", TOKEN_BUCKETS)
+        self.generated_tokens = Histogram(
+            "nemo_generated_tokens", "Generated tokens of each generation", TOKEN_BUCKETS)
+        self.acceptance_ratio = Histogram(
+            "nemo_speculative_acceptance_ratio", "Per-generation share of draft tokens accepted", RATIO_BUCKETS)
+        self.requests = Counter(
+            "nemo_requests_total", "Finished requests by endpoint and status", ("endpoint", "status"))
+        self._gauges: List[Gauge] = []
+
+    def timer(self, endpoint: str):
+        """1リクエスト分のタイマーを作る（無効なら何もしないタイマー）"""
+        return RequestTimer(self, endpoint) if self.enabled else _NullTimer()
+
+    def add_gauge(self, name: str, help_text: str, function: Callable[[], Optional[float]]):
+        """取得時に現在値を計算するゲージを追加する（実行中の生成数など）"""
+        self._gauges.append(Gauge(name, help_text, function))
+
+    def record_generation(self, result):
+        """
+        生成1回分のトークン数・キュー待ち・TTFT・トークン/秒を記録する（推論スレッドから呼ばれる）
+
+        Args:
+            result (GenerationResult): スケジューラの生成結果
+        """
+        if not self.enabled:
+            return
+        timings = result.timings
+        self.prompt_tokens.observe(result.prompt_tokens)
+        self.generated_tokens.observe(len(result.token_ids))
+        if "queue" in timings:
+            self.queue_seconds.observe(timings["queue"])
+        if "ttft" in timings:
+            self.ttft_seconds.observe(timings["ttft"])
+        # 最初のトークンは prefill で得られるので、デコードの速度はそれ以降のトークンで計算する
+        if timings.get("decode", 0) > 0 and len(result.token_ids) > 1:
+            self.tokens_per_second.observe((len(result.token_ids) - 1) / timings["decode"])
+        if result.draft_tokens:
+            self.acceptance_ratio.observe(result.accepted_draft_tokens / result.draft_tokens)
+
+    def render(self) -> str:
+        """すべてのメトリクスを Prometheus のテキスト形式で返す"""
+        lines: List[str] = []
+        for metric in (
+            self.stage_seconds, self.request_seconds, self.queue_seconds, self.ttft_seconds,
+            self.tokens_per_second, self.prompt_tokens, self.generated_tokens, self.acceptance_ratio, self.requests,
+        ):
+            lines.extend(metric.render())
+        for gauge in self._gauges:
+            lines.extend(gauge.render())
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,469 @@
+# =============================================================================
+# 複数プロセスでの推論（重みを共有メモリに1つだけ置く）
+# =============================================================================
+# uvicorn の workers を増やすと、各プロセスが from_pretrained と load_dataset を
+# 行うため、メモリがプロセス数に比例して増える。ここでは次の構成にする:
+#   - フロントエンド（server.py のプロセス）がモデルを1度だけ読み込み、重みを
+#     共有メモリに移す（model.share_memory()）。ペルソナのデータセット・ストア・
+#     インデックスもフロントエンドだけが持つ（ワーカーはトークンIDしか扱わない）
+#   - 推論ワーカー（spawn で起動した N 個のプロセス）は共有メモリの重みをそのまま
+#     参照し（複製しない）、それぞれ自分の GenerationScheduler で連続バッチングを行う
+#   - ワーカーごとに PyTorch のスレッド数（intra-op）を割り当て、CPU コアが足りれば
+#     重ならないコアに固定する（ワーカー同士でコアを取り合わない）
+#   - フロントエンドは /chat などの生成を、処理中のリクエストが最も少ないワーカーに
+#     振り分ける（同数ならペルソナごとに同じワーカーを選び、プレフィックスキャッシュを効かせる）
+#
+# WorkerPool は GenerationScheduler と同じ公開API（generate・stream・stats など）を
+# 持つので、server.py はどちらを使っているかを意識しない。
+# リクエストと結果は torch.multiprocessing のキューで受け渡す（KV などのテンソルは
+# 共有メモリ経由で渡り、受け取った側で通常のメモリに複製する）。
+# =============================================================================
+import asyncio  # 非同期のFuture・キュー
+import itertools  # リクエストIDの採番用
+import logging  # ログ出力用
+import os  # CPU の割り当て・プロセスID用
+import queue  # ワーカーからの結果の受信（タイムアウト付き）
+import threading  # 結果の受信スレッド
+import time  # 起動時間の計測用
+from concurrent.futures import ThreadPoolExecutor  # フロントエンドでのモデルの計算用
+from dataclasses import dataclass
+from typing import AsyncIterator, Callable, Dict, Hashable, List, Optional, Sequence
+
+import torch  # PyTorch（スレッド数の設定）
+import torch.multiprocessing as mp  # テンソルを共有メモリで渡せる multiprocessing
+
+from scheduler import GenerationParams, GenerationResult, GenerationScheduler, KVTensors, eos_token_ids  # ワーカー内の生成ループ
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class WorkerConfig:
+    """推論ワーカーの設定（全ワーカー共通）"""
+    max_batch_size: int = 8  # ワーカーごとの同時生成シーケンス数
+    num_threads: int = 1  # ワーカーごとの PyTorch のスレッド数
+    prefix_cache_bytes: int = 0  # ワーカーごとのプレフィックスキャッシュの上限（0で無効）
+    speculative_tokens: int = 4  # 推測デコードで1回に提案させるトークン数（下書きモデルがある場合）
+
+def share_model(model):
+    """
+    モデルの重みを共有メモリに移す（ワーカーに渡しても複製されない）
+
+    Args:
+        model: PyTorch のモジュール（動的量子化したものは共有できない）
+
+    Returns:
+        モデル（その場で書き換える）
+    """
+    if any(not isinstance(value, torch.Tensor) for value in model.state_dict().values()):
+        raise ValueError("Quantized models cannot be shared between worker processes")
+    return model.share_memory()
+
+def default_threads(workers: int) -> int:
+    """ワーカーごとのスレッド数の既定値（使える CPU をワーカー数で等分する）"""
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+    return max(1, cpus // workers)
+
+def cpu_sets(workers: int, threads: int) -> List[Optional[List[int]]]:
+    """
+    ワーカーごとに固定する CPU の組を返す（コアが足りない・固定できない環境では None）
+
+    Args:
+        workers (int): ワーカー数
+        threads (int): ワーカーごとのスレッド数
+    """
+    if not hasattr(os, "sched_getaffinity"):
+        return [None] * workers
+    cpus = sorted(os.sched_getaffinity(0))
+    if len(cpus) < workers * threads:
+        return [None] * workers
+    return [cpus[i * threads:(i + 1) * threads] for i in range(workers)]
+
+def _private(kv: Optional[KVTensors]) -> Optional[KVTensors]:
+    """共有メモリで受け取った KV を通常のメモリに複製する（共有メモリのファイル記述子を持ち続けない）"""
+    if kv is None:
+        return None
+    return tuple((k.clone(), v.clone()) for k, v in kv)
+
+# =============================================================================
+# ワーカープロセス
+# =============================================================================
+
+def _worker_main(index: int, model, tokenizer, draft, config: WorkerConfig, cpus, requests, responses):
+    """推論ワーカーのエントリーポイント（spawn したプロセスで実行される）"""
+    logging.basicConfig(level=logging.INFO)
+    try:
+        if cpus is not None:
+            os.sched_setaffinity(0, cpus)
+        torch.set_num_threads(config.num_threads)
+        asyncio.run(_serve(index, model, tokenizer, draft, config, requests, responses))
+    except Exception as e:
+        logger.error(f"Inference worker {index} failed: {e}")
+        responses.put(("failed", index, str(e), None))
+
+async def _serve(index: int, model, tokenizer, draft, config: WorkerConfig, requests, responses):
+    """フロントエンドからのリクエストを自分のスケジューラで処理する"""
+    from prefix_cache import PrefixCache  # ワーカーごとのプレフィックスキャッシュ
+    from speculative import SpeculativeDecoder  # 推測デコード（下書きモデル）
+
+    scheduler = GenerationScheduler(
+        model,
+        tokenizer,
+        max_batch_size=config.max_batch_size,
+        num_threads=config.num_threads,
+        prefix_cache=PrefixCache(config.prefix_cache_bytes) if config.prefix_cache_bytes > 0 else None,
+        speculative=SpeculativeDecoder(draft, config.speculative_tokens) if draft is not None else None,
+    )
+    scheduler.start()
+    loop = asyncio.get_running_loop()
+    tasks: Dict[int, asyncio.Task] = {}
+    responses.put(("ready", index, {"pid": os.getpid(), "threads": torch.get_num_threads()}, None))
+
+    async def run(request_id: int, kind: str, kwargs: dict):
+        try:
+            if kind == "stream":
+                async for token in scheduler.stream(**kwargs):
+                    responses.put(("token", request_id, token, None))
+                result = None
+            else:
+                result = await scheduler.generate(**kwargs)
+            responses.put(("done", request_id, result, scheduler.stats()))
+        except asyncio.CancelledError:
+            responses.put(("cancelled", request_id, None, scheduler.stats()))
+        except Exception as e:
+            responses.put(("error", request_id, RuntimeError(f"{type(e).__name__}: {e}"), scheduler.stats()))
+        finally:
+            tasks.pop(request_id, None)
+
+    try:
+        while True:
+            message = await loop.run_in_executor(None, requests.get)
+            kind = message[0]
+            if kind == "stop":
+                break
+            if kind == "cancel":
+                task = tasks.get(message[1])
+                if task is not None:
+                    task.cancel()
+                continue
+            _, request_id, kwargs = message
+            tasks[request_id] = loop.create_task(run(request_id, kind, kwargs))
+    finally:
+        for task in list(tasks.values()):
+            task.cancel()
+        await scheduler.stop()
+
+# =============================================================================
+# フロントエンド側
+# =============================================================================
+
+class _Pending:
+    """フロントエンドで待っている1リクエスト"""
+
+    def __init__(self, worker: int, future: asyncio.Future, tokens: Optional[asyncio.Queue] = None):
+        self.worker = worker
+        self.future = future
+        self.tokens = tokens  # ストリーミング時のトークンのキュー（None で終了）
+
+class WorkerPool:
+    """
+    推論ワーカープロセスの集合（GenerationScheduler と同じ公開APIを持つ）
+
+    重みは共有メモリに置いたものを全ワーカーが参照する。生成は処理中のリクエストが
+    最も少ないワーカーに振り分ける。
+    """
+
+    def __init__(self, model, tokenizer, workers: int, config: WorkerConfig, draft=None, metrics=None):
+        """
+        Args:
+            model: Hugging Face の CausalLM（共有メモリに移す）
+            tokenizer: 対応するトークナイザー（各ワーカーに渡す）
+            workers (int): ワーカー数
+            config (WorkerConfig): ワーカーの設定
+            draft: 推測デコードの下書きモデル（共有メモリに移す。None で推測デコードなし）
+            metrics (ServingMetrics): 生成ごとのトークン数・TTFTなどの記録先（None で記録しない）
+        """
+        self.model = share_model(model)
+        self.draft = share_model(draft) if draft is not None else None
+        self.tokenizer = tokenizer
+        self.workers = workers
+        self.config = config
+        self.metrics = metrics
+        self.max_batch_size = config.max_batch_size * workers
+        self.eos_token_ids = eos_token_ids(model, tokenizer)
+
+        self._context = mp.get_context("spawn")
+        self._responses = self._context.Queue()
+        self._requests = [self._context.Queue() for _ in range(workers)]
+        self._processes: List = []
+        self._ids = itertools.count()
+        self._pending: Dict[int, _Pending] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._reader: Optional[threading.Thread] = None
+        self._closing = False
+        self._ready: Optional[asyncio.Future] = None
+        self._started_at = 0.0
+
+        # ワーカーごとの状態（処理中のリクエスト数・直近のスケジューラの統計）
+        self._alive = [False] * workers
+        self._info: List[dict] = [{} for _ in range(workers)]
+        self._in_flight = [0] * workers
+        self._dispatched = [0] * workers
+        self._worker_stats: List[dict] = [{} for _ in range(workers)]
+
+        # 生成以外でモデルを使う処理（文章のベクトル化など）はフロントエンドのこのスレッドで行う
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="frontend-inference")
+
+    # -------------------------------------------------------------------------
+    # 起動・停止
+    # -------------------------------------------------------------------------
+
+    def start(self):
+        """ワーカープロセスと結果の受信スレッドを起動する"""
+        if self._processes:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._ready = self._loop.create_future()
+        self._started_at = time.perf_counter()
+        for index, cpus in enumerate(cpu_sets(self.workers, self.config.num_threads)):
+            process = self._context.Process(
+                target=_worker_main,
+                args=(index, self.model, self.tokenizer, self.draft, self.config, cpus, self._requests[index], self._responses),
+                name=f"nemo-inference-{index}",
+                daemon=True,
+            )
+            process.start()
+            self._processes.append(process)
+        self._reader = threading.Thread(target=self._receive, name="worker-results", daemon=True)
+        self._reader.start()
+
+    async def wait_ready(self):
+        """全ワーカーがリクエストを受け付けられるようになるまで待つ（起動に失敗したら例外）"""
+        await self._ready
+
+    async def stop(self):
+        """ワーカーを停止し、未完了のリクエストを失敗させる"""
+        self._closing = True
+        for requests, process in zip(self._requests, self._processes):
+            if process.is_alive():
+                requests.put(("stop",))
+        for process in self._processes:
+            await asyncio.to_thread(process.join, 10)
+            if process.is_alive():
+                process.terminate()
+        if self._reader is not None:
+            await asyncio.to_thread(self._reader.join, 5)
+        self._executor.shutdown(wait=True)
+        self._fail(lambda pending: True, RuntimeError("Scheduler stopped"))
+
+    # -------------------------------------------------------------------------
+    # 公開API（GenerationScheduler と同じ）
+    # -------------------------------------------------------------------------
+
+    async def generate(
+        self,
+        prompt_ids: Sequence[int],
+        params: GenerationParams,
+        prefix_key: Optional[Hashable] = None,
+        prefix_len: int = 0,
+        past: Optional[KVTensors] = None,
+        return_cache: bool = False,
+    ) -> GenerationResult:
+        """
+        プロンプトをいずれかのワーカーで生成し、完了まで待つ（引数は GenerationScheduler.generate と同じ）
+
+        Returns:
+            GenerationResult: 生成結果（cache は通常のメモリに複製したもの）
+        """
+        kwargs = {
+            "prompt_ids": list(prompt_ids),
+            "params": params,
+            "prefix_key": prefix_key,
+            "prefix_len": prefix_len,
+            # 送ったテンソルは共有メモリに移るので、呼び出し側が持っている KV ではなく複製を渡す
+            "past": _private(past),
+            "return_cache": return_cache,
+        }
+        request_id, pending = self._submit("generate", kwargs, prefix_key)
+        try:
+            result = await pending.future
+        finally:
+            self._cancel_if_pending(request_id, pending)
+        result.cache = _private(result.cache)
+        return result
+
+    async def stream(
+        self,
+        prompt_ids: Sequence[int],
+        params: GenerationParams,
+        prefix_key: Optional[Hashable] = None,
+        prefix_len: int = 0,
+    ) -> AsyncIterator[int]:
+        """
+        プロンプトをいずれかのワーカーで生成し、生成されたトークンIDを1つずつ返す
+        （途中で反復をやめるとワーカー側の生成も取り消す）
+        """
+        kwargs = {"prompt_ids": list(prompt_ids), "params": params, "prefix_key": prefix_key, "prefix_len": prefix_len}
+        request_id, pending = self._submit("stream", kwargs, prefix_key, stream=True)
+        try:
+            while True:
+                token = await pending.tokens.get()
+                if token is None:  # 終了の合図
+                    break
+                yield token
+            # エラーで終了した場合はここで例外が送出される
+            await pending.future
+        finally:
+            self._cancel_if_pending(request_id, pending)
+
+    async def warmup(self, prompt_ids: Sequence[int], params: GenerationParams) -> List[GenerationResult]:
+        """全ワーカーで1回ずつ生成する（初回だけのコストをすべてのワーカーで払っておく）"""
+        futures = []
+        for worker in range(self.workers):
+            _, pending = self._submit("generate", {"prompt_ids": list(prompt_ids), "params": params}, worker=worker)
+            futures.append(pending.future)
+        return await asyncio.gather(*futures)
+
+    async def run_in_inference_thread(self, fn: Callable, *args):
+        """生成以外でモデルを使う処理（文章のベクトル化など）をフロントエンドの推論スレッドで実行する"""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def stats(self) -> Dict[str, object]:
+        """ワーカーごとの処理中のリクエスト数と、各ワーカーのスケジューラの直近の統計を返す"""
+        per_worker = []
+        for index in range(self.workers):
+            latest = self._worker_stats[index]
+            per_worker.append({
+                "pid": self._info[index].get("pid"),
+                "alive": self._alive[index],
+                "in_flight": self._in_flight[index],
+                "dispatched_requests": self._dispatched[index],
+                "completed_requests": latest.get("completed_requests", 0),
+                "generated_tokens": latest.get("generated_tokens", 0),
+                "tokens_per_second": latest.get("tokens_per_second", 0.0),
+                "reused_prefix_tokens": latest.get("reused_prefix_tokens", 0),
+                "speculative": latest.get("speculative"),
+            })
+        per_slot = self.config.max_batch_size
+        return {
+            "workers": self.workers,
+            "threads_per_worker": self.config.num_threads,
+            "max_batch_size": self.max_batch_size,
+            # ワーカーは自分の max_batch_size までを同時に生成し、残りは自分のキューで待たせる
+            "active_sequences": sum(min(n, per_slot) for n in self._in_flight),
+            "queued_requests": sum(max(n - per_slot, 0) for n in self._in_flight),
+            "completed_requests": sum(w["completed_requests"] for w in per_worker),
+            "generated_tokens": sum(w["generated_tokens"] for w in per_worker),
+            "per_worker": per_worker,
+        }
+
+    # -------------------------------------------------------------------------
+    # 振り分けと結果の受信
+    # -------------------------------------------------------------------------
+
+    def _pick(self, prefix_key: Optional[Hashable]) -> int:
+        """処理中のリクエストが最も少ないワーカーを選ぶ（同数ならペルソナごとに決まったワーカー）"""
+        alive = [i for i in range(self.workers) if self._alive[i]]
+        if not alive:
+            raise RuntimeError("No inference worker is available")
+        least = min(self._in_flight[i] for i in alive)
+        candidates = [i for i in alive if self._in_flight[i] == least]
+        if prefix_key is None:
+            return candidates[0]
+        return candidates[hash(prefix_key) % len(candidates)]
+
+    def _submit(self, kind: str, kwargs: dict, prefix_key: Optional[Hashable] = None, stream: bool = False, worker: Optional[int] = None):
+        """リクエストをワーカーに送り、結果を待つための _Pending を返す"""
+        if worker is None:
+            worker = self._pick(prefix_key)
+        request_id = next(self._ids)
+        pending = _Pending(worker, self._loop.create_future(), asyncio.Queue() if stream else None)
+        self._pending[request_id] = pending
+        self._in_flight[worker] += 1
+        self._dispatched[worker] += 1
+        self._requests[worker].put((kind, request_id, kwargs))
+        return request_id, pending
+
+    def _cancel_if_pending(self, request_id: int, pending: _Pending):
+        """呼び出し側が結果を待たなくなったら、ワーカー側の生成を取り消す"""
+        if not pending.future.done():
+            pending.future.cancel()
+        if request_id in self._pending:
+            self._requests[pending.worker].put(("cancel", request_id))
+
+    def _receive(self):
+        """ワーカーからの結果を受け取り、イベントループ側で処理する（受信スレッド）"""
+        while not self._closing or any(p.is_alive() for p in self._processes):
+            try:
+                message = self._responses.get(timeout=1.0)
+            except queue.Empty:
+                self._loop.call_soon_threadsafe(self._check_workers)
+                continue
+            except (EOFError, OSError):
+                break
+            self._loop.call_soon_threadsafe(self._dispatch, message)
+
+    def _dispatch(self, message: tuple):
+        """ワーカーからの1メッセージを処理する（イベントループのスレッド）"""
+        kind, key, payload, stats = message
+        if kind == "ready":
+            self._alive[key] = True
+            self._info[key] = payload
+            if all(self._alive) and not self._ready.done():
+                logger.info(f"{self.workers} inference workers ready in {time.perf_counter() - self._started_at:.1f}s")
+                self._ready.set_result(None)
+            return
+        if kind == "failed":
+            self._alive[key] = False
+            if not self._ready.done():
+                self._ready.set_exception(RuntimeError(f"Inference worker {key} failed to start: {payload}"))
+            self._fail(lambda pending: pending.worker == key, RuntimeError(f"Inference worker {key} failed: {payload}"))
+            return
+
+        pending = self._pending.get(key)
+        if pending is None:
+            return
+        if kind == "token":
+            if pending.tokens is not None:
+                pending.tokens.put_nowait(payload)
+            return
+
+        # done・error・cancelled: リクエストの終了
+        del self._pending[key]
+        self._in_flight[pending.worker] -= 1
+        self._worker_stats[pending.worker] = stats or self._worker_stats[pending.worker]
+        if pending.tokens is not None:
+            pending.tokens.put_nowait(None)
+        if pending.future.done():
+            return
+        if kind == "done":
+            if self.metrics is not None and payload is not None:
+                self.metrics.record_generation(payload)
+            pending.future.set_result(payload)
+        elif kind == "error":
+            pending.future.set_exception(payload)
+        else:
+            pending.future.cancel()
+
+    def _check_workers(self):
+        """終了してしまったワーカーの処理中のリクエストを失敗させる"""
+        if self._closing:
+            return
+        for index, process in enumerate(self._processes):
+            if self._alive[index] and not process.is_alive():
+                logger.error(f"Inference worker {index} exited (code {process.exitcode})")
+                self._alive[index] = False
+                self._fail(lambda pending: pending.worker == index, RuntimeError(f"Inference worker {index} exited"))
+        if not self._ready.done() and self._processes and not any(p.is_alive() for p in self._processes):
+            self._ready.set_exception(RuntimeError("All inference workers exited during startup"))
+
+    def _fail(self, predicate: Callable[[_Pending], bool], error: Exception):
+        """条件に合う待ち中のリクエストを失敗させる"""
+        for request_id, pending in list(self._pending.items()):
+            if not predicate(pending):
+                continue
+            del self._pending[request_id]
+            self._in_flight[pending.worker] -= 1
+            if pending.tokens is not None:
+                pending.tokens.put_nowait(None)
+            if not pending.future.done():
+                pending.future.set_exception(error)
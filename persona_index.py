@@ -0,0 +1,272 @@
+# =============================================================================
+# ペルソナ検索用のインデックス
+# =============================================================================
+# 100万件のペルソナを条件で探すたびに全件を走査しないよう、起動時に
+#   - 職業・地域・都道府県・性別: 値ごとの行番号リスト（転置インデックス）
+#   - 年齢: 年齢順に並べた行番号（範囲検索は二分探索）
+# を NumPy 配列で作っておく。
+#
+# 職業などの条件は部分一致で、まず値の一覧（数千種類程度）から一致する値を探し、
+# その値の行番号リストを合わせる。複数の条件は行番号リストの共通部分を取る。
+#
+# 説明文のキーワード検索は、他の条件で候補が絞れていればその候補だけを、
+# そうでなければ説明文の文字 bigram（連続する2文字）の転置インデックスで候補を絞る。
+# キーワードのすべての bigram を含む行の共通部分を取り、その行だけを Arrow の部分一致検索で
+# 確かめる（bigram がそろっていても連続して現れるとは限らないため）。1文字のキーワードと、
+# bigram のインデックスを作らない場合は列全体を走査する。結果はキーワードごとにキャッシュする。
+# =============================================================================
+import threading  # キーワード検索キャッシュの排他制御用
+from collections import OrderedDict  # キーワード検索結果のLRUキャッシュ
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np  # 行番号の配列操作
+import pyarrow as pa  # 列指向データ
+import pyarrow.compute as pc  # 列単位の検索
+
+from persona_stats import FILTER_COLUMNS  # 絞り込みに使える列
+
+# 候補がこの件数以下なら、キーワード検索は候補の行だけを対象にする
+KEYWORD_CANDIDATE_LIMIT = 50000
+# bigram のインデックスを作るときに1度に処理する行数（作成中の一時メモリを抑える）
+BIGRAM_CHUNK_ROWS = 16384
+ROW_BITS = np.uint64(14)  # チャンク内の行番号のビット数（2 ** 14 = BIGRAM_CHUNK_ROWS）
+ROW_MASK = np.uint64(BIGRAM_CHUNK_ROWS - 1)
+
+class _InvertedIndex:
+    """1列分の転置インデックス（値 → その値を持つ行番号の昇順配列）"""
+
+    def __init__(self, column: pa.ChunkedArray):
+        encoded = pc.dictionary_encode(column).combine_chunks()
+        codes = encoded.indices.to_numpy(zero_copy_only=False)
+        # 欠損値は -1 として先頭に並ぶようにする
+        codes = np.where(encoded.indices.is_null().to_numpy(zero_copy_only=False), -1, codes).astype(np.int64)
+        self.values: List[str] = encoded.dictionary.to_pylist()
+        # 値の番号順（同じ値の中では行番号順）に並べた行番号
+        self.order = np.argsort(codes, kind="stable").astype(np.int32)
+        counts = np.bincount(codes[codes >= 0], minlength=len(self.values))
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+        # 欠損値の分だけ先頭がずれるので、その件数を足す
+        self.offsets += int((codes < 0).sum())
+
+    def rows_containing(self, text: str) -> np.ndarray:
+        """値に text を含む行の行番号（昇順）を返す"""
+        parts = [
+            self.order[self.offsets[code]:self.offsets[code + 1]]
+            for code, value in enumerate(self.values)
+            if value is not None and text in value
+        ]
+        if not parts:
+            return np.empty(0, dtype=np.int32)
+        if len(parts) == 1:
+            return parts[0]
+        return np.sort(np.concatenate(parts))
+
+class _BigramIndex:
+    """
+    説明文の文字 bigram の転置インデックス（bigram → それを含む行番号の昇順配列）
+
+    bigram は2文字のコードポイントを1つの整数（上位が1文字目）にしたもの。
+    行番号は bigram ごとに連続して1つの int32 配列に入れ、offsets で区切る。
+    作成は2回に分けて行う（1回目で bigram ごとの行数を数えて配列を確保し、2回目で行番号を書き込む）。
+    """
+
+    def __init__(self, column: pa.ChunkedArray):
+        texts = pc.fill_null(column, "")
+        starts = range(0, len(texts), BIGRAM_CHUNK_ROWS)
+
+        # 1回目: bigram ごとに、それを含む行数を数える
+        chunk_keys, chunk_counts = [], []
+        for start in starts:
+            keys, _ = self._pairs(texts, start)
+            keys, counts = np.unique(keys, return_counts=True)
+            chunk_keys.append(keys)
+            chunk_counts.append(counts)
+        self.keys, inverse = np.unique(np.concatenate(chunk_keys), return_inverse=True)
+        totals = np.bincount(inverse, weights=np.concatenate(chunk_counts), minlength=len(self.keys)).astype(np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(totals)])
+
+        # 2回目: 行番号を bigram ごとの位置に書き込む（行の順に処理するので bigram ごとに昇順になる）
+        self.rows = np.empty(int(self.offsets[-1]), dtype=np.int32)
+        cursor = self.offsets[:-1].copy()
+        for start in starts:
+            keys, rows = self._pairs(texts, start)
+            ids = np.searchsorted(self.keys, keys)
+            unique_ids, first, counts = np.unique(ids, return_index=True, return_counts=True)
+            rank = np.arange(len(ids)) - np.repeat(first, counts)
+            self.rows[cursor[ids] + rank] = rows
+            cursor[unique_ids] += counts
+
+    @staticmethod
+    def _pairs(texts: pa.ChunkedArray, start: int):
+        """BIGRAM_CHUNK_ROWS 行分の (bigram, 行番号) の組（重複なし、bigram・行番号の順）"""
+        chunk = texts.slice(start, BIGRAM_CHUNK_ROWS).to_pylist()
+        # 固定長の UTF-32 配列にして、隣り合う2文字のコードポイントを並べる（短い行の残りは0）
+        codes = np.array(chunk, dtype=str)
+        width = codes.dtype.itemsize // 4
+        if width < 2:
+            return np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.int32)
+        points = codes.view(np.uint32).reshape(len(chunk), width)
+        second = points[:, 1:]
+        valid = second != 0
+        # bigram（42ビット）とチャンク内の行番号（ROW_BITS ビット）を1つの整数にして、並べ替えと重複の除去を1回で行う
+        local = np.broadcast_to(np.arange(len(chunk), dtype=np.uint64)[:, None], second.shape)
+        pairs = ((points[:, :-1].astype(np.uint64) << np.uint64(21) | second) << ROW_BITS | local)[valid]
+        pairs.sort()
+        pairs = pairs[np.concatenate([[True], pairs[1:] != pairs[:-1]])]
+        return pairs >> ROW_BITS, (pairs & ROW_MASK).astype(np.int32) + start
+
+    @property
+    def nbytes(self) -> int:
+        """インデックスのメモリ使用量（バイト）"""
+        return self.keys.nbytes + self.offsets.nbytes + self.rows.nbytes
+
+    def candidates(self, keyword: str) -> Optional[np.ndarray]:
+        """keyword のすべての bigram を含む行の行番号（昇順、keyword が1文字なら None）"""
+        if len(keyword) < 2:
+            return None
+        parts = []
+        for key in {(ord(a) << 21) | ord(b) for a, b in zip(keyword, keyword[1:])}:
+            i = int(np.searchsorted(self.keys, np.uint64(key)))
+            if i >= len(self.keys) or self.keys[i] != key:
+                return np.empty(0, dtype=np.int32)
+            parts.append(self.rows[self.offsets[i]:self.offsets[i + 1]])
+        parts.sort(key=len)
+        rows = parts[0]
+        for part in parts[1:]:
+            rows = np.intersect1d(rows, part, assume_unique=True)
+            if len(rows) == 0:
+                break
+        return rows
+
+class PersonaIndex:
+    """
+    ペルソナの条件検索（職業・地域・年齢範囲・キーワード）とページングを行う
+    """
+
+    def __init__(self, table: pa.Table, keyword_cache_size: int = 64, keyword_index: bool = True):
+        """
+        Args:
+            table (pa.Table): ペルソナのテーブル
+            keyword_cache_size (int): キーワード検索結果を何件までキャッシュするか
+            keyword_index (bool): 説明文の bigram の転置インデックスを作るか（False ならキーワード検索は全件走査）
+        """
+        self.table = table
+        self.num_rows = table.num_rows
+        names = set(table.column_names)
+
+        # 職業・地域などの転置インデックス
+        self._inverted: Dict[str, _InvertedIndex] = {
+            name: _InvertedIndex(table.column(name)) for name in FILTER_COLUMNS if name in names
+        }
+
+        # 年齢順に並べた行番号と、その順に並べた年齢
+        self._age_order = None
+        if "age" in names:
+            age = pc.fill_null(pc.cast(table.column("age"), pa.int64()), -1).to_numpy()
+            self._age_order = np.argsort(age, kind="stable").astype(np.int32)
+            self._age_sorted = age[self._age_order]
+
+        # 説明文の bigram の転置インデックス
+        self._bigrams = _BigramIndex(table.column("persona")) if keyword_index and "persona" in names else None
+
+        self._keyword_cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._keyword_cache_size = keyword_cache_size
+        self._lock = threading.Lock()
+
+    def search(
+        self,
+        keywords: Sequence[str] = (),
+        age_min: Optional[int] = None,
+        age_max: Optional[int] = None,
+        **contains,
+    ) -> np.ndarray:
+        """
+        条件にすべて一致するペルソナの行番号（昇順）を返す
+
+        Args:
+            keywords (Sequence[str]): 説明文（persona 列）に含まれるべきキーワード（AND）
+            age_min (Optional[int]): 年齢の下限（この値を含む）
+            age_max (Optional[int]): 年齢の上限（この値を含む）
+            **contains: 列名=文字列 の部分一致条件（occupation, region, prefecture, sex）
+
+        Returns:
+            np.ndarray: 一致した行番号
+        """
+        sets: List[np.ndarray] = []
+        for column, text in contains.items():
+            if text is None:
+                continue
+            if column not in self._inverted:
+                raise ValueError(f"Unknown filter column: {column}")
+            sets.append(self._inverted[column].rows_containing(text))
+
+        if age_min is not None or age_max is not None:
+            if self._age_order is None:
+                raise ValueError("Dataset has no age column")
+            lo = np.searchsorted(self._age_sorted, age_min if age_min is not None else 0, side="left")
+            hi = np.searchsorted(self._age_sorted, age_max if age_max is not None else np.iinfo(np.int64).max, side="right")
+            sets.append(np.sort(self._age_order[lo:hi]))
+
+        # 件数の少ない条件から順に共通部分を取る
+        rows = None
+        for part in sorted(sets, key=len):
+            rows = part if rows is None else np.intersect1d(rows, part, assume_unique=True)
+            if len(rows) == 0:
+                return rows
+
+        for keyword in (k for k in keywords if k):
+            if rows is not None and len(rows) <= KEYWORD_CANDIDATE_LIMIT:
+                # 候補が少なければ候補の説明文だけを調べる
+                rows = self._verify(rows, keyword)
+            else:
+                part = self._keyword_rows(keyword)
+                rows = part if rows is None else np.intersect1d(rows, part, assume_unique=True)
+            if len(rows) == 0:
+                return rows
+
+        if rows is None:
+            return np.arange(self.num_rows, dtype=np.int32)
+        return rows
+
+    def fetch(self, rows: Sequence[int], columns: Sequence[str]) -> List[dict]:
+        """
+        指定した行の指定した列だけを取り出す
+
+        Args:
+            rows (Sequence[int]): 行番号
+            columns (Sequence[str]): 取り出す列名
+
+        Returns:
+            List[dict]: 行ごとの {列名: 値}
+        """
+        columns = [c for c in columns if c in self.table.column_names]
+        return self.table.select(columns).take(pa.array(rows, type=pa.int64())).to_pylist()
+
+    @property
+    def keyword_index_bytes(self) -> int:
+        """説明文の bigram の転置インデックスのメモリ使用量（バイト、作っていなければ0）"""
+        return self._bigrams.nbytes if self._bigrams is not None else 0
+
+    def _verify(self, rows: np.ndarray, keyword: str) -> np.ndarray:
+        """rows のうち、説明文に keyword を含む行だけを返す"""
+        matched = pc.match_substring(self.table.column("persona").take(pa.array(rows)), keyword)
+        return rows[pc.fill_null(matched, False).to_numpy()]
+
+    def _keyword_rows(self, keyword: str) -> np.ndarray:
+        """説明文に keyword を含む全行の行番号（キャッシュ付き）"""
+        with self._lock:
+            if keyword in self._keyword_cache:
+                self._keyword_cache.move_to_end(keyword)
+                return self._keyword_cache[keyword]
+        candidates = self._bigrams.candidates(keyword) if self._bigrams is not None else None
+        if candidates is not None:
+            # bigram がすべて含まれる行だけを確かめる
+            rows = self._verify(candidates, keyword)
+        else:
+            matched = pc.fill_null(pc.match_substring(self.table.column("persona"), keyword), False)
+            rows = np.flatnonzero(matched.to_numpy()).astype(np.int32)
+        with self._lock:
+            self._keyword_cache[keyword] = rows
+            while len(self._keyword_cache) > self._keyword_cache_size:
+                self._keyword_cache.popitem(last=False)
+        return rows
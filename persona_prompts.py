@@ -0,0 +1,216 @@
+# =============================================================================
+# ペルソナのシステムプロンプト（トークン化済みの保存とその読み出し）
+# =============================================================================
+# /chat のたびにペルソナの情報からシステムプロンプトの文字列を組み立てて
+# トークン化すると、同じペルソナでも毎回同じ処理を繰り返すことになる。
+#
+# ここでは全ペルソナのシステムプロンプト（<|im_start|>system ... <|im_end|>）を
+# オフラインでトークン化し、
+#   - tokens.u32  : 全ペルソナのトークンIDを連結した uint32 の配列
+#   - offsets.i64 : ペルソナ i のトークンIDは tokens[offsets[i]:offsets[i + 1]]
+#   - meta.json   : トークナイザー名・データセットの fingerprint・テンプレートのハッシュ
+# として保存する:
+#   python persona_prompts.py
+#
+# サーバーは配列を memmap で開き、ペルソナのトークンIDを切り出して会話部分の
+# トークンIDとつなげるだけでよい（文字列の組み立ても再トークン化もしない）。
+# =============================================================================
+import argparse  # コマンドライン引数の解析用
+import hashlib  # テンプレートのハッシュ計算用
+import json  # メタデータの読み書き用
+import logging  # ログ出力用
+import os  # ファイルパス操作用
+import time  # 処理速度の計測用
+from typing import Dict, List, Optional
+
+import numpy as np  # トークンIDの保存と読み出し
+
+logger = logging.getLogger(__name__)
+
+TOKENS_FILE = "tokens.u32"
+OFFSETS_FILE = "offsets.i64"
+META_FILE = "meta.json"
+
+# プロンプトに使うペルソナの項目
+PROMPT_COLUMNS = ("persona", "occupation", "age", "region")
+
+def build_persona_prompt(persona_data: dict) -> str:
+    """
+    ペルソナデータからAIに与えるシステムプロンプトを作る
+
+    Args:
+        persona_data (dict): ペルソナのデータ
+
+    Returns:
+        str: システムプロンプト
+    """
+    # ペルソナデータから各項目を取得（存在しない場合は空文字）
+    persona_description = persona_data.get("persona", "")  # 人物の詳細説明
+    occupation = persona_data.get("occupation", "")  # 職業
+    age = persona_data.get("age", "")  # 年齢
+    region = persona_data.get("region", "")  # 出身・居住地
+
+    # 存在するペルソナ情報のみをリストに追加
+    persona_parts = []
+    if persona_description:
+        persona_parts.append(f"人物像：{persona_description}")
+    if occupation:
+        persona_parts.append(f"職業：{occupation}")
+    if age:
+        persona_parts.append(f"年齢：{age}歳")
+    if region:
+        persona_parts.append(f"出身・居住地：{region}")
+
+    # ペルソナ情報を改行で結合（情報がない場合はデフォルト）
+    persona_info_text = "\n".join(persona_parts) if persona_parts else "一般的な日本人"
+
+    # AIに与えるシステムプロンプトを作成
+    return f"""あなたは以下のペルソナの人物として、その人になりきって自然な日本語で返答してください。メタ的な説明や分析は一切せず、その人物そのものとして話してください。
+
+【あなたの人物像】
+{persona_info_text}
+
+この人物として、自然な口調と視点で会話してください。その人の経験、価値観、話し方で返答してください。"""
+
+def build_system_block(persona_prompt: str) -> str:
+    """システムプロンプトをQwen3の会話形式のシステム部分に変換する"""
+    return f"<|im_start|>system\n{persona_prompt}<|im_end|>\n"
+
+def template_hash() -> str:
+    """
+    プロンプトのテンプレートのハッシュ（テンプレートを変更したら保存済みのデータを使わない）
+    """
+    sample = build_system_block(build_persona_prompt({
+        "persona": "{persona}", "occupation": "{occupation}", "age": "{age}", "region": "{region}"
+    }))
+    return hashlib.sha1(sample.encode("utf-8")).hexdigest()
+
+def build_prompt_store(
+    table,
+    tokenizer,
+    out_dir: str,
+    tokenizer_id: str,
+    fingerprint: Optional[str] = None,
+    batch_size: int = 1024,
+) -> dict:
+    """
+    全ペルソナのシステムプロンプトをトークン化して保存する
+
+    Args:
+        table: ペルソナの Arrow テーブル
+        tokenizer: Hugging Face のトークナイザー（サーバーと同じもの）
+        out_dir (str): 出力ディレクトリ
+        tokenizer_id (str): トークナイザー（モデル）名（メタデータに記録し、サーバー側で照合する）
+        fingerprint (Optional[str]): データセットの fingerprint
+        batch_size (int): 1度にトークン化する件数
+
+    Returns:
+        dict: メタデータ
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    rows = table.num_rows
+    columns = [c for c in PROMPT_COLUMNS if c in table.column_names]
+    offsets = np.zeros(rows + 1, dtype=np.int64)
+
+    # 完成するまでは一時ファイルに書き、最後に置き換える（途中の状態をサーバーが読まない）
+    tokens_path = os.path.join(out_dir, TOKENS_FILE)
+    start_time = time.perf_counter()
+    with open(tokens_path + ".tmp", "wb") as f:
+        for start in range(0, rows, batch_size):
+            batch = table.slice(start, batch_size).select(columns).to_pylist()
+            blocks = [build_system_block(build_persona_prompt(row)) for row in batch]
+            # 1件ずつ encode した場合と同じトークン列になる（高速トークナイザーでまとめて処理）
+            for i, ids in enumerate(tokenizer(blocks)["input_ids"]):
+                offsets[start + i + 1] = offsets[start + i] + len(ids)
+                f.write(np.asarray(ids, dtype=np.uint32).tobytes())
+            done = min(start + batch_size, rows)
+            if done % (batch_size * 100) == 0 or done == rows:
+                logger.info(f"Tokenized {done} / {rows} persona prompts ({done / (time.perf_counter() - start_time):.0f} rows/s)")
+
+    offsets_path = os.path.join(out_dir, OFFSETS_FILE)
+    offsets.tofile(offsets_path + ".tmp")
+    meta = {
+        "tokenizer": tokenizer_id,
+        "fingerprint": fingerprint,
+        "rows": rows,
+        "tokens": int(offsets[-1]),
+        "template": template_hash(),
+    }
+    meta_path = os.path.join(out_dir, META_FILE)
+    with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+
+    # 置き換えの途中で止まっても古いメタデータと新しい配列を組み合わせないよう、
+    # 先にメタデータを消し、配列を置き換えてから最後にメタデータを置く（メタデータがなければサーバーは使わない）
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    os.replace(tokens_path + ".tmp", tokens_path)
+    os.replace(offsets_path + ".tmp", offsets_path)
+    os.replace(meta_path + ".tmp", meta_path)
+    return meta
+
+class PersonaPromptStore:
+    """
+    トークン化済みのシステムプロンプトを memmap で開き、ペルソナごとに切り出す
+    """
+
+    def __init__(self, out_dir: str):
+        """
+        Args:
+            out_dir (str): build_prompt_store の出力ディレクトリ
+        """
+        with open(os.path.join(out_dir, META_FILE), encoding="utf-8") as f:
+            self.meta = json.load(f)
+        if self.meta.get("template") != template_hash():
+            raise ValueError("Persona prompts were built with a different prompt template")
+        self.tokenizer_id = self.meta["tokenizer"]
+        self.fingerprint = self.meta.get("fingerprint")
+        self.rows = self.meta["rows"]
+        self.tokens = np.memmap(os.path.join(out_dir, TOKENS_FILE), dtype=np.uint32, mode="r")
+        self.offsets = np.fromfile(os.path.join(out_dir, OFFSETS_FILE), dtype=np.int64)
+        if len(self.offsets) != self.rows + 1 or self.offsets[-1] != len(self.tokens):
+            raise ValueError("Persona prompt files are inconsistent")
+
+    def ids(self, row: int) -> List[int]:
+        """ペルソナ row のシステムプロンプト部分のトークンIDを返す"""
+        return self.tokens[self.offsets[row]:self.offsets[row + 1]].tolist()
+
+    def stats(self) -> Dict[str, float]:
+        """保存済みのペルソナ数とトークン数を返す"""
+        return {
+            "rows": self.rows,
+            "tokens": int(self.offsets[-1]),
+            "avg_tokens": round(float(self.offsets[-1]) / self.rows, 1) if self.rows else 0.0,
+            "tokenizer": self.tokenizer_id,
+        }
+
+# =============================================================================
+# オフラインでのトークン化（python persona_prompts.py）
+# =============================================================================
+
+def main():
+    from datasets import load_dataset  # データセット読み込み用
+    from transformers import AutoTokenizer  # Hugging Face transformers
+    from persona_stats import dataset_table  # データセットの Arrow テーブル
+
+    parser = argparse.ArgumentParser(description="全ペルソナのシステムプロンプトをトークン化して保存する")
+    parser.add_argument("--out", default=os.path.expanduser("~/.cache/nemo_chat_app/persona_prompts"), help="出力ディレクトリ")
+    parser.add_argument("--model", default="Qwen/Qwen3-1.7B", help="トークナイザー（サーバーと同じモデルを指定）")
+    parser.add_argument("--dataset", default="nvidia/Nemotron-Personas-Japan", help="ペルソナのデータセット")
+    parser.add_argument("--batch-size", type=int, default=1024, help="1度にトークン化する件数")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    personas = load_dataset(args.dataset, split="train")
+    tokenizer = AutoTokenizer.from_pretrained(args.model, trust_remote_code=True)
+    build_prompt_store(
+        dataset_table(personas),
+        tokenizer,
+        args.out,
+        tokenizer_id=args.model,
+        fingerprint=getattr(personas, "_fingerprint", None),
+        batch_size=args.batch_size,
+    )
+
+if __name__ == "__main__":
+    main()
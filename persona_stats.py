@@ -0,0 +1,171 @@
+# =============================================================================
+# ペルソナデータセットの統計情報（列指向で集計）
+# =============================================================================
+# 100万件のペルソナを1行ずつ Python の dict にして数えると数秒かかるため、
+# データセットの元になっている Arrow テーブルに対して列単位の集計
+# （pyarrow.compute の value_counts など）を行う。
+#
+# 全体の統計は起動時に1度だけ計算し、データセットの fingerprint をキーにした
+# JSONファイル（サイドカー）に保存しておく。次回起動時はそれを読むだけで済む。
+# 条件付きの統計（地域・年齢層などで絞り込み）も同じく列単位で計算する。
+# =============================================================================
+import json  # サイドカーファイルの読み書き用
+import logging  # ログ出力用
+import os  # ファイルパス操作用
+import threading  # 条件付き統計のキャッシュの排他制御用
+from collections import OrderedDict  # 条件付き統計のLRUキャッシュ
+from typing import Dict, Optional
+
+import pyarrow as pa  # 列指向データ
+import pyarrow.compute as pc  # 列単位の集計
+
+logger = logging.getLogger(__name__)
+
+# 完全一致で絞り込める列（データセットに存在する列のみ使用可能）
+FILTER_COLUMNS = ("region", "prefecture", "occupation", "sex")
+
+def dataset_table(dataset) -> pa.Table:
+    """
+    Hugging Face の Dataset から、元データの Arrow テーブルを取り出す
+    （行の並べ替えや絞り込みがされている場合はそれを反映したテーブルにする）
+    """
+    if getattr(dataset, "_indices", None) is not None:
+        dataset = dataset.flatten_indices()
+    table = dataset.data
+    return table.table if hasattr(table, "table") else table
+
+def _value_counts(column: pa.ChunkedArray) -> Dict[str, int]:
+    """列の値ごとの件数を数える（欠損値は「不明」として数える）"""
+    counts = pc.value_counts(column)
+    result = {}
+    for value, count in zip(counts.field("values").to_pylist(), counts.field("counts").to_pylist()):
+        key = "不明" if value is None else value
+        result[key] = result.get(key, 0) + count
+    return result
+
+def compute_stats(table: pa.Table) -> dict:
+    """
+    テーブル全体の統計情報を計算する（/stats のレスポンス形式）
+
+    Args:
+        table (pa.Table): ペルソナのテーブル（絞り込み済みでもよい）
+
+    Returns:
+        dict: 総数、職業TOP10、地域分布、年齢層分布
+    """
+    names = set(table.column_names)
+    occupations = _value_counts(table.column("occupation")) if "occupation" in names else {}
+    regions = _value_counts(table.column("region")) if "region" in names else {}
+
+    # 年齢を年代（20代、30代など）にまとめて数える（欠損・0歳は除外）
+    ages = {}
+    if "age" in names:
+        age = pc.cast(table.column("age"), pa.int64())
+        age = pc.filter(age, pc.greater(age, 0))
+        decades = pc.multiply(pc.divide(age, 10), 10)  # 整数同士の割り算は切り捨て
+        for decade, count in sorted(_value_counts(decades).items()):
+            ages[f"{decade}代"] = count
+
+    return {
+        "total_personas": table.num_rows,  # 総ペルソナ数
+        "top_occupations": sorted(occupations.items(), key=lambda x: x[1], reverse=True)[:10],  # 職業TOP10
+        "regions": dict(sorted(regions.items(), key=lambda x: x[1], reverse=True)),  # 地域分布（多い順）
+        "age_groups": ages  # 年齢層分布（年代順）
+    }
+
+class PersonaStats:
+    """
+    ペルソナデータセットの統計情報を保持し、条件付きの統計も返す
+    """
+
+    def __init__(self, dataset, cache_dir: Optional[str] = None, max_filtered: int = 256):
+        """
+        Args:
+            dataset: Hugging Face の Dataset（ペルソナデータ）
+            cache_dir (Optional[str]): 全体の統計を保存するディレクトリ（None なら保存しない）
+            max_filtered (int): 条件付き統計を何件までキャッシュするか
+        """
+        self.table = dataset_table(dataset)
+        self.fingerprint = getattr(dataset, "_fingerprint", None)
+        self.cache_dir = cache_dir
+        self.max_filtered = max_filtered
+        self.overall: Optional[dict] = None
+        self._filtered: "OrderedDict[tuple, dict]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load_or_compute(self) -> dict:
+        """
+        全体の統計を読み込む（サイドカーファイルがなければ計算して保存する）
+
+        Returns:
+            dict: 全体の統計情報
+        """
+        path = self._sidecar_path()
+        if path and os.path.exists(path):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    self.overall = json.load(f)
+                logger.info(f"Loaded persona stats from {path}")
+                return self.overall
+            except (OSError, ValueError) as e:
+                logger.warning(f"Ignoring unreadable stats cache {path}: {e}")
+
+        self.overall = compute_stats(self.table)
+        if path:
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                with open(path, "w", encoding="utf-8") as f:
+                    json.dump(self.overall, f, ensure_ascii=False)
+            except OSError as e:
+                logger.warning(f"Could not write stats cache {path}: {e}")
+        return self.overall
+
+    def filtered(self, age_min: Optional[int] = None, age_max: Optional[int] = None, **equals) -> dict:
+        """
+        条件に一致するペルソナだけの統計を計算する
+
+        Args:
+            age_min (Optional[int]): 年齢の下限（この値を含む）
+            age_max (Optional[int]): 年齢の上限（この値を含む）
+            **equals: 列名=値 の完全一致条件（region, prefecture, occupation, sex）
+
+        Returns:
+            dict: 条件に一致したペルソナの統計情報
+        """
+        equals = {k: v for k, v in equals.items() if v is not None}
+        key = (age_min, age_max) + tuple(sorted(equals.items()))
+        with self._lock:
+            if key in self._filtered:
+                self._filtered.move_to_end(key)
+                return self._filtered[key]
+
+        mask = None
+        for column, value in equals.items():
+            if column not in FILTER_COLUMNS or column not in self.table.column_names:
+                raise ValueError(f"Unknown filter column: {column}")
+            mask = _and(mask, pc.equal(self.table.column(column), value))
+        if age_min is not None or age_max is not None:
+            age = self.table.column("age")
+            if age_min is not None:
+                mask = _and(mask, pc.greater_equal(age, age_min))
+            if age_max is not None:
+                mask = _and(mask, pc.less_equal(age, age_max))
+
+        table = self.table.filter(mask) if mask is not None else self.table
+        stats = compute_stats(table)
+        with self._lock:
+            self._filtered[key] = stats
+            while len(self._filtered) > self.max_filtered:
+                self._filtered.popitem(last=False)
+        return stats
+
+    def _sidecar_path(self) -> Optional[str]:
+        """データセットの fingerprint をファイル名にしたサイドカーファイルのパス"""
+        if not self.cache_dir or not self.fingerprint:
+            return None
+        return os.path.join(self.cache_dir, f"persona_stats_{self.fingerprint}.json")
+
+def _and(mask, condition):
+    """絞り込み条件を AND で結合する（欠損値は条件不一致として扱う）"""
+    condition = pc.fill_null(condition, False)
+    return condition if mask is None else pc.and_(mask, condition)
@@ -0,0 +1,202 @@
+# =============================================================================
+# ペルソナの列指向ストア（ランダムアクセス用）
+# =============================================================================
+# Hugging Face datasets の personas[i] は、1件取り出すたびに全項目を Python の
+# dict に変換する。チャットで使うのは職業・年齢などの数項目だけなので、
+# ここでは列ごとにファイルを分けて保存し、必要な項目だけを O(1) で読む。
+#
+#   - 文字列の列: {列名}.offsets（int64、行数+1）と {列名}.data（UTF-8 のバイト列）
+#                 行 i の値は data[offsets[i]:offsets[i + 1]]
+#   - 数値の列:   {列名}.values（固定長の配列）
+#   - 欠損値:     {列名}.nulls（欠損がある列のみ、bool の配列）
+#   - meta.json : 行数・データセットの fingerprint・列の種類
+#
+# ファイルはすべて np.memmap で開くので、読んだ部分だけがメモリに載る。
+# サーバー起動時にストアがなければ（またはデータセットが変わっていれば）作成する:
+#   python persona_store.py  # 事前に作成しておく場合
+# =============================================================================
+import argparse  # コマンドライン引数の解析用
+import json  # メタデータの読み書き・文字列以外の値の保存用
+import logging  # ログ出力用
+import os  # ファイルパス操作用
+import shutil  # 作り直す際の古いストアの削除用
+from typing import Dict, Optional, Sequence
+
+import numpy as np  # 列の保存と読み出し
+import pyarrow as pa  # 列指向データ
+import pyarrow.compute as pc  # 欠損値の判定
+
+logger = logging.getLogger(__name__)
+
+META_FILE = "meta.json"
+
+def _column_kind(dtype: pa.DataType) -> str:
+    """Arrow の型を保存形式の種類に対応させる"""
+    if pa.types.is_string(dtype) or pa.types.is_large_string(dtype):
+        return "str"
+    if pa.types.is_integer(dtype) or pa.types.is_floating(dtype) or pa.types.is_boolean(dtype):
+        return "num"
+    return "json"  # リストなどは JSON 文字列として保存する
+
+def build_persona_store(table: pa.Table, out_dir: str, fingerprint: Optional[str] = None) -> dict:
+    """
+    ペルソナのテーブルを列ごとのファイルに書き出す
+
+    一時ディレクトリに書いてから置き換えるので、途中で止まっても壊れたストアは残らない。
+
+    Args:
+        table (pa.Table): ペルソナのテーブル
+        out_dir (str): 出力ディレクトリ
+        fingerprint (Optional[str]): データセットの fingerprint
+
+    Returns:
+        dict: メタデータ
+    """
+    tmp_dir = out_dir.rstrip(os.sep) + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    columns = []
+    for name in table.column_names:
+        column = table.column(name)
+        kind = _column_kind(column.type)
+        has_nulls = column.null_count > 0
+        if has_nulls:
+            pc.is_null(column).to_numpy(zero_copy_only=False).astype(np.bool_).tofile(os.path.join(tmp_dir, f"{name}.nulls"))
+
+        if kind == "num":
+            values = pc.fill_null(column, pa.scalar(0).cast(column.type)) if has_nulls else column
+            array = values.to_numpy()
+            array.tofile(os.path.join(tmp_dir, f"{name}.values"))
+            columns.append({"name": name, "kind": kind, "dtype": array.dtype.str, "nulls": has_nulls})
+            continue
+
+        if kind == "json":
+            column = pa.chunked_array([pa.array([json.dumps(v, ensure_ascii=False) for v in column.to_pylist()], pa.large_string())])
+        # large_string（オフセットが int64）にそろえ、Arrow のバッファをそのまま書き出す
+        array = pc.fill_null(column.cast(pa.large_string()), "").combine_chunks()
+        _, offsets, data = array.buffers()
+        offsets = np.frombuffer(offsets, dtype=np.int64)[array.offset:array.offset + len(array) + 1]
+        data = np.frombuffer(data, dtype=np.uint8) if data is not None else np.empty(0, dtype=np.uint8)
+        (offsets - offsets[0]).tofile(os.path.join(tmp_dir, f"{name}.offsets"))
+        data[offsets[0]:offsets[-1]].tofile(os.path.join(tmp_dir, f"{name}.data"))
+        columns.append({"name": name, "kind": kind, "nulls": has_nulls})
+
+    meta = {"rows": table.num_rows, "fingerprint": fingerprint, "columns": columns}
+    with open(os.path.join(tmp_dir, META_FILE), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.replace(tmp_dir, out_dir)
+    return meta
+
+class _Column:
+    """ストアの1列分（memmap したファイル）"""
+
+    def __init__(self, out_dir: str, info: dict, rows: int):
+        name = info["name"]
+        self.kind = info["kind"]
+        self.nulls = np.memmap(os.path.join(out_dir, f"{name}.nulls"), dtype=np.bool_, mode="r") if info["nulls"] else None
+        if self.kind == "num":
+            self.values = np.memmap(os.path.join(out_dir, f"{name}.values"), dtype=np.dtype(info["dtype"]), mode="r")
+        else:
+            self.offsets = np.memmap(os.path.join(out_dir, f"{name}.offsets"), dtype=np.int64, mode="r")
+            path = os.path.join(out_dir, f"{name}.data")
+            # 空のファイルは memmap できないので空の配列にする
+            self.data = np.memmap(path, dtype=np.uint8, mode="r") if os.path.getsize(path) else np.empty(0, dtype=np.uint8)
+            if len(self.offsets) != rows + 1:
+                raise ValueError(f"Persona store column {name} is inconsistent")
+
+    def get(self, row: int):
+        """行 row の値を返す"""
+        if self.nulls is not None and self.nulls[row]:
+            return None
+        if self.kind == "num":
+            return self.values[row].item()
+        text = self.data[self.offsets[row]:self.offsets[row + 1]].tobytes().decode("utf-8")
+        return json.loads(text) if self.kind == "json" else text
+
+class PersonaStore:
+    """
+    列ごとに保存したペルソナを、必要な項目だけ読み出す
+    """
+
+    def __init__(self, out_dir: str):
+        """
+        Args:
+            out_dir (str): build_persona_store の出力ディレクトリ
+        """
+        with open(os.path.join(out_dir, META_FILE), encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.rows = self.meta["rows"]
+        self.fingerprint = self.meta.get("fingerprint")
+        self.columns = [info["name"] for info in self.meta["columns"]]
+        self._columns: Dict[str, _Column] = {
+            info["name"]: _Column(out_dir, info, self.rows) for info in self.meta["columns"]
+        }
+
+    def get(self, row: int, column: str):
+        """行 row の列 column の値を返す"""
+        return self._columns[column].get(row)
+
+    def row(self, row: int, columns: Optional[Sequence[str]] = None) -> dict:
+        """
+        1行分の指定した列を返す
+
+        Args:
+            row (int): 行番号
+            columns (Optional[Sequence[str]]): 取り出す列名（None なら全列）
+
+        Returns:
+            dict: {列名: 値}
+        """
+        if not 0 <= row < self.rows:
+            raise IndexError(row)
+        return {name: self._columns[name].get(row) for name in (columns or self.columns)}
+
+    def stats(self) -> Dict[str, float]:
+        """行数・列数と、ディスク上のサイズを返す"""
+        nbytes = 0
+        for column in self._columns.values():
+            for array in (column.nulls, getattr(column, "values", None), getattr(column, "offsets", None), getattr(column, "data", None)):
+                nbytes += array.nbytes if array is not None else 0
+        return {"rows": self.rows, "columns": len(self.columns), "bytes": nbytes}
+
+def open_or_build_store(out_dir: str, table: pa.Table, fingerprint: Optional[str] = None) -> PersonaStore:
+    """
+    ストアを開く（なければ、またはデータセットが変わっていれば作り直す）
+
+    Args:
+        out_dir (str): ストアのディレクトリ
+        table (pa.Table): ペルソナのテーブル
+        fingerprint (Optional[str]): データセットの fingerprint
+
+    Returns:
+        PersonaStore: ペルソナのストア
+    """
+    try:
+        store = PersonaStore(out_dir)
+        if store.rows == table.num_rows and store.fingerprint == fingerprint and fingerprint is not None:
+            return store
+        logger.info("Persona store is out of date; rebuilding")
+    except (OSError, ValueError, KeyError) as e:
+        logger.info(f"Building persona store in {out_dir} ({e})")
+    build_persona_store(table, out_dir, fingerprint)
+    return PersonaStore(out_dir)
+
+def main():
+    from datasets import load_dataset  # データセット読み込み用
+    from persona_stats import dataset_table  # データセットの Arrow テーブル
+
+    parser = argparse.ArgumentParser(description="ペルソナを列ごとのファイルに書き出す（ランダムアクセス用）")
+    parser.add_argument("--out", default=os.path.expanduser("~/.cache/nemo_chat_app/persona_store"), help="出力ディレクトリ")
+    parser.add_argument("--dataset", default="nvidia/Nemotron-Personas-Japan", help="ペルソナのデータセット")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    personas = load_dataset(args.dataset, split="train")
+    meta = build_persona_store(dataset_table(personas), args.out, getattr(personas, "_fingerprint", None))
+    logger.info(f"Wrote {meta['rows']} personas ({len(meta['columns'])} columns) to {args.out}")
+
+if __name__ == "__main__":
+    main()
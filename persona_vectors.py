@@ -0,0 +1,359 @@
+# =============================================================================
+# ペルソナ説明文のベクトル検索（似ているペルソナを探す）
+# =============================================================================
+# ペルソナの説明文（persona 列）を言語モデルでベクトル化し、内積（コサイン類似度）が
+# 大きい順に似ているペルソナを返す。
+#
+# 100万件のベクトル化には時間がかかるため、サーバーとは別にオフラインで実行する:
+#   python persona_vectors.py
+# 途中で止めても、もう一度同じコマンドを実行すれば続きから再開する。
+#
+# 出力ディレクトリの中身:
+#   - vectors.f16 : float16 の行列 [ペルソナ数, 次元数]（np.memmap で読む）
+#   - meta.json   : モデル名・推論精度・データセットの fingerprint・処理済み件数など
+#   - ivf.npz     : IVF用のクラスタ中心と、クラスタごとの行番号（既定はペルソナ数の平方根のクラスタ数）
+#
+# サーバーは行列を memmap で開くだけなので、全体をメモリに読み込まない。
+# IVF があれば、クエリに近いクラスタ（nprobe 個）の行だけを計算する。
+# IVF がなければ1回の検索で行列全体（100万件で数GB）を読むため、--ivf-lists 0 は小さなデータ向け。
+# =============================================================================
+import argparse  # コマンドライン引数の解析用
+import json  # メタデータの読み書き用
+import logging  # ログ出力用
+import math  # IVF の既定のクラスタ数（平方根）の計算用
+import os  # ファイルパス操作用
+import time  # 処理速度の計測用
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np  # ベクトルの保存と類似度計算
+import torch  # PyTorch（モデルの実行）
+
+logger = logging.getLogger(__name__)
+
+VECTORS_FILE = "vectors.f16"
+META_FILE = "meta.json"
+IVF_FILE = "ivf.npz"
+
+def embed_texts(model, tokenizer, texts: Sequence[str], max_length: int = 256) -> np.ndarray:
+    """
+    文章をベクトル化する（最終層の隠れ状態をトークン方向に平均し、長さ1に正規化）
+
+    Args:
+        model: Hugging Face の CausalLM（語彙方向の出力層は使わない）
+        tokenizer: 対応するトークナイザー
+        texts (Sequence[str]): ベクトル化する文章
+        max_length (int): 1文章あたりの最大トークン数（超えた分は切り捨て）
+
+    Returns:
+        np.ndarray: float32 のベクトル [len(texts), 次元数]
+    """
+    encoded = [tokenizer.encode(text or "")[:max_length] or [tokenizer.pad_token_id] for text in texts]
+    width = max(len(ids) for ids in encoded)
+
+    # 右詰めパディング（因果的なモデルなので、後ろのパディングは前のトークンに影響しない）
+    input_ids = torch.full((len(encoded), width), tokenizer.pad_token_id, dtype=torch.long)
+    mask = torch.zeros((len(encoded), width), dtype=torch.long)
+    for i, ids in enumerate(encoded):
+        input_ids[i, :len(ids)] = torch.tensor(ids)
+        mask[i, :len(ids)] = 1
+
+    # 出力層（語彙数次元のロジット）は不要なので本体のデコーダだけを実行する
+    decoder = model.get_decoder() if hasattr(model, "get_decoder") else model
+    with torch.inference_mode():
+        output = decoder(input_ids=input_ids.to(model.device), attention_mask=mask.to(model.device))
+        hidden = output.last_hidden_state.float()
+        mask = mask.to(hidden.device).unsqueeze(-1).float()
+        pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1)
+        pooled = torch.nn.functional.normalize(pooled, dim=-1)
+    return pooled.cpu().numpy()
+
+def _read_meta(out_dir: str) -> Optional[dict]:
+    """メタデータを読む（なければ None）"""
+    path = os.path.join(out_dir, META_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def _write_meta(out_dir: str, meta: dict):
+    """メタデータを書く（途中で止まっても壊れないよう、一時ファイルから置き換える）"""
+    path = os.path.join(out_dir, META_FILE)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+
+def build_vectors(
+    texts,
+    model,
+    tokenizer,
+    out_dir: str,
+    model_id: str,
+    fingerprint: Optional[str] = None,
+    precision: Optional[str] = None,
+    batch_size: int = 32,
+    max_length: int = 256,
+    chunk_size: int = 4096,
+) -> dict:
+    """
+    全ペルソナの説明文をベクトル化して保存する（前回の続きから再開できる）
+
+    chunk_size 件ごとに行列をディスクへ書き出し、処理済み件数をメタデータに記録する。
+    モデル・推論精度・データセット・件数・最大トークン数が前回と同じなら、処理済みの分は飛ばす。
+
+    Args:
+        texts: 説明文の列（pyarrow の ChunkedArray、またはリスト）
+        model: Hugging Face の CausalLM
+        tokenizer: 対応するトークナイザー
+        out_dir (str): 出力ディレクトリ
+        model_id (str): モデル名（メタデータに記録し、再開時とサーバー側で照合する）
+        fingerprint (Optional[str]): データセットの fingerprint
+        precision (Optional[str]): モデルの推論精度（"bf16"・"fp32"・"int8"。メタデータに記録し、サーバー側で照合する）
+        batch_size (int): 1回のフォワードでベクトル化する件数
+        max_length (int): 1文章あたりの最大トークン数
+        chunk_size (int): 何件ごとに保存するか
+
+    Returns:
+        dict: メタデータ
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    rows = len(texts)
+    dim = model.config.hidden_size
+    settings = {
+        "model": model_id, "precision": precision, "fingerprint": fingerprint,
+        "rows": rows, "dim": dim, "max_length": max_length,
+    }
+
+    meta = _read_meta(out_dir)
+    path = os.path.join(out_dir, VECTORS_FILE)
+    if meta is not None and all(meta.get(k) == v for k, v in settings.items()) and os.path.exists(path):
+        logger.info(f"Resuming from row {meta['done']} / {rows}")
+        vectors = np.memmap(path, dtype=np.float16, mode="r+", shape=(rows, dim))
+    else:
+        meta = dict(settings, done=0)
+        vectors = np.memmap(path, dtype=np.float16, mode="w+", shape=(rows, dim))
+        # 以前の IVF は古いベクトルに対応しているので削除する
+        if os.path.exists(os.path.join(out_dir, IVF_FILE)):
+            os.remove(os.path.join(out_dir, IVF_FILE))
+        _write_meta(out_dir, meta)
+
+    start_time, start_row = time.perf_counter(), meta["done"]
+    for start in range(meta["done"], rows, chunk_size):
+        end = min(start + chunk_size, rows)
+        chunk = texts.slice(start, end - start).to_pylist() if hasattr(texts, "slice") else list(texts[start:end])
+
+        # 長さの近い文章をまとめてバッチにし、パディングを減らす
+        order = sorted(range(len(chunk)), key=lambda i: len(chunk[i] or ""))
+        for i in range(0, len(order), batch_size):
+            batch = order[i:i + batch_size]
+            embedded = embed_texts(model, tokenizer, [chunk[j] for j in batch], max_length)
+            vectors[[start + j for j in batch]] = embedded.astype(np.float16)
+
+        vectors.flush()
+        meta["done"] = end
+        _write_meta(out_dir, meta)
+        speed = (end - start_row) / (time.perf_counter() - start_time)
+        logger.info(f"Embedded {end} / {rows} personas ({speed:.1f} rows/s)")
+
+    return meta
+
+def build_ivf(out_dir: str, num_lists: int, iterations: int = 10, sample_size: int = 100000, seed: int = 0, chunk_rows: int = 65536):
+    """
+    保存済みのベクトルから IVF（クラスタごとの行番号リスト）を作る
+
+    サンプルに対して球面 k-means（内積が最大のクラスタに割り当てる）を行い、
+    全行をいちばん近いクラスタに割り当てる。
+
+    Args:
+        out_dir (str): build_vectors の出力ディレクトリ
+        num_lists (int): クラスタ数
+        iterations (int): k-means の反復回数
+        sample_size (int): k-means に使う行数
+        seed (int): 乱数シード
+        chunk_rows (int): 割り当て時に1度に読む行数
+    """
+    meta = _read_meta(out_dir)
+    if meta is None or meta["done"] < meta["rows"]:
+        raise ValueError("Vectors are not fully built yet")
+    rows, dim = meta["rows"], meta["dim"]
+    vectors = np.memmap(os.path.join(out_dir, VECTORS_FILE), dtype=np.float16, mode="r", shape=(rows, dim))
+    num_lists = min(num_lists, rows)
+
+    rng = np.random.default_rng(seed)
+    sample = np.sort(rng.choice(rows, size=min(sample_size, rows), replace=False))
+    sample = np.asarray(vectors[sample], dtype=np.float32)
+    centroids = sample[rng.choice(len(sample), size=num_lists, replace=False)]
+    for _ in range(iterations):
+        assign = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, sample)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        # 空になったクラスタは前回の中心をそのまま使う
+        centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids)
+
+    assign = np.empty(rows, dtype=np.int32)
+    for start in range(0, rows, chunk_rows):
+        block = np.asarray(vectors[start:start + chunk_rows], dtype=np.float32)
+        assign[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+
+    order = np.argsort(assign, kind="stable").astype(np.int32)
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=num_lists))])
+    np.savez(os.path.join(out_dir, IVF_FILE), centroids=centroids.astype(np.float32), order=order, offsets=offsets)
+    logger.info(f"Built IVF with {num_lists} lists over {rows} vectors")
+
+class PersonaVectors:
+    """
+    保存済みのペルソナベクトルを memmap で開き、似ているペルソナを検索する
+    """
+
+    def __init__(self, out_dir: str, nprobe: int = 16, chunk_rows: int = 16384):
+        """
+        Args:
+            out_dir (str): build_vectors の出力ディレクトリ
+            nprobe (int): IVF がある場合に調べるクラスタ数
+            chunk_rows (int): 1度に類似度を計算する行数（メモリ使用量の上限になる）
+        """
+        meta = _read_meta(out_dir)
+        if meta is None:
+            raise ValueError(f"No persona vectors in {out_dir}")
+        if meta["done"] < meta["rows"]:
+            raise ValueError(f"Persona vectors are incomplete ({meta['done']} / {meta['rows']})")
+        self.meta = meta
+        self.model_id = meta["model"]
+        self.precision = meta.get("precision")  # 記録のない古いベクトルは None
+        self.fingerprint = meta.get("fingerprint")
+        self.rows, self.dim = meta["rows"], meta["dim"]
+        self.max_length = meta["max_length"]
+        self.nprobe = nprobe
+        self.chunk_rows = chunk_rows
+        self.vectors = np.memmap(os.path.join(out_dir, VECTORS_FILE), dtype=np.float16, mode="r", shape=(self.rows, self.dim))
+
+        self._centroids = None
+        ivf_path = os.path.join(out_dir, IVF_FILE)
+        if os.path.exists(ivf_path):
+            with np.load(ivf_path) as ivf:
+                self._centroids = ivf["centroids"]
+                self._order = ivf["order"]
+                self._offsets = ivf["offsets"]
+
+    def vector(self, row: int) -> np.ndarray:
+        """保存済みのベクトル（float32）を返す"""
+        return np.asarray(self.vectors[row], dtype=np.float32)
+
+    def search(self, query: np.ndarray, k: int = 10, exclude: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        クエリとの内積が大きい順に k 件の行番号とスコアを返す
+
+        Args:
+            query (np.ndarray): クエリのベクトル（長さ1に正規化済み）
+            k (int): 返す件数
+            exclude (Optional[int]): 結果から除く行番号（検索元のペルソナ自身など）
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: 行番号とスコア（スコアの降順）
+        """
+        query = np.asarray(query, dtype=np.float32)
+        best_rows: List[np.ndarray] = []
+        best_scores: List[np.ndarray] = []
+
+        for rows, block in self._blocks(query):
+            scores = block @ query
+            if exclude is not None:
+                scores[rows == exclude] = -np.inf
+            # ブロックごとに上位 k 件だけを残す
+            if len(scores) > k:
+                top = np.argpartition(-scores, k)[:k]
+                rows, scores = rows[top], scores[top]
+            best_rows.append(rows)
+            best_scores.append(scores)
+
+        if not best_rows:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        rows, scores = np.concatenate(best_rows), np.concatenate(best_scores)
+        top = np.argsort(-scores, kind="stable")[:k]
+        top = top[np.isfinite(scores[top])]
+        return rows[top], scores[top]
+
+    def stats(self) -> Dict[str, float]:
+        """ベクトルの件数と検索方法を返す"""
+        return {
+            "rows": self.rows,
+            "dim": self.dim,
+            "model": self.model_id,
+            "precision": self.precision,
+            "ivf_lists": len(self._centroids) if self._centroids is not None else 0,
+            "nprobe": self.nprobe,
+        }
+
+    def _blocks(self, query: np.ndarray):
+        """類似度を計算する (行番号, float32 のベクトル) を chunk_rows 件ずつ返す"""
+        if self._centroids is None:
+            # IVF がなければ全行を順番に読む
+            for start in range(0, self.rows, self.chunk_rows):
+                end = min(start + self.chunk_rows, self.rows)
+                yield np.arange(start, end), np.asarray(self.vectors[start:end], dtype=np.float32)
+            return
+
+        # クエリに近いクラスタの行だけを読む（行番号順に読むとディスクの読み込みが連続になる）
+        probe = np.argsort(-(self._centroids @ query))[:self.nprobe]
+        candidates = np.sort(np.concatenate([self._order[self._offsets[c]:self._offsets[c + 1]] for c in probe]))
+        for start in range(0, len(candidates), self.chunk_rows):
+            rows = candidates[start:start + self.chunk_rows]
+            yield rows, np.asarray(self.vectors[rows], dtype=np.float32)
+
+# =============================================================================
+# オフラインでのベクトル化（python persona_vectors.py）
+# =============================================================================
+
+def main():
+    from datasets import load_dataset  # データセット読み込み用
+    from transformers import AutoTokenizer, AutoModelForCausalLM  # Hugging Face transformers
+    from persona_stats import dataset_table  # データセットの Arrow テーブル
+    from precision import PRECISIONS, apply_precision, load_options  # 推論精度（サーバーと同じ処理）
+
+    parser = argparse.ArgumentParser(description="ペルソナ説明文をベクトル化して保存する（中断しても再開可能）")
+    parser.add_argument("--out", default=os.path.expanduser("~/.cache/nemo_chat_app/persona_vectors"), help="出力ディレクトリ")
+    parser.add_argument("--model", default="Qwen/Qwen3-1.7B", help="ベクトル化に使うモデル（サーバーと同じモデルを指定）")
+    parser.add_argument("--precision", default="bf16", choices=PRECISIONS, help="推論精度（サーバーの NEMO_PRECISION と同じ値を指定）")
+    parser.add_argument("--dataset", default="nvidia/Nemotron-Personas-Japan", help="ペルソナのデータセット")
+    parser.add_argument("--batch-size", type=int, default=32, help="1回のフォワードでベクトル化する件数")
+    parser.add_argument("--max-length", type=int, default=256, help="1文章あたりの最大トークン数")
+    parser.add_argument("--chunk-size", type=int, default=4096, help="何件ごとに保存するか（再開の単位）")
+    parser.add_argument("--ivf-lists", type=int, default=-1, help="IVF のクラスタ数（-1でペルソナ数の平方根、0で作らない）")
+    parser.add_argument("--ivf-iterations", type=int, default=10, help="IVF の k-means の反復回数")
+    parser.add_argument("--threads", type=int, default=0, help="PyTorch のスレッド数（0で既定値）")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    personas = load_dataset(args.dataset, split="train")
+    tokenizer = AutoTokenizer.from_pretrained(args.model, trust_remote_code=True)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    model = AutoModelForCausalLM.from_pretrained(
+        args.model,
+        **load_options(args.precision),  # サーバーと同じ精度でベクトル化する
+        trust_remote_code=True
+    )
+    model = apply_precision(model, args.precision)
+    model.eval()
+
+    build_vectors(
+        dataset_table(personas).column("persona"),
+        model,
+        tokenizer,
+        args.out,
+        model_id=args.model,
+        fingerprint=getattr(personas, "_fingerprint", None),
+        precision=args.precision,
+        batch_size=args.batch_size,
+        max_length=args.max_length,
+        chunk_size=args.chunk_size,
+    )
+    ivf_lists = round(math.sqrt(len(personas))) if args.ivf_lists < 0 else args.ivf_lists
+    if ivf_lists > 0:
+        build_ivf(args.out, ivf_lists, iterations=args.ivf_iterations)
+
+if __name__ == "__main__":
+    main()
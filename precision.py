@@ -0,0 +1,89 @@
+# =============================================================================
+# 推論精度（bf16 / fp32 / int8）の切り替え
+# =============================================================================
+# bfloat16 は GPU や AMX・AVX512-BF16 のある CPU では速いが、それ以外の多くの
+# x86 CPU では行列積が遅く、fp32 より遅くなることもある。起動時の設定で
+# 次のどれかを選べるようにする:
+#   - bf16: bfloat16 で読み込む（GPU があれば device_map="auto" で配置。従来の動作）
+#   - fp32: float32 で読み込む（CPU での互換性重視の選択肢）
+#   - int8: float32 で読み込んでから、デコーダ層の Linear を動的量子化する（CPU のみ）
+#           重みは int8 で保持し、活性は推論時に量子化する。lm_head は精度のため fp32 のまま
+#
+# 精度ごとのメモリ・速度・出力の差は benchmarks/precision_report.py で比べられる。
+# =============================================================================
+import logging  # ログ出力用
+from typing import Any, Dict
+
+import torch  # PyTorch（dtype の変換・動的量子化）
+
+logger = logging.getLogger(__name__)
+
+PRECISIONS = ("bf16", "fp32", "int8")
+
+def check_precision(precision: str):
+    """対応していない精度なら ValueError を投げる"""
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision!r} (choose from {', '.join(PRECISIONS)})")
+
+def load_options(precision: str) -> Dict[str, Any]:
+    """
+    from_pretrained に渡す dtype と配置の指定を返す
+
+    Args:
+        precision (str): "bf16"・"fp32"・"int8" のいずれか
+
+    Returns:
+        Dict[str, Any]: torch_dtype と device_map
+    """
+    check_precision(precision)
+    if precision == "bf16":
+        return {"torch_dtype": torch.bfloat16, "device_map": "auto"}
+    # 動的量子化は CPU のカーネルしかないので、int8 は CPU に読み込む
+    return {"torch_dtype": torch.float32, "device_map": "auto" if precision == "fp32" else None}
+
+def apply_precision(model, precision: str):
+    """
+    読み込んだモデルを指定の精度にする（int8 ならデコーダ層の Linear を動的量子化する）
+
+    Args:
+        model: Hugging Face の CausalLM（load_options の指定で読み込んだもの）
+        precision (str): "bf16"・"fp32"・"int8" のいずれか
+
+    Returns:
+        モデル（int8 の場合は量子化済み。その場で書き換える）
+    """
+    check_precision(precision)
+    if precision == "bf16":
+        return model.to(torch.bfloat16)
+    model = model.float()
+    if precision == "int8":
+        from torch.ao.quantization import quantize_dynamic  # 動的量子化（CPU）
+
+        # lm_head（語彙数×隠れ層の大きな行列）は出力の分布への影響が大きいので量子化しない
+        quantize_dynamic(model.model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        logger.info(f"Quantized decoder linear layers to int8 (engine: {torch.backends.quantized.engine})")
+    return model
+
+def model_bytes(model) -> int:
+    """
+    モデルの重み・バッファのバイト数を返す（量子化済みの重みや、共有している重みも正しく数える）
+
+    Args:
+        model: PyTorch のモジュール
+
+    Returns:
+        int: バイト数
+    """
+    total = 0
+    seen = set()
+    for value in model.state_dict().values():
+        # 量子化した Linear の重みは (weight, bias) のタプルとして入っている
+        for tensor in (value if isinstance(value, tuple) else (value,)):
+            if not isinstance(tensor, torch.Tensor):
+                continue
+            key = (tensor.data_ptr(), tensor.nelement())
+            if key in seen:
+                continue
+            seen.add(key)
+            total += tensor.nelement() * tensor.element_size()
+    return total
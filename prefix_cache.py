@@ -0,0 +1,104 @@
+# =============================================================================
+# システムプロンプトのKVプレフィックスキャッシュ
+# =============================================================================
+# 同じペルソナのシステムプロンプトは、どのユーザーのどのターンでも同じ内容になる。
+# その部分の prefill 結果（past_key_values）を保存しておき、次回からは
+# 続きの会話部分だけを prefill する。
+#
+# 容量はバイト数で制限し、超えた場合は最も長く使われていないものから捨てる（LRU）。
+# =============================================================================
+import threading  # 推論スレッドと統計取得の排他制御用
+from collections import OrderedDict  # LRU管理用
+from typing import Dict, Hashable, Optional, Sequence, Tuple
+
+from scheduler import KVTensors  # レイヤーごとの (key, value) テンソル
+
+def kv_nbytes(kv: KVTensors) -> int:
+    """KVキャッシュが使用しているメモリ量（バイト）を返す"""
+    return sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in kv)
+
+class PrefixCache:
+    """
+    プレフィックス（トークン列）ごとに計算済みのKVキャッシュを保持するLRUキャッシュ
+
+    保存したテンソルは読み出し側で書き換えない前提（DynamicCache は追記時に
+    新しいテンソルを作るので、そのまま past_key_values の元データとして使える）。
+    """
+
+    def __init__(self, max_bytes: int):
+        """
+        Args:
+            max_bytes (int): キャッシュ全体で使ってよい最大バイト数（0で無効）
+        """
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Hashable, Tuple[Tuple[int, ...], KVTensors, int]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        # 統計情報
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, token_ids: Sequence[int]) -> Optional[KVTensors]:
+        """
+        キャッシュ済みのKVを取得する
+
+        Args:
+            key (Hashable): キャッシュのキー（ペルソナ番号など）
+            token_ids (Sequence[int]): プレフィックスのトークンID（保存時と一致する場合のみヒット）
+
+        Returns:
+            Optional[KVTensors]: 見つかればKVキャッシュ、なければ None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != tuple(token_ids):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: Hashable, token_ids: Sequence[int], kv: KVTensors):
+        """
+        KVを保存する（容量を超える場合は古いものから削除）
+
+        Args:
+            key (Hashable): キャッシュのキー
+            token_ids (Sequence[int]): プレフィックスのトークンID
+            kv (KVTensors): プレフィックスを prefill して得たKVキャッシュ
+        """
+        nbytes = kv_nbytes(kv)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            while self._entries and self._bytes + nbytes > self.max_bytes:
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+                self.evictions += 1
+            self._entries[key] = (tuple(token_ids), kv, nbytes)
+            self._bytes += nbytes
+
+    def clear(self):
+        """キャッシュを空にする"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, float]:
+        """キャッシュの使用状況とヒット率を返す"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
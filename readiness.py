@@ -0,0 +1,115 @@
+# =============================================================================
+# 起動処理の進み具合（liveness / readiness）
+# =============================================================================
+# データセットとモデルの読み込みはサーバー起動後にバックグラウンドで並行して行う。
+# その間もサーバーはリクエストに応答できる（liveness）が、チャットなどに必要な
+# 部品がそろうまでは ready ではない（readiness）。
+#
+# 部品（データセット、モデル、スケジューラなど）ごとに
+#   pending → loading → ready / failed
+# の状態と所要時間を記録し、/health で返す。
+# =============================================================================
+import threading  # 読み込みスレッドと /health の排他制御用
+import time  # 所要時間の計測用
+from contextlib import contextmanager  # 状態を記録する with ブロック
+from typing import Dict, Iterator, Optional, Sequence
+
+class ReadinessTracker:
+    """
+    起動時に読み込む部品ごとの状態と所要時間を記録する
+    """
+
+    def __init__(self, components: Sequence[str], required: Sequence[str]):
+        """
+        Args:
+            components (Sequence[str]): 読み込む部品の名前（表示順）
+            required (Sequence[str]): ready になるために必要な部品
+        """
+        self.required = tuple(required)
+        self.started_at = time.monotonic()
+        self._components: Dict[str, dict] = {
+            name: {"state": "pending", "seconds": None, "error": None} for name in components
+        }
+        self._started: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def track(self, name: str) -> Iterator[None]:
+        """
+        with ブロックの間を部品 name の読み込みとして記録する
+        （例外が出たら failed にして、そのまま送出する）
+        """
+        with self._lock:
+            self._components[name]["state"] = "loading"
+            self._started[name] = time.monotonic()
+        try:
+            yield
+        except BaseException as e:
+            self._set(name, "failed", error=str(e) or type(e).__name__)
+            raise
+        self._set(name, "ready")
+
+    def skip(self, name: str, reason: str):
+        """読み込まない部品を記録する（設定で無効にした場合など）"""
+        with self._lock:
+            self._components[name].update(state="skipped", error=reason)
+
+    def progress(self, name: str, **info):
+        """部品の読み込み状況（件数など）を追加で記録する"""
+        with self._lock:
+            self._components[name].update(info)
+
+    def state(self, name: str) -> str:
+        """部品の状態（pending / loading / ready / failed / skipped）"""
+        with self._lock:
+            return self._components[name]["state"]
+
+    def is_loading(self, name: str) -> bool:
+        """部品がまだ読み込み前か読み込み中か"""
+        return self.state(name) in ("pending", "loading")
+
+    @property
+    def ready(self) -> bool:
+        """必要な部品がすべて ready か（設定で無効にした部品は skipped でもよい）"""
+        with self._lock:
+            return self._all_ready()
+
+    @property
+    def failed(self) -> Optional[str]:
+        """必要な部品のうち失敗したもののエラー（なければ None）"""
+        with self._lock:
+            errors = [
+                f"{name}: {self._components[name]['error']}"
+                for name in self.required
+                if self._components[name]["state"] == "failed"
+            ]
+        return "; ".join(errors) or None
+
+    def stats(self) -> dict:
+        """部品ごとの状態と所要時間（読み込み中なら経過時間）を返す"""
+        now = time.monotonic()
+        with self._lock:
+            components = {}
+            for name, info in self._components.items():
+                info = dict(info)
+                if info["state"] == "loading":
+                    info["seconds"] = round(now - self._started[name], 3)
+                components[name] = info
+            return {
+                "ready": self._all_ready(),
+                "uptime_seconds": round(now - self.started_at, 3),
+                "components": components,
+            }
+
+    def _all_ready(self) -> bool:
+        """（ロックを取った状態で）必要な部品がすべて ready または skipped か"""
+        return all(self._components[name]["state"] in ("ready", "skipped") for name in self.required)
+
+    def _set(self, name: str, state: str, error: Optional[str] = None):
+        """部品の最終状態と所要時間を記録する"""
+        with self._lock:
+            self._components[name].update(
+                state=state,
+                seconds=round(time.monotonic() - self._started[name], 3),
+                error=error,
+            )
@@ -0,0 +1,144 @@
+# =============================================================================
+# 決定的な生成の応答キャッシュ
+# =============================================================================
+# 同じペルソナへの同じあいさつ（「自己紹介をお願いします。」など）は、
+# temperature 0（グリーディ）またはシード指定なら毎回同じ返答になるのに、
+# そのたびに生成のコストがかかる。
+#
+# ここでは (モデル名, ペルソナ番号, 正規化した会話履歴, 生成パラメータ) のハッシュを
+# キーにして返答を保存し、同じリクエストには生成せずに返す。
+#   - 決定的なリクエスト（temperature <= 0 またはシード指定）だけを対象にする
+#   - 件数とバイト数の上限を超えたら最も古く使われたものから削除する（LRU）
+#   - 保存してから ttl_seconds を過ぎたものは使わない
+# =============================================================================
+import dataclasses  # 生成パラメータを dict にする用
+import hashlib  # キーのハッシュ計算用
+import json  # キー・値の直列化用
+import threading  # 同時アクセスの排他制御用
+import time  # 有効期限の判定用
+import unicodedata  # 会話履歴の正規化用
+from collections import OrderedDict  # LRU の順序管理
+from typing import Any, Dict, Hashable, Optional, Sequence, Tuple
+
+def is_deterministic(params) -> bool:
+    """生成パラメータで毎回同じ結果になるか（グリーディまたはシード指定）"""
+    return params.temperature <= 0 or params.seed is not None
+
+def cache_key(
+    model_id: str,
+    persona_index: int,
+    messages: Sequence[Tuple[str, str]],
+    params,
+    namespace: str = "",
+    options: Optional[Dict[str, Any]] = None,
+) -> str:
+    """
+    応答キャッシュのキーを作る
+
+    会話履歴は Unicode 正規化（NFC）と前後の空白の除去をしてから使う。
+    グリーディの場合は結果に影響しない temperature・top_p・top_k・seed をキーに含めない。
+
+    Args:
+        model_id (str): モデル名
+        persona_index (int): ペルソナのインデックス
+        messages (Sequence[Tuple[str, str]]): (role, content) の会話履歴
+        params (GenerationParams): 生成パラメータ
+        namespace (str): 返す値の形式が異なる呼び出し元を区別する名前（"chat" など）
+        options (Optional[Dict[str, Any]]): プロンプトの組み立てに影響するその他の設定（思考モードの有無など）
+
+    Returns:
+        str: SHA-256 の16進文字列
+    """
+    sampling = dataclasses.asdict(params)
+    if params.temperature <= 0:
+        sampling.update(temperature=0, top_p=None, top_k=None, seed=None)
+    payload = {
+        "namespace": namespace,
+        "model": model_id,
+        "persona": persona_index,
+        "messages": [[role, unicodedata.normalize("NFC", content).strip()] for role, content in messages],
+        "params": sampling,
+        "options": options or {},
+    }
+    encoded = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """
+    キーごとに返答を保存するキャッシュ（LRU・件数とバイト数の上限・有効期限）
+    """
+
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 64 * 1024 * 1024, ttl_seconds: float = 3600.0):
+        """
+        Args:
+            max_entries (int): 保存する最大件数
+            max_bytes (int): 保存する値の合計サイズの上限（JSON にした場合のバイト数）
+            ttl_seconds (float): 保存してから使える秒数（0以下なら期限なし）
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[Hashable, Tuple[Any, int, float]]" = OrderedDict()  # キー → (値, バイト数, 保存時刻)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.skipped = 0  # 決定的でないためキャッシュを使わなかったリクエスト数
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """キーに対応する値を返す（なければ・期限切れなら None）"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl_seconds > 0 and time.monotonic() - entry[2] > self.ttl_seconds:
+                self._remove(key)
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any):
+        """値を保存し、上限を超えた分を古いものから削除する（1件で上限を超える値は保存しない）"""
+        nbytes = len(json.dumps(value, ensure_ascii=False).encode("utf-8"))
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, nbytes, time.monotonic())
+            self._bytes += nbytes
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def skip(self):
+        """決定的でないリクエストを記録する（統計用）"""
+        with self._lock:
+            self.skipped += 1
+
+    def _remove(self, key: Hashable):
+        _, nbytes, _ = self._entries.pop(key)
+        self._bytes -= nbytes
+
+    def stats(self) -> Dict[str, float]:
+        """件数・サイズ・ヒット率などを返す"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "expired": self.expired,
+                "evictions": self.evictions,
+                "skipped": self.skipped,
+            }
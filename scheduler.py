@@ -0,0 +1,774 @@
+# =============================================================================
+# 連続バッチング（Continuous Batching）生成スケジューラ
+# =============================================================================
+# 複数の /chat リクエストを1つのバッチにまとめ、1トークンずつ同時にデコードする。
+# 新しいシーケンスはトークン単位で随時バッチに参加し、終了したシーケンスは
+# その場でバッチから外れる（リクエスト単位で待ち合わせない）。
+#
+# モデルの計算はイベントループとは別の専用スレッド（推論エグゼキュータ）で行うため、
+# 生成中でも /health などの軽いエンドポイントは待たされない。
+#
+# モデルは Hugging Face の CausalLM であれば何でもよく、Qwen3-1.7B の代わりに
+# ローカルで構築した小さなモデルを渡して動作確認できる。
+#
+# 下書きモデル（SpeculativeDecoder）を渡すと、バッチが1シーケンスだけで待っている
+# リクエストもないときは推測デコードで1回のフォワードで複数トークン進める。
+# =============================================================================
+import asyncio  # 非同期キューとFuture
+import logging  # ログ出力用
+import time  # スループット計測用
+from concurrent.futures import ThreadPoolExecutor  # 推論専用スレッド
+from dataclasses import dataclass, field, replace
+from typing import AsyncIterator, Callable, Dict, Hashable, List, Optional, Sequence, Set, Tuple
+
+import torch  # PyTorch
+from transformers import DynamicCache  # KVキャッシュ
+
+from logits_processors import RepetitionProcessor, SequenceRepetition, warp_scores  # 繰り返しの制御（差分更新）・temperature / top_k / top_p
+from speculative import SpeculativeDecoder  # 推測デコード（下書きモデル）
+
+logger = logging.getLogger(__name__)
+
+# レイヤーごとの (key, value) テンソルの組。形状は [batch, heads, seq_len, head_dim]
+KVTensors = Tuple[Tuple[torch.Tensor, torch.Tensor], ...]
+
+# =============================================================================
+# KVキャッシュ操作ヘルパー
+# =============================================================================
+
+def cache_to_tensors(cache) -> KVTensors:
+    """
+    モデルが返したKVキャッシュを (key, value) テンソルのタプルに変換する
+
+    Args:
+        cache: DynamicCache またはレガシー形式のタプル
+
+    Returns:
+        KVTensors: レイヤーごとの (key, value)
+    """
+    if hasattr(cache, "layers"):
+        return tuple((layer.keys, layer.values) for layer in cache.layers)
+    if hasattr(cache, "to_legacy_cache"):
+        return cache.to_legacy_cache()
+    return tuple(cache)
+
+def tensors_to_cache(kv: KVTensors):
+    """
+    (key, value) テンソルのタプルからモデルに渡せるKVキャッシュを作る
+
+    Args:
+        kv (KVTensors): レイヤーごとの (key, value)
+
+    Returns:
+        DynamicCache: モデルの past_key_values に渡すキャッシュ
+    """
+    if hasattr(DynamicCache, "from_legacy_cache"):
+        return DynamicCache.from_legacy_cache(kv)
+    return DynamicCache(kv)
+
+def kv_length(kv: KVTensors) -> int:
+    """KVキャッシュに入っているトークン数を返す"""
+    return kv[0][0].shape[-2] if kv else 0
+
+def _left_pad(kv: KVTensors, pad: int) -> KVTensors:
+    """KVキャッシュの系列方向の先頭に pad 個のゼロを詰める"""
+    if pad <= 0:
+        return kv
+    padded = []
+    for k, v in kv:
+        k_pad = k.new_zeros(k.shape[:-2] + (pad, k.shape[-1]))
+        v_pad = v.new_zeros(v.shape[:-2] + (pad, v.shape[-1]))
+        padded.append((torch.cat([k_pad, k], dim=-2), torch.cat([v_pad, v], dim=-2)))
+    return tuple(padded)
+
+# =============================================================================
+# データ構造
+# =============================================================================
+
+DEFAULT_TOP_K = 50  # generation_config に top_k がない場合の値（model.generate の既定値と同じ）
+
+@dataclass
+class GenerationParams:
+    """
+    1シーケンス分の生成パラメータ
+    バッチ内のシーケンスごとに異なる値を持てる
+    """
+    max_new_tokens: int = 150  # 生成する最大トークン数
+    temperature: float = 0.8  # 0以下ならグリーディ（最尤）デコード
+    top_p: float = 0.9  # nucleus sampling の閾値
+    top_k: Optional[int] = None  # 確率の上位 k 語彙に絞る（0で絞らない、None ならモデルの generation_config の値）
+    repetition_penalty: float = 1.1  # 同じトークンの繰り返しを抑制
+    no_repeat_ngram_size: int = 2  # このサイズのn-gramの繰り返しを禁止（0で無効）
+    seed: Optional[int] = None  # サンプリングの乱数のシード（指定するとバッチの組み合わせによらず同じ乱数列になる）
+    thinking_budget: Optional[int] = None  # 思考ブロック（<think>...</think>）のトークン数の上限（超えたら </think> で閉じる）
+
+@dataclass
+class GenerationResult:
+    """
+    1シーケンス分の生成結果
+    """
+    token_ids: List[int]  # 新しく生成されたトークンID（プロンプトは含まない）
+    finish_reason: str  # "stop"（終了トークン）または "length"（上限到達）
+    prompt_tokens: int  # プロンプトのトークン数
+    cache: Optional[KVTensors] = None  # return_cache 指定時、プロンプト＋生成トークン（最後の1つを除く）のKV
+    timings: Dict[str, float] = field(default_factory=dict)  # 段階別の所要時間（秒）: queue, prefill, decode, ttft
+    draft_tokens: int = 0  # 推測デコードで下書きモデルが提案したトークン数
+    accepted_draft_tokens: int = 0  # そのうち採用されたトークン数
+
+@dataclass
+class _Sequence:
+    """スケジューラ内部で管理する生成中のシーケンス"""
+    prompt_ids: List[int]
+    params: GenerationParams
+    future: asyncio.Future
+    generated: List[int] = field(default_factory=list)
+    next_token: Optional[int] = None  # サンプリング済みでまだモデルに入力していないトークン
+    finish_reason: Optional[str] = None
+    tokens: Optional[asyncio.Queue] = None  # ストリーミング時に生成トークンを1つずつ流すキュー
+    prefix_key: Optional[Hashable] = None  # プレフィックスキャッシュのキー
+    prefix_len: int = 0  # prompt_ids のうちプレフィックスキャッシュの対象になる先頭トークン数
+    past: Optional[KVTensors] = None  # 呼び出し側が持っている計算済みKV（prompt_ids の先頭部分）
+    return_cache: bool = False  # 終了時にこのシーケンスのKVを結果に含めるかどうか
+    cache: Optional[KVTensors] = None
+    enqueued_at: float = field(default_factory=time.perf_counter)  # キューに入れた時刻
+    prefill_started_at: Optional[float] = None  # prefill を始めた時刻
+    first_token_at: Optional[float] = None  # 最初のトークンが得られた時刻
+    generator: Optional[torch.Generator] = None  # シード指定時のこのシーケンス専用の乱数生成器
+    repetition: Optional[SequenceRepetition] = None  # 繰り返しの制御の状態（prefill 時に作る）
+    thinking: Optional[int] = None  # 思考ブロック内で生成したトークン数（思考ブロックの外なら None）
+    forced: List[int] = field(default_factory=list)  # サンプリング結果の代わりに出力するトークン（思考の打ち切り用）
+    draft_tokens: int = 0  # 推測デコードで提案されたトークン数
+    accepted_draft_tokens: int = 0  # そのうち採用されたトークン数
+
+    @property
+    def all_ids(self) -> List[int]:
+        return self.prompt_ids + self.generated
+
+# =============================================================================
+# スケジューラ本体
+# =============================================================================
+
+class GenerationScheduler:
+    """
+    非同期キューからリクエストを取り出し、バッチでデコードするスケジューラ
+
+    - 各ステップで空きスロットがあれば待機中のシーケンスを prefill して合流させる
+    - バッチ全体を1回のフォワードで1トークン進める
+    - 終了トークンまたは max_new_tokens に達したシーケンスは即座に外す
+    """
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        max_batch_size: int = 8,
+        num_threads: int = 0,
+        prefix_cache=None,
+        metrics=None,
+        speculative: Optional[SpeculativeDecoder] = None,
+    ):
+        """
+        Args:
+            model: Hugging Face の CausalLM
+            tokenizer: 対応するトークナイザー（終了・パディングトークンの取得に使用）
+            max_batch_size (int): 同時に生成できるシーケンス数（生成スロット数）
+            num_threads (int): PyTorch のスレッド数（0ならPyTorchの既定値）。torch.set_num_threads は
+                プロセス全体の設定なので、同じプロセスの他の PyTorch の処理（埋め込みなど）にも効く
+            prefix_cache (PrefixCache): システムプロンプトのKVキャッシュ（None で無効）
+            metrics (ServingMetrics): 生成ごとのトークン数・TTFTなどの記録先（None で記録しない）
+            speculative (SpeculativeDecoder): 推測デコードの下書きモデル（None なら常に通常のデコード）
+        """
+        self.model = model
+        self.speculative = speculative
+        self.max_batch_size = max_batch_size
+        self.num_threads = num_threads
+        self.prefix_cache = prefix_cache
+        self.metrics = metrics
+        self.pad_token_id = tokenizer.pad_token_id
+
+        self.eos_token_ids = eos_token_ids(model, tokenizer)
+        # top_k を指定しないリクエストはモデルの generation_config の値を使う（model.generate と同じ分布にする）
+        top_k = getattr(getattr(model, "generation_config", None), "top_k", None)
+        self.default_top_k = DEFAULT_TOP_K if top_k is None else int(top_k)
+
+        # 思考ブロックのタグ（語彙に1トークンとしてない場合は thinking_budget で打ち切らない）
+        self.think_start_id = _single_token_id(tokenizer, "<think>")
+        think_end_id = _single_token_id(tokenizer, "</think>")
+        if self.think_start_id is None or think_end_id is None:
+            self.think_start_id = None
+        self.think_end_ids = [think_end_id] + tokenizer.encode("\n\n") if self.think_start_id is not None else []
+
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # モデルの計算はすべてこの1本のスレッドで行う（バッチ状態はこのスレッドだけが触る）
+        self._executor = ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix="inference",
+            initializer=self._init_worker,
+        )
+
+        # バッチの状態（左詰めパディングで系列長をそろえる）
+        self._rows: List[_Sequence] = []
+        self._kv: KVTensors = ()
+        self._mask: Optional[torch.Tensor] = None  # [batch, seq_len] 有効位置が1
+        self._repetition = RepetitionProcessor()  # 行ごとの既出トークン・n-gram（バッチと同じ並び）
+
+        # 統計情報
+        self._generated_tokens = 0
+        self._busy_seconds = 0.0
+        self._steps = 0
+        self._completed = 0
+        self._cancelled = 0  # 生成の途中（または開始前）に取り消されたリクエスト数
+        self._thinking_truncated = 0  # thinking_budget で思考を打ち切った回数
+        self._prefill_tokens = 0  # 実際に prefill したトークン数
+        self._reused_tokens = 0  # プレフィックスキャッシュで prefill を省略したトークン数
+
+    # -------------------------------------------------------------------------
+    # 公開API
+    # -------------------------------------------------------------------------
+
+    def start(self):
+        """イベントループ上でスケジューラのループを開始する"""
+        if self._task is None:
+            self._loop = asyncio.get_running_loop()
+            self._task = self._loop.create_task(self._run())
+
+    async def stop(self):
+        """スケジューラのループを停止し、未完了のリクエストを失敗させる"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._executor.shutdown(wait=True)
+        error = RuntimeError("Scheduler stopped")
+        self._fail_all(error)
+        while not self._queue.empty():
+            _resolve(self._queue.get_nowait(), error, None)
+
+    async def generate(
+        self,
+        prompt_ids: Sequence[int],
+        params: GenerationParams,
+        prefix_key: Optional[Hashable] = None,
+        prefix_len: int = 0,
+        past: Optional[KVTensors] = None,
+        return_cache: bool = False,
+    ) -> GenerationResult:
+        """
+        プロンプトをキューに入れ、生成完了まで待つ
+
+        Args:
+            prompt_ids (Sequence[int]): プロンプトのトークンID
+            params (GenerationParams): 生成パラメータ
+            prefix_key (Optional[Hashable]): プレフィックスキャッシュのキー（ペルソナ番号など）
+            prefix_len (int): prompt_ids の先頭から何トークンをキャッシュ対象にするか
+            past (Optional[KVTensors]): prompt_ids の先頭部分について計算済みのKV（前のターンのKVなど）。
+                指定した場合は残りのトークンだけを prefill する
+            return_cache (bool): 生成後のKVを結果に含める（次のターンで past として渡せる）
+
+        Returns:
+            GenerationResult: 生成結果
+        """
+        seq = self._new_sequence(prompt_ids, params, prefix_key, prefix_len, past, return_cache)
+        await self._queue.put(seq)
+        return await seq.future
+
+    async def stream(
+        self,
+        prompt_ids: Sequence[int],
+        params: GenerationParams,
+        prefix_key: Optional[Hashable] = None,
+        prefix_len: int = 0,
+    ) -> AsyncIterator[int]:
+        """
+        プロンプトをキューに入れ、生成されたトークンIDを1つずつ返す
+
+        呼び出し側が途中で反復をやめた場合（クライアント切断など）は、
+        そのシーケンスを取り消してバッチから外す。
+
+        Args:
+            prompt_ids (Sequence[int]): プロンプトのトークンID
+            params (GenerationParams): 生成パラメータ
+            prefix_key (Optional[Hashable]): プレフィックスキャッシュのキー
+            prefix_len (int): prompt_ids の先頭から何トークンをキャッシュ対象にするか
+
+        Yields:
+            int: 生成されたトークンID（終了トークンも含む）
+        """
+        seq = self._new_sequence(prompt_ids, params, prefix_key, prefix_len)
+        seq.tokens = asyncio.Queue()
+        future, tokens = seq.future, seq.tokens
+        await self._queue.put(seq)
+        try:
+            while True:
+                token = await tokens.get()
+                if token is None:  # 終了の合図
+                    break
+                yield token
+            # エラーで終了した場合はここで例外が送出される
+            await future
+        finally:
+            if not future.done():
+                future.cancel()
+
+    async def run_in_inference_thread(self, fn: Callable, *args):
+        """
+        生成以外でモデルを使う処理（文章のベクトル化など）を推論スレッドで実行する
+
+        デコードステップと同じスレッドで順番に実行されるので、
+        生成中のバッチとモデルの計算が同時に走ることはない。
+        """
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _new_sequence(self, prompt_ids, params, prefix_key=None, prefix_len=0, past=None, return_cache=False) -> _Sequence:
+        """キューに入れるシーケンスを作る"""
+        if not prompt_ids:
+            raise ValueError("prompt_ids must not be empty")
+        # 続きのトークンが最低1つないと次トークンのロジットが得られない
+        if past is not None and kv_length(past) >= len(prompt_ids):
+            raise ValueError("past must cover fewer tokens than prompt_ids")
+        if params.top_k is None:
+            params = replace(params, top_k=self.default_top_k)
+        return _Sequence(
+            prompt_ids=list(prompt_ids),
+            params=params,
+            future=asyncio.get_running_loop().create_future(),
+            prefix_key=prefix_key,
+            prefix_len=min(prefix_len, len(prompt_ids) - 1),
+            past=past,
+            return_cache=return_cache,
+            generator=torch.Generator().manual_seed(params.seed) if params.seed is not None else None,
+        )
+
+    def stats(self) -> Dict[str, float]:
+        """スケジューラの稼働状況（集計スループットなど）を返す"""
+        return {
+            "max_batch_size": self.max_batch_size,
+            "active_sequences": len(self._rows),
+            "queued_requests": self._queue.qsize(),
+            "completed_requests": self._completed,
+            "cancelled_requests": self._cancelled,
+            "thinking_truncated": self._thinking_truncated,
+            "decode_steps": self._steps,
+            "generated_tokens": self._generated_tokens,
+            "prefill_tokens": self._prefill_tokens,
+            "reused_prefix_tokens": self._reused_tokens,
+            "busy_seconds": round(self._busy_seconds, 3),
+            "tokens_per_second": round(self._generated_tokens / self._busy_seconds, 2) if self._busy_seconds else 0.0,
+            "speculative": self.speculative.stats() if self.speculative is not None else None,
+        }
+
+    # -------------------------------------------------------------------------
+    # メインループ
+    # -------------------------------------------------------------------------
+
+    def _init_worker(self):
+        """
+        推論スレッドの初期化（PyTorchのスレッド数を設定）
+
+        torch.set_num_threads はスレッドごとではなくプロセス全体の設定なので、推論スレッド以外の
+        PyTorch の処理にも効く（同じプロセスにスケジューラが複数あれば、最後に設定した値になる）。
+        """
+        if self.num_threads > 0:
+            torch.set_num_threads(self.num_threads)
+
+    async def _run(self):
+        """キューの監視とデコードステップを繰り返す（ステップ自体は推論スレッドで実行）"""
+        while True:
+            # 何も処理していなければ次のリクエストが来るまで待つ
+            if not self._rows and self._queue.empty():
+                first = await self._queue.get()
+                admitted = [first]
+            else:
+                admitted = []
+            while len(self._rows) + len(admitted) < self.max_batch_size and not self._queue.empty():
+                admitted.append(self._queue.get_nowait())
+            # 待っているリクエストがなければ、1シーケンスだけのときに推測デコードしてよい
+            idle = self._queue.empty()
+
+            try:
+                await self._loop.run_in_executor(self._executor, self._step, admitted, idle)
+            except Exception as e:
+                logger.error(f"Scheduler step error: {e}")
+                for seq in admitted:
+                    self._finish(seq, error=e)
+                self._fail_all(e)
+
+    def _step(self, admitted: List[_Sequence], idle: bool = False):
+        """新規シーケンスの prefill と、バッチ全体の1トークンデコード（または推測デコード）を行う"""
+        start = time.perf_counter()
+        with torch.inference_mode():
+            for seq in admitted:
+                if seq.future.cancelled():
+                    self._cancelled += 1
+                    continue
+                self._prefill(seq)
+            if self._rows:
+                num_tokens = self._speculative_tokens() if idle else 0
+                if num_tokens > 0:
+                    self._speculate(num_tokens)
+                else:
+                    self._decode()
+        self._busy_seconds += time.perf_counter() - start
+
+    def _prefill(self, seq: _Sequence):
+        """シーケンスのプロンプトを単独で処理し、最初のトークンをサンプリングしてバッチに合流させる"""
+        seq.prefill_started_at = time.perf_counter()
+        past, start = self._prompt_past(seq)
+
+        input_ids = torch.tensor([seq.prompt_ids[start:]], device=self.model.device)
+        outputs = self.model(
+            input_ids=input_ids,
+            past_key_values=tensors_to_cache(past) if past is not None else None,
+            use_cache=True,
+            logits_to_keep=1,
+        )
+        self._prefill_tokens += input_ids.shape[1]
+        kv = cache_to_tensors(outputs.past_key_values)
+        if self._first_token(seq, outputs.logits[:, -1, :]):
+            if seq.return_cache:
+                seq.cache = kv
+            self._finish(seq)
+            return
+        self._join(seq, kv)
+
+    def _prompt_past(self, seq: _Sequence) -> Tuple[Optional[KVTensors], int]:
+        """
+        プロンプトの先頭のうち計算済みのKVを返す（呼び出し側が渡したKV、またはプレフィックスキャッシュ）
+
+        Returns:
+            Tuple[Optional[KVTensors], int]: KV（なければ None）と、それが何トークン分か
+        """
+        past, start = None, 0
+        if seq.past is not None:
+            # 呼び出し側が渡した計算済みKV（前のターンまでの会話）の続きから prefill する
+            past, start = seq.past, kv_length(seq.past)
+            seq.past = None
+            self._reused_tokens += start
+        elif self.prefix_cache is not None and seq.prefix_key is not None and seq.prefix_len > 0:
+            # システムプロンプト部分はキャッシュ済みのKVを使い、続きだけを prefill する
+            prefix_ids = seq.prompt_ids[:seq.prefix_len]
+            past = self.prefix_cache.get(seq.prefix_key, prefix_ids)
+            if past is None:
+                prefix = self.model(
+                    input_ids=torch.tensor([prefix_ids], device=self.model.device),
+                    use_cache=True,
+                    logits_to_keep=1,
+                )
+                past = cache_to_tensors(prefix.past_key_values)
+                self.prefix_cache.put(seq.prefix_key, prefix_ids, past)
+                self._prefill_tokens += seq.prefix_len
+            else:
+                self._reused_tokens += seq.prefix_len
+            start = seq.prefix_len
+        return past, start
+
+    def _first_token(self, seq: _Sequence, logits: torch.Tensor) -> bool:
+        """prefill の最後の位置のロジットから最初のトークンを選び、シーケンスが終了したかどうかを返す"""
+        seq.repetition = SequenceRepetition(seq.prompt_ids, seq.params.repetition_penalty, seq.params.no_repeat_ngram_size)
+        token = self._sample(logits, [seq], seq.repetition.apply)[0]
+        seq.first_token_at = time.perf_counter()
+        return self._append_token(seq, token)
+
+    def _decode(self):
+        """バッチ内の全シーケンスを1トークン進める"""
+        next_tokens = torch.tensor([[seq.next_token] for seq in self._rows], device=self.model.device)
+        mask = torch.cat([self._mask, self._mask.new_ones((len(self._rows), 1))], dim=1)
+        # 各シーケンスの実トークン数がそのまま次の位置になる（左パディング分は数えない）
+        position_ids = (self._mask.sum(dim=1, keepdim=True)).to(next_tokens.device)
+
+        outputs = self.model(
+            input_ids=next_tokens,
+            attention_mask=mask,
+            position_ids=position_ids,
+            past_key_values=tensors_to_cache(self._kv),
+            use_cache=True,
+        )
+        self._kv = cache_to_tensors(outputs.past_key_values)
+        self._mask = mask
+        self._steps += 1
+
+        tokens = self._sample(outputs.logits[:, -1, :], self._rows, self._repetition)
+        keep = []
+        for i, (seq, token) in enumerate(zip(self._rows, tokens)):
+            cancelled = seq.future.cancelled()
+            if cancelled:
+                # クライアントの切断や期限切れで取り消されたシーケンスは、このステップで外す
+                self._cancelled += 1
+            if cancelled or self._append_token(seq, token):
+                if seq.return_cache:
+                    seq.cache = self._row_cache(i)
+                self._finish(seq)
+            else:
+                keep.append(i)
+        if len(keep) < len(self._rows):
+            self._retain(keep)
+
+    def _speculative_tokens(self) -> int:
+        """推測デコードで提案させるトークン数（推測デコードしない場合は0）"""
+        if self.speculative is None or len(self._rows) != 1:
+            return 0
+        seq = self._rows[0]
+        # シード指定のサンプリングは、負荷によらず同じ結果になるように通常のデコードにする
+        # （思考の打ち切りで出力するトークンが決まっている間も同様）
+        if (seq.params.seed is not None and seq.params.temperature > 0) or seq.forced:
+            return 0
+        return max(0, min(self.speculative.num_tokens, seq.params.max_new_tokens - len(seq.generated) - 1))
+
+    def _speculate(self, num_tokens: int):
+        """
+        1シーケンスだけのバッチを推測デコードで進める
+
+        下書きモデルが提案した num_tokens 個と、まだ入力していない次のトークンを本体モデルに
+        まとめて入力し、各位置の分布で提案を先頭から採否判定する。採用されなかった位置
+        （またはすべて採用された後の追加の1トークン）までを出力し、KV を出力した分に切り詰める。
+        """
+        seq = self._rows[0]
+        if seq.future.cancelled():
+            self._cancelled += 1
+            self._finish(seq)
+            self._retain([])
+            return
+
+        params = seq.params
+        draft, draft_probs = self.speculative.propose(
+            seq, seq.all_ids, num_tokens, params.temperature, params.top_p, params.top_k, repetition=seq.repetition
+        )
+        input_ids = torch.tensor([[seq.next_token] + draft], device=self.model.device)
+        length = input_ids.shape[1]
+        mask = torch.cat([self._mask, self._mask.new_ones((1, length))], dim=1)
+        position_ids = (self._mask.sum(dim=1, keepdim=True) + torch.arange(length, device=self._mask.device)).to(input_ids.device)
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=mask,
+            position_ids=position_ids,
+            past_key_values=tensors_to_cache(self._kv),
+            use_cache=True,
+        )
+        self._steps += 1
+        logits = outputs.logits[0].float()  # [num_tokens + 1, vocab]
+
+        accepted, emitted, finished = 0, 0, False
+        for i in range(length):
+            if i < len(draft):
+                scores = self._repetition(logits[i:i + 1])[0]
+                token, ok = self.speculative.accept(
+                    scores, draft[i], draft_probs[i] if draft_probs is not None else None, params.temperature, params.top_p, params.top_k
+                )
+            else:
+                # すべて採用されたら、最後の位置の分布からもう1トークン選ぶ
+                token, ok = self._sample(logits[i:i + 1], [seq], self._repetition)[0], False
+            finished = self._append_token(seq, token)
+            emitted += 1
+            if ok and seq.generated[-1] == token:
+                accepted += 1
+            else:
+                ok = False  # 思考の打ち切りで別のトークンに置き換わった場合も、以降の提案は使えない
+            if finished or not ok:
+                break
+
+        # 出力したトークンのうち最後の1つ以外（本体に入力済みのもの）まで KV と マスクを残す
+        keep = self._mask.shape[1] + emitted
+        self._kv = tuple((k[..., :keep, :], v[..., :keep, :]) for k, v in cache_to_tensors(outputs.past_key_values))
+        self._mask = mask[:, :keep]
+        self.speculative.rollback(len(seq.all_ids) - 1)
+        self.speculative.record(len(draft), accepted, emitted)
+        seq.draft_tokens += len(draft)
+        seq.accepted_draft_tokens += accepted
+
+        if finished:
+            if seq.return_cache:
+                seq.cache = self._row_cache(0)
+            self._finish(seq)
+            self._retain([])
+
+    # -------------------------------------------------------------------------
+    # バッチ管理
+    # -------------------------------------------------------------------------
+
+    def _join(self, seq: _Sequence, kv: KVTensors):
+        """prefill 済みのシーケンスを右端をそろえてバッチに追加する"""
+        new_len = kv_length(kv)
+        new_mask = torch.ones((1, new_len), dtype=torch.long, device=kv[0][0].device)
+        self._repetition.join(seq.repetition)
+        if not self._rows:
+            self._kv, self._mask = kv, new_mask
+        else:
+            batch_len = self._mask.shape[1]
+            target = max(batch_len, new_len)
+            batch_kv = _left_pad(self._kv, target - batch_len)
+            kv = _left_pad(kv, target - new_len)
+            self._kv = tuple(
+                (torch.cat([bk, k], dim=0), torch.cat([bv, v], dim=0))
+                for (bk, bv), (k, v) in zip(batch_kv, kv)
+            )
+            pad = lambda m, n: torch.cat([m.new_zeros((m.shape[0], n)), m], dim=1)
+            self._mask = torch.cat([pad(self._mask, target - batch_len), pad(new_mask, target - new_len)], dim=0)
+        self._rows.append(seq)
+
+    def _retain(self, keep: List[int]):
+        """指定した行だけをバッチに残し、全行でパディングになった先頭列を切り詰める"""
+        self._repetition.retain(keep)
+        if not keep:
+            self._rows, self._kv, self._mask = [], (), None
+            return
+        index = torch.tensor(keep, device=self._mask.device)
+        mask = self._mask.index_select(0, index)
+        # 残った全行で無効な先頭列は計算の無駄なので捨てる
+        offset = int((mask.cumsum(dim=1) == 0).all(dim=0).sum().item())
+        self._mask = mask[:, offset:]
+        self._kv = tuple(
+            (k.index_select(0, index.to(k.device))[..., offset:, :], v.index_select(0, index.to(v.device))[..., offset:, :])
+            for k, v in self._kv
+        )
+        self._rows = [self._rows[i] for i in keep]
+
+    def _row_cache(self, row: int) -> KVTensors:
+        """バッチの指定行のKVを、左パディングを除いて取り出す（バッチとはメモリを共有しない）"""
+        offset = int((self._mask[row] == 0).sum().item())
+        return tuple(
+            (k[row:row + 1, :, offset:, :].clone(), v[row:row + 1, :, offset:, :].clone())
+            for k, v in self._kv
+        )
+
+    def _append_token(self, seq: _Sequence, token: int) -> bool:
+        """サンプリングしたトークンを記録し、シーケンスが終了したかどうかを返す"""
+        if seq.forced:
+            # 思考の上限に達した後は、サンプリング結果の代わりに </think> を出力する
+            token = seq.forced.pop(0)
+        seq.generated.append(token)
+        seq.next_token = token
+        seq.repetition.append(token)
+        self._count_thinking(seq, token)
+        if seq.tokens is not None:
+            self._loop.call_soon_threadsafe(seq.tokens.put_nowait, token)
+        self._generated_tokens += 1
+        if token in self.eos_token_ids:
+            seq.finish_reason = "stop"
+        elif len(seq.generated) >= seq.params.max_new_tokens:
+            seq.finish_reason = "length"
+        return seq.finish_reason is not None
+
+    def _count_thinking(self, seq: _Sequence, token: int):
+        """思考ブロック内のトークン数を数え、thinking_budget に達したら閉じタグを出力させる"""
+        budget = seq.params.thinking_budget
+        if budget is None or self.think_start_id is None:
+            return
+        if token == self.think_start_id:
+            seq.thinking = 0
+        elif seq.thinking is None:
+            return
+        elif token == self.think_end_ids[0]:
+            seq.thinking = None
+            return
+        else:
+            seq.thinking += 1
+        if seq.thinking >= budget:
+            seq.thinking = None
+            seq.forced = list(self.think_end_ids)
+            self._thinking_truncated += 1
+
+    def _finish(self, seq: _Sequence, error: Optional[Exception] = None):
+        """シーケンスの結果（またはエラー）を待っているリクエストに返す"""
+        result = None
+        if self.speculative is not None:
+            self.speculative.release(seq)
+        if error is None:
+            if not seq.future.cancelled():
+                self._completed += 1
+            result = GenerationResult(
+                token_ids=seq.generated,
+                finish_reason=seq.finish_reason or "length",
+                prompt_tokens=len(seq.prompt_ids),
+                cache=seq.cache,
+                timings=_timings(seq),
+                draft_tokens=seq.draft_tokens,
+                accepted_draft_tokens=seq.accepted_draft_tokens,
+            )
+            if self.metrics is not None and not seq.future.cancelled():
+                self.metrics.record_generation(result)
+        # Future はイベントループのスレッドでしか操作できないので、ループ側で結果を設定する
+        self._loop.call_soon_threadsafe(_resolve, seq, error, result)
+
+    def _fail_all(self, error: Exception):
+        """バッチ内の全シーケンスをエラーで終了させ、バッチを空にする"""
+        for seq in self._rows:
+            self._finish(seq, error=error)
+        self._rows, self._kv, self._mask = [], (), None
+        self._repetition.clear()
+
+    # -------------------------------------------------------------------------
+    # サンプリング
+    # -------------------------------------------------------------------------
+
+    def _sample(self, logits: torch.Tensor, rows: List[_Sequence], repetition: Callable[[torch.Tensor], torch.Tensor]) -> List[int]:
+        """
+        シーケンスごとのパラメータでロジットを加工し、次のトークンを選ぶ
+        処理順は model.generate と同じ（繰り返しペナルティ → n-gram禁止 → temperature → top_k → top_p）
+
+        Args:
+            logits (torch.Tensor): [len(rows), vocab] の次トークンのロジット
+            rows (List[_Sequence]): ロジットの各行に対応するシーケンス
+            repetition (Callable): 繰り返しの制御（バッチなら RepetitionProcessor、prefill なら1行分）
+        """
+        scores = repetition(logits.float())
+
+        temperatures = torch.tensor([seq.params.temperature for seq in rows], device=scores.device)
+        top_p = torch.tensor([seq.params.top_p for seq in rows], device=scores.device)
+        top_k = torch.tensor([seq.params.top_k or 0 for seq in rows], device=scores.device)
+        greedy = temperatures <= 0
+        greedy_tokens = scores.argmax(dim=-1)
+        if bool(greedy.all()):
+            return greedy_tokens.tolist()
+
+        probs = warp_scores(scores, temperatures, top_p, top_k).softmax(dim=-1)
+        sampled = torch.multinomial(probs, num_samples=1).squeeze(1)
+        # シード指定のシーケンスは専用の乱数生成器で選び直す（他のシーケンスの乱数の消費に影響されない）
+        for i, seq in enumerate(rows):
+            if seq.generator is not None and not greedy[i]:
+                sampled[i] = torch.multinomial(probs[i].cpu(), num_samples=1, generator=seq.generator).item()
+        return torch.where(greedy, greedy_tokens, sampled).tolist()
+
+def _resolve(seq: _Sequence, error: Optional[Exception], result: Optional[GenerationResult]):
+    """（イベントループ上で）シーケンスの Future に結果またはエラーを設定する"""
+    if seq.tokens is not None:
+        seq.tokens.put_nowait(None)
+    if seq.future.done():
+        return
+    if error is not None:
+        seq.future.set_exception(error)
+    else:
+        seq.future.set_result(result)
+
+def eos_token_ids(model, tokenizer) -> Set[int]:
+    """終了トークンのIDを返す（Qwen3は <|im_end|> と <|endoftext|> の両方で止める）"""
+    eos_ids = set()
+    for eos in (tokenizer.eos_token_id, getattr(model.generation_config, "eos_token_id", None)):
+        if isinstance(eos, int):
+            eos_ids.add(eos)
+        elif eos:
+            eos_ids.update(eos)
+    return eos_ids
+
+def _single_token_id(tokenizer, token: str) -> Optional[int]:
+    """語彙に1トークンとしてある文字列のIDを返す（なければ None）"""
+    token_id = tokenizer.convert_tokens_to_ids(token)
+    if token_id is None or token_id == tokenizer.unk_token_id:
+        return None
+    return token_id
+
+def _timings(seq: _Sequence) -> Dict[str, float]:
+    """シーケンスの段階別の所要時間（キュー待ち・prefill・デコード・最初のトークンまで）"""
+    if seq.prefill_started_at is None or seq.first_token_at is None:
+        return {}
+    now = time.perf_counter()
+    return {
+        "queue": seq.prefill_started_at - seq.enqueued_at,
+        "prefill": seq.first_token_at - seq.prefill_started_at,
+        "decode": now - seq.first_token_at,
+        "ttft": seq.first_token_at - seq.enqueued_at,
+    }
@@ -1,13 +1,44 @@
 # =============================================================================
 # ライブラリインポート
 # =============================================================================
-from typing import List, Optional  # 型ヒント用（ListとOptionalを使用）
-from fastapi import FastAPI, HTTPException  # WebAPIフレームワーク
-from pydantic import BaseModel  # データ検証・シリアライゼーション
-import torch  # PyTorch（深層学習フレームワーク）
+from typing import List, Optional, Sequence, Tuple  # 型ヒント用（List、Optional、Sequence、Tupleを使用）
+import asyncio  # 重い処理をイベントループ外で実行する用
+from contextlib import aclosing  # 非同期ジェネレータを確実に閉じる用
+from fastapi import FastAPI, HTTPException, Query, Request, Response  # WebAPIフレームワーク
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse  # ステータスコード指定・メトリクス・ストリーミングレスポンス用
+from starlette.background import BackgroundTask  # ストリーミング終了後の後始末用
+from starlette.middleware.gzip import GZipMiddleware  # レスポンスの gzip 圧縮
+from pydantic import BaseModel, ValidationError  # データ検証・シリアライゼーション
 from transformers import AutoTokenizer, AutoModelForCausalLM  # Hugging Face transformers
 from datasets import load_dataset  # データセット読み込み用
 import logging  # ログ出力用
+import os  # 環境変数から設定を読み込む用
+import json  # ストリーミングイベントのJSON化用
+import time  # ストリーミング中の段階別の所要時間の計測用
+from scheduler import GenerationScheduler, GenerationParams, kv_length  # 連続バッチング生成スケジューラ
+from prefix_cache import PrefixCache  # システムプロンプトのKVキャッシュ
+from sessions import SessionStore  # サーバー側の会話セッション
+from history import HistoryCompactor, generation_prompt  # トークン数の上限に合わせた会話履歴の圧縮
+from persona_stats import PersonaStats, dataset_table  # ペルソナの統計情報（列指向で集計）
+from persona_store import open_or_build_store  # ペルソナの列指向ストア（必要な項目だけを読む）
+from persona_index import PersonaIndex  # ペルソナ検索用のインデックス
+from persona_vectors import PersonaVectors, embed_texts  # 説明文のベクトル検索（似ているペルソナ）
+from readiness import ReadinessTracker  # 起動処理の進み具合（liveness / readiness）
+from metrics import ServingMetrics  # 段階別のレイテンシ計測と /metrics
+from response_cache import ResponseCache, cache_key, is_deterministic  # 決定的な生成の応答キャッシュ
+from admission import AdmissionController, AdmissionRejected, ClientDisconnected, DeadlineExceeded, watch_request  # 受け付け制御
+from persona_prompts import PROMPT_COLUMNS, PersonaPromptStore, build_persona_prompt, build_system_block  # ペルソナのシステムプロンプト
+from streaming import IncrementalDecoder, ThinkTagFilter, format_sse, strip_think  # トークン単位のストリーミング・思考部分の除去用
+from precision import apply_precision, check_precision, load_options, model_bytes  # 推論精度（bf16 / fp32 / int8）
+from speculative import SpeculativeDecoder  # 推測デコード（下書きモデル）
+from multiproc import WorkerConfig, WorkerPool, default_threads  # 重みを共有する複数の推論ワーカープロセス
+from compiled_engine import CompiledScheduler  # 静的なKVキャッシュと torch.compile による生成
+
+# sse-starlette はオプション（インストールされていれば /chat/stream で使用）
+try:
+    from sse_starlette.sse import EventSourceResponse
+except ImportError:
+    EventSourceResponse = None
 
 # =============================================================================
 # ロギング設定
@@ -24,10 +55,105 @@ app = FastAPI(title="Nemotron JP Persona Chat", version="2.0.0")
 # グローバル変数（アプリケーション全体で使用する変数）
 # =============================================================================
 MODEL_ID = "Qwen/Qwen3-1.7B"  # 使用する言語モデルのID（Hugging Faceから取得）
+PRECISION = os.environ.get("NEMO_PRECISION", "bf16")  # 推論精度（bf16 / fp32 / int8、CPU のみのノードでは fp32 か int8 が速いことが多い）
+DRAFT_MODEL_ID = os.environ.get("NEMO_DRAFT_MODEL", "")  # 推測デコードの下書きモデルのID（例: Qwen/Qwen3-0.6B、空文字で無効）
+SPECULATIVE_TOKENS = int(os.environ.get("NEMO_SPECULATIVE_TOKENS", "4"))  # 推測デコードで1回に提案させるトークン数
+MAX_BATCH_SIZE = int(os.environ.get("NEMO_MAX_BATCH_SIZE", "8"))  # 同時に生成できるシーケンス数（生成スロット数）
+INFERENCE_WORKERS = int(os.environ.get("NEMO_INFERENCE_WORKERS", "1"))  # 推論ワーカープロセス数（2以上で重みを共有メモリに置いてプロセスを分ける）
+COMPILED_ENGINE = os.environ.get("NEMO_COMPILED_ENGINE", "0") == "1"  # 静的なKVキャッシュと torch.compile で1シーケンスずつ生成する（ワーカー1つのときのみ）
+COMPILE_BUCKETS = [int(b) for b in os.environ.get("NEMO_COMPILE_BUCKETS", "64,128,256,512").split(",") if b.strip()]  # prefill の入力長のバケット
+STATIC_CACHE_TOKENS = int(os.environ.get("NEMO_STATIC_CACHE_TOKENS", "2048"))  # 静的なKVキャッシュのトークン数（超えるリクエストは通常の経路）
+INFERENCE_THREADS = int(os.environ.get("NEMO_INFERENCE_THREADS", "0"))  # PyTorchのスレッド数（ワーカーのプロセスごと。0で既定値、ワーカーが複数ならCPU数を等分。プロセス全体の設定なので、ワーカーが1つならサーバーの全 PyTorch 処理に効く）
+PREFIX_CACHE_MB = int(os.environ.get("NEMO_PREFIX_CACHE_MB", "512"))  # ペルソナのシステムプロンプトKVキャッシュの上限（MB、0で無効）
+SESSION_CACHE_MB = int(os.environ.get("NEMO_SESSION_CACHE_MB", "1024"))  # 全セッションのKVキャッシュと履歴の合計上限（MB）
+MAX_SESSIONS = int(os.environ.get("NEMO_MAX_SESSIONS", "10000"))  # 保持する会話セッション数の上限（超えたら使われていない順に削除）
+SESSION_IDLE_SECONDS = float(os.environ.get("NEMO_SESSION_IDLE_SECONDS", "1800"))  # この秒数使われないセッションは削除
+SESSION_MAX_TOKENS = int(os.environ.get("NEMO_SESSION_MAX_TOKENS", "4096"))  # 1セッションで保持する最大トークン数
+HISTORY_TOKEN_BUDGET = int(os.environ.get("NEMO_HISTORY_TOKEN_BUDGET", "1024"))  # プロンプト（システムプロンプト＋履歴）の最大トークン数
+KEYWORD_INDEX = os.environ.get("NEMO_KEYWORD_INDEX", "1") != "0"  # 説明文のキーワード検索用の bigram の転置インデックスを作る（0なら全件走査）
+SEARCH_RESULT_FIELDS = ("occupation", "age", "sex", "region", "prefecture", "persona")  # 検索結果に含める項目
+STATS_CACHE_DIR = os.environ.get("NEMO_STATS_CACHE_DIR", os.path.expanduser("~/.cache/nemo_chat_app"))  # 統計情報の保存先（空文字で保存しない）
+VECTORS_DIR = os.environ.get("NEMO_VECTORS_DIR", os.path.expanduser("~/.cache/nemo_chat_app/persona_vectors"))  # persona_vectors.py で作成したベクトルの場所
+VECTOR_NPROBE = int(os.environ.get("NEMO_VECTOR_NPROBE", "16"))  # 類似検索で調べるIVFのクラスタ数
+EXHAUSTIVE_VECTOR_ROWS = 100000  # IVF のないベクトルがこの件数を超えたら警告する（検索のたびに全件を読むため）
+PROMPTS_DIR = os.environ.get("NEMO_PROMPTS_DIR", os.path.expanduser("~/.cache/nemo_chat_app/persona_prompts"))  # persona_prompts.py で作成したトークン化済みプロンプトの場所
+PERSONA_STORE_DIR = os.environ.get("NEMO_PERSONA_STORE_DIR", os.path.expanduser("~/.cache/nemo_chat_app/persona_store"))  # ペルソナの列指向ストアの場所（空文字で使わない）
+MAX_BULK_PERSONAS = 1000  # GET /personas で1度に取得できる最大件数
+MAX_CONCURRENT_REQUESTS = int(os.environ.get("NEMO_MAX_CONCURRENT_REQUESTS", str(MAX_BATCH_SIZE * INFERENCE_WORKERS)))  # 同時に生成するチャットリクエスト数の上限
+MAX_QUEUED_REQUESTS = int(os.environ.get("NEMO_MAX_QUEUED_REQUESTS", "32"))  # 実行枠を待てるリクエスト数（超えたら429）
+REQUEST_TIMEOUT_SECONDS = float(os.environ.get("NEMO_REQUEST_TIMEOUT_SECONDS", "120"))  # チャットリクエストの期限（秒、待ち時間を含む。0で無制限）
+MAX_BATCH_REQUESTS = int(os.environ.get("NEMO_MAX_BATCH_REQUESTS", "10000"))  # POST /chat/batch で1度に受け付ける最大件数
+METRICS_ENABLED = os.environ.get("NEMO_METRICS", "1") != "0"  # 段階別の所要時間などを記録して /metrics で返す（0で無効）
+SERVER_TIMING = os.environ.get("NEMO_SERVER_TIMING", "0") == "1"  # レスポンスに Server-Timing ヘッダー（段階別の所要時間）を付ける
+GZIP_MINIMUM_BYTES = int(os.environ.get("NEMO_GZIP_MINIMUM_BYTES", "1024"))  # この大きさ以上のレスポンスを gzip で圧縮（0で圧縮しない）
+WARMUP_TOKENS = int(os.environ.get("NEMO_WARMUP_TOKENS", "8"))  # 起動時のウォームアップ生成のトークン数（0で無効）
+RESPONSE_CACHE_ENTRIES = int(os.environ.get("NEMO_RESPONSE_CACHE_ENTRIES", "1024"))  # 決定的な生成の応答キャッシュの最大件数（0で無効）
+RESPONSE_CACHE_MB = int(os.environ.get("NEMO_RESPONSE_CACHE_MB", "64"))  # 応答キャッシュの合計サイズの上限（MB）
+RESPONSE_CACHE_TTL_SECONDS = float(os.environ.get("NEMO_RESPONSE_CACHE_TTL_SECONDS", "3600"))  # 応答キャッシュの有効期限（秒、0で期限なし）
 tokenizer = None  # テキストをトークン（数値）に変換するツール
 model = None  # 実際の言語生成モデル
+scheduler = None  # 複数リクエストをまとめてデコードするスケジューラ
+prefix_cache = None  # ペルソナごとのシステムプロンプトのKVキャッシュ
+response_cache = None  # 決定的な生成（グリーディ・シード指定）の返答のキャッシュ
+sessions = None  # サーバー側で保持している会話セッション
+history_compactor = None  # 会話履歴をトークン数の上限に収める
 personas = None  # 日本人ペルソナデータセット
+persona_stats = None  # ペルソナデータセットの統計情報
+persona_index = None  # ペルソナ検索用のインデックス
+persona_vectors = None  # ペルソナ説明文のベクトル（似ているペルソナの検索用）
+persona_prompts = None  # トークン化済みのシステムプロンプト（全ペルソナ分）
+persona_store = None  # ペルソナの列指向ストア（項目単位のランダムアクセス用）
 startup_error = None  # サーバー起動時のエラーを記録する変数
+startup_task = None  # バックグラウンドで読み込みを行うタスク
+# 段階別の所要時間・トークン数・TTFTなどのメトリクス
+metrics = ServingMetrics(enabled=METRICS_ENABLED)
+metrics.add_gauge(
+    "nemo_in_flight_generations", "Generations currently decoding or queued",
+    lambda: scheduler.stats()["active_sequences"] + scheduler.stats()["queued_requests"] if scheduler else None
+)
+metrics.add_gauge(
+    "nemo_queued_generations", "Generations waiting for a batch slot",
+    lambda: scheduler.stats()["queued_requests"] if scheduler else None
+)
+metrics.add_gauge(
+    "nemo_response_cache_hit_ratio", "Hit ratio of the deterministic response cache",
+    lambda: response_cache.stats()["hit_rate"] if response_cache else None
+)
+# チャットの同時実行数と待ち行列の上限（超えたら429で断る）
+admission = AdmissionController(MAX_CONCURRENT_REQUESTS, MAX_QUEUED_REQUESTS)
+metrics.add_gauge(
+    "nemo_admission_waiting", "Chat requests waiting for an admission slot",
+    lambda: admission.stats()["waiting"]
+)
+# 起動時に読み込む部品の状態（dataset・tokenizer・model・scheduler・warmup がそろえば ready）
+readiness = ReadinessTracker(
+    ["dataset", "store", "stats", "index", "vectors", "tokenizer", "model", "draft", "scheduler", "warmup", "prompts"],
+    required=["dataset", "tokenizer", "model", "scheduler", "warmup"]
+)
+
+# =============================================================================
+# レスポンスの圧縮
+# =============================================================================
+UNCOMPRESSED_PATHS = ("/chat/stream",)  # トークンごとに届ける必要があるストリーミング（圧縮するとまとめて届く）
+
+class ResponseCompression:
+    """
+    ペルソナ情報・統計・一括生成の結果などのレスポンスを gzip で圧縮する ASGI ミドルウェア
+    （クライアントが Accept-Encoding: gzip を送った場合のみ。UNCOMPRESSED_PATHS は圧縮しない）
+    """
+
+    def __init__(self, app, minimum_size: int):
+        self.app = app
+        self.gzip = GZipMiddleware(app, minimum_size=minimum_size)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] in UNCOMPRESSED_PATHS:
+            await self.app(scope, receive, send)
+        else:
+            await self.gzip(scope, receive, send)
+
+if GZIP_MINIMUM_BYTES > 0:
+    app.add_middleware(ResponseCompression, minimum_size=GZIP_MINIMUM_BYTES)
 
 # =============================================================================
 # データモデル定義（APIの入力・出力の形式を定義）
@@ -52,6 +178,13 @@ class ChatRequest(BaseModel):
     max_new_tokens: int = 150  # 生成する最大トークン数（長さの制限）
     temperature: float = 0.8  # 生成のランダム性（0.0-1.0、高いほど創造的）
     top_p: float = 0.9  # 生成時の語彙選択幅（0.0-1.0、nucleus sampling）
+    top_k: Optional[int] = None  # 確率の上位 k 語彙に絞る（0で絞らない、省略時はモデルの既定値）
+    repetition_penalty: float = 1.1  # 既出トークンの出にくさ（1.0で無効）
+    no_repeat_ngram_size: int = 2  # このサイズのn-gramの繰り返しを禁止（0で無効）
+    seed: Optional[int] = None  # サンプリングの乱数のシード（指定すると同じリクエストには同じ返答）
+    timeout_seconds: Optional[float] = None  # このリクエストの期限（秒、サーバーの上限より長くはできない）
+    enable_thinking: bool = True  # False なら思考（<think>）を省略して返答を始めさせる
+    thinking_budget: Optional[int] = None  # 思考のトークン数の上限（超えたら思考を打ち切って返答を始めさせる）
 
 class ChatResponse(BaseModel):
     """
@@ -60,6 +193,59 @@ class ChatResponse(BaseModel):
     """
     reply: str  # AIの返答内容
     persona_info: Optional[dict] = None  # 使用したペルソナの情報（optional）
+    generation: Optional[dict] = None  # 生成の統計（トークン数・トークン/秒・推測デコードの採用率、キャッシュから返した場合は None）
+
+class SimilarPersonaRequest(BaseModel):
+    """
+    文章に似ているペルソナを探すリクエスト形式
+    """
+    text: str  # 探したいペルソナの説明（例：「海の近くで暮らす釣り好きの漁師」）
+    k: int = 10  # 返す件数
+
+class SessionCreateRequest(BaseModel):
+    """
+    会話セッション作成APIへのリクエスト形式
+    """
+    persona_index: Optional[int] = 0  # 使用するペルソナのインデックス（0から開始）
+
+class SessionInfo(BaseModel):
+    """
+    会話セッションの状態
+    """
+    session_id: str  # セッションID（以降のリクエストで使用）
+    persona_index: int  # 使用しているペルソナのインデックス
+    turns: int  # これまでの発言数（ユーザーとAIの合計）
+    context_tokens: int  # サーバーが保持している会話全体のトークン数
+    kv_cached: bool  # KVキャッシュを保持しているか（Falseなら次のターンで全体を prefill）
+    persona_info: Optional[dict] = None  # ペルソナ情報（作成時のみ）
+
+class SessionMessageRequest(BaseModel):
+    """
+    会話セッションへの発言リクエスト形式
+    履歴はサーバーが保持しているので、新しい発言だけを送る
+    """
+    content: str  # ユーザーの発言内容
+    max_new_tokens: int = 150  # 生成する最大トークン数
+    temperature: float = 0.8  # 生成のランダム性（0.0-1.0）
+    top_p: float = 0.9  # 生成時の語彙選択幅（0.0-1.0）
+    top_k: Optional[int] = None  # 確率の上位 k 語彙に絞る（0で絞らない、省略時はモデルの既定値）
+    repetition_penalty: float = 1.1  # 既出トークンの出にくさ（1.0で無効）
+    no_repeat_ngram_size: int = 2  # このサイズのn-gramの繰り返しを禁止（0で無効）
+    seed: Optional[int] = None  # サンプリングの乱数のシード
+    timeout_seconds: Optional[float] = None  # このリクエストの期限（秒）
+    enable_thinking: bool = True  # False なら思考（<think>）を省略する
+    thinking_budget: Optional[int] = None  # 思考のトークン数の上限
+
+class SessionMessageResponse(BaseModel):
+    """
+    会話セッションへの発言に対するレスポンス形式
+    """
+    reply: str  # AIの返答内容
+    session_id: str  # セッションID
+    turns: int  # これまでの発言数
+    context_tokens: int  # 会話全体のトークン数
+    prefilled_tokens: int  # 今回 prefill が必要だったトークン数（セッションのKVで省略できた分は含まない）
+    generation: Optional[dict] = None  # 生成の統計（トークン数・トークン/秒・推測デコードの採用率）
 
 # =============================================================================
 # サーバー起動時の初期化処理
@@ -69,43 +255,235 @@ class ChatResponse(BaseModel):
 async def startup_event():
     """
     FastAPIサーバー起動時に実行される関数
-    モデルとデータセットの読み込みを行う
+    データセットとモデルの読み込みをバックグラウンドで開始し、すぐに応答可能にする
+    （読み込みの進み具合は /health で確認できる）
     """
-    global tokenizer, model, personas, startup_error
+    global startup_task
+    startup_task = asyncio.create_task(load_components())
 
-    try:
-        # ステップ1: 日本人ペルソナデータセットの読み込み
+async def load_components():
+    """
+    データセット側とモデル側の読み込みを並行して行う
+    どちらかが失敗しても、もう一方は最後まで読み込む
+    """
+    global startup_error, persona_prompts
+
+    results = await asyncio.gather(load_persona_components(), load_model_components(), return_exceptions=True)
+    errors = [str(r) for r in results if isinstance(r, Exception)]
+
+    # トークン化済みのシステムプロンプトはデータセットとトークナイザーの両方がそろってから開く
+    if personas is not None and tokenizer is not None:
+        with readiness.track("prompts"):
+            persona_prompts = await asyncio.to_thread(load_persona_prompts)
+            readiness.progress("prompts", rows=persona_prompts.rows if persona_prompts else 0)
+    else:
+        readiness.skip("prompts", "dataset or tokenizer not loaded")
+    if errors:
+        # 初期化に失敗した場合のエラーハンドリング
+        startup_error = f"Startup error: {'; '.join(errors)}"  # エラー状態を記録
+        logger.error(startup_error)
+    else:
+        logger.info(f"System ready for persona-aware chat with Qwen3-1.7B ({readiness.stats()['uptime_seconds']}s)")
+
+async def load_persona_components():
+    """
+    ペルソナデータセットと、それを使う統計・検索インデックス・ベクトルを読み込む
+    """
+    global personas, persona_store, persona_stats, persona_index, persona_vectors
+
+    # 日本人ペルソナデータセットの読み込み（読み込めた時点で /personas/{id} が使える）
+    with readiness.track("dataset"):
         logger.info("Loading Nemotron-Personas-Japan dataset...")
-        personas = load_dataset("nvidia/Nemotron-Personas-Japan", split="train")
+        personas = await asyncio.to_thread(load_dataset, "nvidia/Nemotron-Personas-Japan", split="train")
+        readiness.progress("dataset", rows=len(personas))
         logger.info(f"Loaded {len(personas)} Japanese personas")
 
-        # ステップ2: Qwen3-1.7Bモデルの読み込み
-        logger.info("Loading Qwen3-1.7B model...")
+    # 項目単位で読める列指向ストアを開く（なければ作成する。作成中はデータセットから読む）
+    if PERSONA_STORE_DIR:
+        with readiness.track("store"):
+            persona_store = await asyncio.to_thread(
+                open_or_build_store, PERSONA_STORE_DIR, dataset_table(personas), getattr(personas, "_fingerprint", None)
+            )
+            readiness.progress("store", **persona_store.stats())
+    else:
+        readiness.skip("store", "NEMO_PERSONA_STORE_DIR is empty")
+
+    # 統計情報は起動時に1度だけ列単位で集計（前回の結果があれば読み込むだけ）
+    with readiness.track("stats"):
+        stats = PersonaStats(personas, cache_dir=STATS_CACHE_DIR or None)
+        await asyncio.to_thread(stats.load_or_compute)
+        persona_stats = stats
+
+    # 職業・地域・年齢での検索用インデックスを作成
+    with readiness.track("index"):
+        persona_index = await asyncio.to_thread(PersonaIndex, persona_stats.table, keyword_index=KEYWORD_INDEX)
+        readiness.progress("index", keyword_index_mb=round(persona_index.keyword_index_bytes / 1024 / 1024, 1))
+
+    # オフラインで作成したベクトルがあれば開く（memmap なので全体は読み込まない）
+    with readiness.track("vectors"):
+        persona_vectors = load_persona_vectors()
+        readiness.progress("vectors", rows=persona_vectors.rows if persona_vectors else 0)
+
+def load_draft_model(target):
+    """
+    推測デコードの下書きモデルを本体と同じ精度で読み込む
 
-        # トークナイザー（文章を数値に変換するツール）の読み込み
-        tokenizer = AutoTokenizer.from_pretrained(MODEL_ID, trust_remote_code=True)
+    Args:
+        target: 本体のモデル（語彙が同じかを確かめる）
 
-        # パディングトークンが設定されていない場合、終了トークンを使用
-        if tokenizer.pad_token is None:
-            tokenizer.pad_token = tokenizer.eos_token
+    Returns:
+        下書きモデル（語彙が本体と違えば ValueError）
+    """
+    logger.info(f"Loading draft model {DRAFT_MODEL_ID} ({PRECISION})...")
+    draft = AutoModelForCausalLM.from_pretrained(
+        DRAFT_MODEL_ID,
+        **load_options(PRECISION),
+        low_cpu_mem_usage=True,
+        use_safetensors=True,
+        trust_remote_code=True
+    )
+    if draft.config.vocab_size != target.config.vocab_size:
+        raise ValueError(f"vocabulary size {draft.config.vocab_size} does not match the model ({target.config.vocab_size})")
+    draft = apply_precision(draft, PRECISION)
+    return draft
+
+async def load_model_components():
+    """
+    トークナイザー・モデルを読み込み、生成スケジューラを起動してウォームアップする
+    チャットに使うグローバル変数（model など）は、ウォームアップが終わってから設定する
+    """
+    global tokenizer, model, scheduler, prefix_cache, response_cache, sessions, history_compactor
+
+    # トークナイザー（文章を数値に変換するツール）の読み込み
+    with readiness.track("tokenizer"):
+        tok = await asyncio.to_thread(AutoTokenizer.from_pretrained, MODEL_ID, trust_remote_code=True)
 
-        # 言語モデル本体の読み込み
-        model = AutoModelForCausalLM.from_pretrained(
+        # パディングトークンが設定されていない場合、終了トークンを使用
+        if tok.pad_token is None:
+            tok.pad_token = tok.eos_token
+
+    # 言語モデル本体の読み込み（safetensors の重みはメモリマップで読み、CPUメモリへの余分なコピーを避ける）
+    with readiness.track("model"):
+        check_precision(PRECISION)
+        logger.info(f"Loading Qwen3-1.7B model ({PRECISION})...")
+        mdl = await asyncio.to_thread(
+            AutoModelForCausalLM.from_pretrained,
             MODEL_ID,
-            torch_dtype=torch.bfloat16,  # メモリ効率のため16bit浮動小数点を使用
-            device_map="auto",  # 利用可能なGPU/CPUに自動でモデルを配置
+            **load_options(PRECISION),  # 精度に応じた dtype と配置（bf16 なら利用可能なGPU/CPUに自動で配置）
+            low_cpu_mem_usage=True,  # 重みを1度だけ読み込む（一時的なランダム初期化をしない）
+            use_safetensors=True,  # メモリマップで読める safetensors 形式を使う
             trust_remote_code=True  # Hugging Faceのカスタムコード実行を許可
         )
+        parameters = sum(p.numel() for p in mdl.parameters())
+        # int8 ならデコーダ層の Linear を動的量子化する
+        mdl = await asyncio.to_thread(apply_precision, mdl, PRECISION)
+        readiness.progress("model", parameters=parameters, precision=PRECISION, model_bytes=model_bytes(mdl))
+
+    # 推測デコードの下書きモデル（読み込めなければ警告を出し、通常のデコードだけで動かす）
+    draft = None
+    if DRAFT_MODEL_ID and SPECULATIVE_TOKENS > 0:
+        try:
+            with readiness.track("draft"):
+                draft = await asyncio.to_thread(load_draft_model, mdl)
+                readiness.progress("draft", model=DRAFT_MODEL_ID, num_tokens=SPECULATIVE_TOKENS, model_bytes=model_bytes(draft))
+        except Exception as e:
+            logger.warning(f"Speculative decoding disabled, failed to load draft model {DRAFT_MODEL_ID}: {e}")
+    else:
+        readiness.skip("draft", "NEMO_DRAFT_MODEL is not set")
+
+    # 同時リクエストをまとめてデコードするスケジューラを起動
+    # （モデルの計算は専用の推論スレッドで行い、イベントループを止めない）
+    with readiness.track("scheduler"):
+        # 会話履歴をトークン数の上限に収めるための圧縮器（発言ごとのトークンIDをキャッシュ）
+        history_compactor = HistoryCompactor(tok, HISTORY_TOKEN_BUDGET)
+        if INFERENCE_WORKERS > 1:
+            # 重み（と下書きモデル）を共有メモリに移し、複数の推論ワーカープロセスで生成する
+            # （プレフィックスキャッシュはワーカーごとに持ち、上限を等分する）
+            config = WorkerConfig(
+                max_batch_size=MAX_BATCH_SIZE,
+                num_threads=INFERENCE_THREADS or default_threads(INFERENCE_WORKERS),
+                prefix_cache_bytes=PREFIX_CACHE_MB * 1024 * 1024 // INFERENCE_WORKERS,
+                speculative_tokens=SPECULATIVE_TOKENS
+            )
+            scheduler = WorkerPool(mdl, tok, INFERENCE_WORKERS, config, draft=draft, metrics=metrics)
+            scheduler.start()
+            await scheduler.wait_ready()
+            readiness.progress("scheduler", workers=INFERENCE_WORKERS, threads_per_worker=config.num_threads)
+        elif COMPILED_ENGINE:
+            # 静的なKVキャッシュとコンパイル済みのフォワード（受け付け前にすべてのバケットをコンパイルする）
+            if draft is not None:
+                logger.warning("Speculative decoding is not used with NEMO_COMPILED_ENGINE=1")
+            prefix_cache = PrefixCache(PREFIX_CACHE_MB * 1024 * 1024) if PREFIX_CACHE_MB > 0 else None
+            scheduler = CompiledScheduler(
+                mdl,
+                tok,
+                buckets=COMPILE_BUCKETS,
+                max_cache_len=STATIC_CACHE_TOKENS,
+                num_threads=INFERENCE_THREADS,
+                prefix_cache=prefix_cache,
+                metrics=metrics
+            )
+            scheduler.start()
+            compile_seconds = await scheduler.precompile()
+            readiness.progress("scheduler", compiled=scheduler.compiled, compile_seconds=round(sum(compile_seconds.values()), 1))
+        else:
+            prefix_cache = PrefixCache(PREFIX_CACHE_MB * 1024 * 1024) if PREFIX_CACHE_MB > 0 else None
+            scheduler = GenerationScheduler(
+                mdl,
+                tok,
+                max_batch_size=MAX_BATCH_SIZE,
+                num_threads=INFERENCE_THREADS,
+                prefix_cache=prefix_cache,
+                metrics=metrics,
+                speculative=SpeculativeDecoder(draft, SPECULATIVE_TOKENS) if draft is not None else None
+            )
+            scheduler.start()
+        sessions = SessionStore(SESSION_CACHE_MB * 1024 * 1024, SESSION_IDLE_SECONDS, MAX_SESSIONS)
+        if RESPONSE_CACHE_ENTRIES > 0:
+            response_cache = ResponseCache(RESPONSE_CACHE_ENTRIES, RESPONSE_CACHE_MB * 1024 * 1024, RESPONSE_CACHE_TTL_SECONDS)
+
+    # 最初の /chat が初回だけのコスト（カーネルの準備やメモリ確保）を払わないよう、短い生成を1回行う
+    if WARMUP_TOKENS > 0:
+        with readiness.track("warmup"):
+            prompt = tok.encode("<|im_start|>user\nこんにちは<|im_end|>\n<|im_start|>assistant\n")
+            params = GenerationParams(max_new_tokens=WARMUP_TOKENS, temperature=0.0)
+            if INFERENCE_WORKERS > 1:
+                # どのワーカーに振り分けられても初回のコストを払わないよう、全ワーカーで1回ずつ
+                results = await scheduler.warmup(prompt, params)
+                readiness.progress("warmup", generated_tokens=sum(len(r.token_ids) for r in results), workers=len(results))
+            else:
+                result = await scheduler.generate(prompt, params)
+                readiness.progress("warmup", generated_tokens=len(result.token_ids))
+    else:
+        readiness.skip("warmup", "NEMO_WARMUP_TOKENS=0")
 
-        # ステップ3: 初期化成功
-        startup_error = None  # 成功時はエラーをクリア
-        logger.info("System ready for persona-aware chat with Qwen3-1.7B")
+    tokenizer, model = tok, mdl
 
-    except Exception as e:
-        # 初期化に失敗した場合のエラーハンドリング
-        error_msg = f"Startup error: {e}"
-        logger.error(error_msg)
-        startup_error = error_msg  # エラー状態を記録
+@app.on_event("shutdown")
+async def shutdown_event():
+    """
+    FastAPIサーバー終了時に実行される関数
+    読み込み中なら中断し、生成スケジューラを停止する
+    """
+    if startup_task is not None and not startup_task.done():
+        startup_task.cancel()
+        try:
+            await startup_task
+        except asyncio.CancelledError:
+            pass
+    if scheduler is not None:
+        await scheduler.stop()
+
+def require_ready(component: str, detail: str):
+    """
+    部品がまだ読み込み中なら 503 を返す（Retry-After 付き）
+
+    Args:
+        component (str): 必要な部品の名前
+        detail (str): 読み込み中の場合のエラーメッセージ
+    """
+    if readiness.is_loading(component):
+        raise HTTPException(status_code=503, detail=detail, headers={"Retry-After": "5"})
 
 # =============================================================================
 # APIエンドポイント定義
@@ -119,211 +497,1123 @@ async def root():
     """
     return {
         "message": "Nemotron JP Persona Chat Server v2.0 with Qwen3-1.7B",
-        "status": "error" if startup_error else "running",  # サーバーの状態
+        "status": "error" if startup_error else ("running" if readiness.ready else "loading"),  # サーバーの状態
         "model": MODEL_ID,  # 使用中のモデル名
         "model_loaded": model is not None,  # モデルが正常に読み込まれているか
         "personas_loaded": personas is not None,  # ペルソナが読み込まれているか
         "total_personas": len(personas) if personas else 0,  # ペルソナの総数
+        "history_token_budget": HISTORY_TOKEN_BUDGET,  # プロンプトに使う最大トークン数（クライアントが送る履歴の目安）
         "startup_error": startup_error  # 起動時エラーがあれば表示
     }
 
+def persona_summaries(rows, scores=None) -> List[dict]:
+    """
+    検索結果として返すペルソナの主要項目を取り出す
+
+    Args:
+        rows: ペルソナの行番号
+        scores: 類似度（指定した場合は結果に含める）
+
+    Returns:
+        List[dict]: id と主要項目（説明文は200文字以内）
+    """
+    results = persona_index.fetch(rows, SEARCH_RESULT_FIELDS)
+    for i, (row_id, result) in enumerate(zip(list(map(int, rows)), results)):
+        result["id"] = row_id
+        if scores is not None:
+            result["score"] = round(float(scores[i]), 4)
+        if result.get("persona"):
+            result["persona"] = result["persona"][:200]  # 説明文は200文字以内に制限
+    return results
+
+def load_persona_prompts():
+    """
+    persona_prompts.py で作成したトークン化済みのシステムプロンプトを開く（なければ None）
+
+    データセット・トークナイザーが作成時と異なる場合は使わない（データセットの fingerprint を比べ、
+    さらに先頭のペルソナをその場でトークン化した結果と比べて確認する）。
+
+    Returns:
+        Optional[PersonaPromptStore]: トークン化済みのシステムプロンプト
+    """
+    if not PROMPTS_DIR or not os.path.exists(os.path.join(PROMPTS_DIR, "meta.json")):
+        logger.info("Pre-tokenized persona prompts not found; prompts are tokenized per request")
+        return None
+    try:
+        store = PersonaPromptStore(PROMPTS_DIR)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Could not open persona prompts: {e}")
+        return None
+    if store.rows != len(personas) or store.tokenizer_id != MODEL_ID:
+        logger.warning(f"Persona prompts were built for {store.rows} rows with {store.tokenizer_id}; ignoring them")
+        return None
+    fingerprint = getattr(personas, "_fingerprint", None)
+    if store.fingerprint is not None and fingerprint is not None and store.fingerprint != fingerprint:
+        logger.warning(f"Persona prompts were built from dataset {store.fingerprint}, not {fingerprint}; ignoring them")
+        return None
+    if store.rows and store.ids(0) != tokenizer.encode(build_system_block(build_persona_prompt(persona_row(0, PROMPT_COLUMNS)))):
+        logger.warning("Persona prompts do not match the current tokenizer or dataset; ignoring them")
+        return None
+    return store
+
+def load_persona_vectors():
+    """
+    persona_vectors.py で作成したベクトルを開く（なければ None）
+
+    Returns:
+        Optional[PersonaVectors]: ペルソナのベクトル
+    """
+    if not VECTORS_DIR or not os.path.exists(os.path.join(VECTORS_DIR, "meta.json")):
+        logger.info("Persona vectors not found; similarity search is disabled")
+        return None
+    try:
+        vectors = PersonaVectors(VECTORS_DIR, nprobe=VECTOR_NPROBE)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Could not open persona vectors: {e}")
+        return None
+    if vectors.rows != len(personas):
+        logger.warning(f"Persona vectors cover {vectors.rows} rows but dataset has {len(personas)}; ignoring them")
+        return None
+    fingerprint = getattr(personas, "_fingerprint", None)
+    if vectors.fingerprint is not None and fingerprint is not None and vectors.fingerprint != fingerprint:
+        logger.warning(f"Persona vectors were built from dataset {vectors.fingerprint}, not {fingerprint}; ignoring them")
+        return None
+    if vectors.stats()["ivf_lists"] == 0 and vectors.rows > EXHAUSTIVE_VECTOR_ROWS:
+        logger.warning(
+            f"Persona vectors have no IVF; every similarity query reads all {vectors.rows} vectors "
+            "(rebuild with persona_vectors.py to create one)"
+        )
+    if vectors.model_id != MODEL_ID:
+        logger.warning(f"Persona vectors were built with {vectors.model_id}; text queries are disabled")
+    elif vectors.precision is not None and vectors.precision != PRECISION:
+        logger.warning(
+            f"Persona vectors were built in {vectors.precision} but the server runs in {PRECISION}; "
+            "text query scores may differ slightly (rebuild with persona_vectors.py --precision to match)"
+        )
+    return vectors
+
+@app.get("/personas/search")
+async def search_personas(
+    occupation: Optional[str] = None,
+    region: Optional[str] = None,
+    prefecture: Optional[str] = None,
+    sex: Optional[str] = None,
+    age_min: Optional[int] = None,
+    age_max: Optional[int] = None,
+    q: Optional[str] = None,
+    offset: int = Query(0, ge=0),
+    limit: int = Query(20, ge=1, le=100)
+):
+    """
+    条件に一致するペルソナを検索するエンドポイント
+    例: GET /personas/search?prefecture=大阪&occupation=教師&age_min=40&age_max=49&q=野球
+
+    職業・地域などの条件は部分一致、q は説明文に含まれるキーワード（空白区切りで AND）。
+    起動時に作成したインデックスを使うので、全件を走査せずに結果を返す。
+
+    Args:
+        occupation, region, prefecture, sex (Optional[str]): 部分一致で絞り込む条件
+        age_min, age_max (Optional[int]): 年齢の範囲（両端を含む）
+        q (Optional[str]): 説明文のキーワード
+        offset (int): 何件目から返すか（ページング用）
+        limit (int): 最大何件返すか（1-100）
+
+    Returns:
+        dict: 一致した総数と、指定範囲のペルソナ一覧（id と主要項目）
+    """
+    require_ready("index", "Personas are still loading")
+    if persona_index is None:
+        raise HTTPException(status_code=503, detail="Personas not loaded")
+
+    def search():
+        rows = persona_index.search(
+            keywords=(q or "").replace("　", " ").split(),
+            age_min=age_min,
+            age_max=age_max,
+            occupation=occupation,
+            region=region,
+            prefecture=prefecture,
+            sex=sex
+        )
+        page = rows[offset:offset + limit]
+        return {"total": int(len(rows)), "offset": offset, "limit": limit, "results": persona_summaries(page)}
+
+    # 検索はイベントループを止めないようにスレッドで実行
+    try:
+        return await asyncio.to_thread(search)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.post("/personas/similar")
+async def similar_personas_by_text(req: SimilarPersonaRequest):
+    """
+    文章に似ているペルソナを探すエンドポイント
+    例: POST /personas/similar {"text": "海の近くで暮らす釣り好きの漁師", "k": 5}
+
+    文章は読み込み済みのモデルでベクトル化する（生成と同じ推論スレッドで順番に実行するので、
+    /chat と同じ実行枠を得てから行う）。
+
+    Args:
+        req (SimilarPersonaRequest): 探したいペルソナの説明と件数
+
+    Returns:
+        dict: 似ている順のペルソナ一覧（score はコサイン類似度）
+    """
+    require_ready("vectors", "Personas are still loading")
+    require_ready("warmup", "Model is still loading")
+    if persona_vectors is None or persona_index is None:
+        raise HTTPException(status_code=503, detail="Persona vectors not available")
+    if model is None or scheduler is None or persona_vectors.model_id != MODEL_ID:
+        raise HTTPException(status_code=503, detail="Text queries not available")
+    if not req.text.strip():
+        raise HTTPException(status_code=400, detail="text must not be empty")
+
+    slot = await admit(request_deadline(req))
+    try:
+        query = await scheduler.run_in_inference_thread(
+            embed_texts, model, tokenizer, [req.text], persona_vectors.max_length
+        )
+    finally:
+        slot.release()
+    rows, scores = await asyncio.to_thread(persona_vectors.search, query[0], min(max(req.k, 1), 100))
+    return {"results": persona_summaries(rows, scores)}
+
+@app.get("/personas/{persona_id}/similar")
+async def similar_personas(persona_id: int, k: int = Query(10, ge=1, le=100)):
+    """
+    指定したペルソナに似ているペルソナを探すエンドポイント
+    例: GET /personas/0/similar?k=5
+
+    保存済みのベクトル同士を比べるだけなので、モデルの計算は行わない。
+
+    Args:
+        persona_id (int): 基準にするペルソナのID
+        k (int): 返す件数（1-100）
+
+    Returns:
+        dict: 似ている順のペルソナ一覧（基準のペルソナ自身は含まない）
+    """
+    require_ready("vectors", "Personas are still loading")
+    if persona_vectors is None or persona_index is None:
+        raise HTTPException(status_code=503, detail="Persona vectors not available")
+    if persona_id < 0 or persona_id >= persona_vectors.rows:
+        raise HTTPException(status_code=404, detail="Persona not found")
+
+    rows, scores = await asyncio.to_thread(
+        persona_vectors.search, persona_vectors.vector(persona_id), k, persona_id
+    )
+    return {"persona_id": persona_id, "results": persona_summaries(rows, scores)}
+
+@app.get("/personas")
+async def get_personas(ids: str, fields: Optional[str] = None):
+    """
+    複数のペルソナ情報をまとめて取得するエンドポイント
+    例: GET /personas?ids=0,10,200&fields=occupation,age,region
+
+    1件ずつ /personas/{persona_id} を呼ぶ代わりに、1回のリクエストで取得できる。
+
+    Args:
+        ids (str): 取得したいペルソナのID（カンマ区切り、最大 MAX_BULK_PERSONAS 件）
+        fields (Optional[str]): 返す項目（カンマ区切り、省略時は全項目）
+
+    Returns:
+        dict: 見つかったペルソナ（id 付き、指定順）と、見つからなかったID
+    """
+    require_ready("dataset", "Personas are still loading")
+    if personas is None:
+        raise HTTPException(status_code=503, detail="Personas not loaded")
+    try:
+        id_list = [int(x) for x in ids.split(",") if x.strip()]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="ids must be comma-separated integers")
+    if len(id_list) > MAX_BULK_PERSONAS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BULK_PERSONAS} ids per request")
+    columns = parse_persona_fields(fields)
+
+    found = [i for i in id_list if 0 <= i < len(personas)]
+    results = await asyncio.to_thread(lambda: [dict(persona_row(i, columns), id=i) for i in found])
+    return {"personas": results, "missing": [i for i in id_list if not 0 <= i < len(personas)]}
+
 @app.get("/personas/{persona_id}")
-async def get_persona(persona_id: int):
+async def get_persona(persona_id: int, fields: Optional[str] = None):
     """
     特定のペルソナ情報を取得するエンドポイント
     例: GET /personas/0 で0番目のペルソナ情報を取得
+        GET /personas/0?fields=occupation,age で指定した項目だけを取得
 
     Args:
         persona_id (int): 取得したいペルソナのID（0から開始）
+        fields (Optional[str]): 返す項目（カンマ区切り、省略時は全項目）
 
     Returns:
         dict: ペルソナの詳細情報（職業、年齢、地域、性格など）
     """
     # ペルソナデータが読み込まれているかチェック
+    require_ready("dataset", "Personas are still loading")
     if personas is None:
         raise HTTPException(status_code=503, detail="Personas not loaded")
 
     # 指定されたIDが存在するかチェック
-    if persona_id >= len(personas):
+    if persona_id < 0 or persona_id >= len(personas):
         raise HTTPException(status_code=404, detail="Persona not found")
 
     # ペルソナ情報を返す
-    return personas[persona_id]
+    return persona_row(persona_id, parse_persona_fields(fields))
+
+def persona_row(persona_id: int, columns: Optional[Sequence[str]] = None) -> dict:
+    """
+    ペルソナ1件分の指定した項目を返す
+
+    列指向ストアがあれば必要な項目だけを読み、なければデータセットの行から取り出す。
+
+    Args:
+        persona_id (int): ペルソナのID
+        columns (Optional[Sequence[str]]): 取り出す項目（None なら全項目、存在しない項目は無視）
+
+    Returns:
+        dict: {項目名: 値}
+    """
+    if persona_store is not None:
+        if columns is not None:
+            columns = [c for c in columns if c in persona_store.columns]
+        return persona_store.row(persona_id, columns)
+    row = personas[persona_id]
+    return row if columns is None else {c: row[c] for c in columns if c in row}
+
+def parse_persona_fields(fields: Optional[str]) -> Optional[List[str]]:
+    """
+    fields パラメータ（カンマ区切り）を項目名のリストにする（存在しない項目は400）
+    """
+    if not fields:
+        return None
+    columns = [f.strip() for f in fields.split(",") if f.strip()]
+    known = persona_store.columns if persona_store is not None else personas.column_names
+    unknown = [c for c in columns if c not in known]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    return columns
+
+# =============================================================================
+# チャット処理の共通部分（/chat と /chat/stream で使用）
+# =============================================================================
+
+def require_chat_ready():
+    """
+    チャットに必要な部品（データセット・モデル）がそろっているかチェックする（なければ503）
+    """
+    # サーバー起動時にエラーが発生していないかチェック（読み込み中に失敗した部品も含む）
+    error = startup_error or readiness.failed
+    if error:
+        raise HTTPException(status_code=503, detail=f"System not ready: {error}")
+    require_ready("dataset", "Personas are still loading")
+    require_ready("warmup", "Model is still loading")
+
+def get_chat_persona(req: ChatRequest) -> dict:
+    """
+    システム状態とリクエストの妥当性をチェックし、使用するペルソナのデータを返す
+
+    Args:
+        req (ChatRequest): チャットリクエスト
+
+    Returns:
+        dict: 指定されたペルソナのデータ
+    """
+    require_chat_ready()
+
+    # ペルソナデータが存在し、指定されたペルソナIDが有効かチェック
+    if not personas or not 0 <= req.persona_index < len(personas):
+        raise HTTPException(status_code=400, detail="Invalid persona index")
+
+    # 指定されたペルソナのデータを取得（プロンプトと返答に使う項目だけ）
+    return persona_row(req.persona_index, PROMPT_COLUMNS)
+
+def build_persona_info(persona_data: dict) -> dict:
+    """
+    フロントエンドに返すペルソナ情報を整理する
+
+    Args:
+        persona_data (dict): ペルソナのデータ
+
+    Returns:
+        dict: 説明文（200文字以内）、職業、年齢、地域
+    """
+    return {
+        "persona": persona_data.get("persona", "")[:200],  # 説明文は200文字以内に制限
+        "occupation": persona_data.get("occupation", ""),  # 職業
+        "age": persona_data.get("age", ""),  # 年齢
+        "region": persona_data.get("region", "")  # 出身・居住地
+    }
+
+def fallback_reply(persona_data: dict) -> ChatResponse:
+    """モデルまたはトークナイザーが読み込まれていない場合の簡易応答を作る"""
+    persona_text = persona_data.get("persona", "日本人です")
+    reply = f"{persona_text[:100]}... こんにちは！何かお手伝いできることはありますか？"
+    return ChatResponse(
+        reply=reply,
+        persona_info={"persona": persona_text[:200]}
+    )
+
+async def encode_conversation(req: ChatRequest, persona_data: dict) -> Tuple[List[int], int]:
+    """
+    リクエストからプロンプトを組み立ててトークンIDに変換する
+
+    システムプロンプトは常に残し、会話履歴は新しい発言から順にトークン数の上限
+    （HISTORY_TOKEN_BUDGET）に収まるだけ残す。プロンプトは必ず返答開始タグで終わる。
+    システムプロンプト部分はトークン化済みのデータから取り出し（なければ単独でトークン化し）、
+    先頭の何トークンがペルソナ固有の部分かを返す（プレフィックスキャッシュで prefill を省略するため）。
+    <|im_end|> などの特殊トークンの位置で区切るので、全体を一度にトークン化した
+    結果と同じトークン列になる。
+
+    Args:
+        req (ChatRequest): チャットリクエスト
+        persona_data (dict): 使用するペルソナのデータ
+
+    Returns:
+        Tuple[List[int], int]: プロンプトのトークンIDと、そのうちシステムプロンプト部分のトークン数
+    """
+    turns = [(msg.role, msg.content) for msg in req.messages]
+
+    # 会話テキストをモデルが理解できる数値（トークン）に変換
+    # （トークナイズは他のリクエストを止めないようにスレッドで実行）
+    def encode():
+        system_ids = persona_system_ids(req.persona_index, persona_data)
+        input_ids, dropped = history_compactor.compact(system_ids, turns, req.enable_thinking)
+        if dropped:
+            logger.info(f"Dropped {dropped} oldest turns to fit {HISTORY_TOKEN_BUDGET} tokens")
+        return input_ids, len(system_ids)
+
+    return await asyncio.to_thread(encode)
+
+def persona_system_ids(persona_index: int, persona_data: dict) -> List[int]:
+    """
+    ペルソナのシステムプロンプト部分のトークンIDを返す
+
+    トークン化済みのデータがあればそこから切り出すだけ（文字列の組み立てと
+    トークン化を省略する）。なければその場で組み立ててトークン化する。
+
+    Args:
+        persona_index (int): ペルソナのインデックス
+        persona_data (dict): ペルソナのデータ
+
+    Returns:
+        List[int]: <|im_start|>system ... <|im_end|> 部分のトークンID
+    """
+    if persona_prompts is not None:
+        return persona_prompts.ids(persona_index)
+    return tokenizer.encode(build_system_block(build_persona_prompt(persona_data)))
+
+def generation_params(req: ChatRequest) -> GenerationParams:
+    """リクエストの生成パラメータをスケジューラ用に変換する（範囲外の値は400）"""
+    if req.repetition_penalty <= 0:
+        raise HTTPException(status_code=400, detail="repetition_penalty must be positive")
+    if req.no_repeat_ngram_size < 0:
+        raise HTTPException(status_code=400, detail="no_repeat_ngram_size must not be negative")
+    if req.top_k is not None and req.top_k < 0:
+        raise HTTPException(status_code=400, detail="top_k must not be negative")
+    if req.thinking_budget is not None and req.thinking_budget < 0:
+        raise HTTPException(status_code=400, detail="thinking_budget must not be negative")
+    return GenerationParams(
+        max_new_tokens=req.max_new_tokens,  # 新しく生成するトークン数の上限
+        temperature=req.temperature,  # 生成の創造性（0.0-1.0、0ならグリーディ）
+        top_p=req.top_p,  # nucleus sampling（語彙選択幅）
+        top_k=req.top_k,  # 上位 k 語彙に絞る（None ならモデルの generation_config の値）
+        repetition_penalty=req.repetition_penalty,  # 同じ表現の繰り返しを軽減
+        no_repeat_ngram_size=req.no_repeat_ngram_size,  # n語の組み合わせの繰り返しを防止
+        seed=req.seed,  # サンプリングの乱数のシード
+        thinking_budget=req.thinking_budget if req.enable_thinking else None  # 思考のトークン数の上限
+    )
+
+def generation_stats(result) -> dict:
+    """
+    1回の生成の統計を返す（レスポンスの generation 用）
+
+    Args:
+        result (GenerationResult): スケジューラの生成結果
+
+    Returns:
+        dict: finish_reason・prompt_tokens・generated_tokens・tokens_per_second（デコード部分）、
+        推測デコードを使った場合は draft_tokens・accepted_draft_tokens・acceptance_rate も含む
+    """
+    generated = len(result.token_ids)
+    decode_seconds = result.timings.get("decode", 0.0)
+    stats = {
+        "finish_reason": result.finish_reason,
+        "prompt_tokens": result.prompt_tokens,
+        "generated_tokens": generated,
+        # 最初のトークンは prefill で出るので、デコードの速度には含めない
+        "tokens_per_second": round((generated - 1) / decode_seconds, 2) if generated > 1 and decode_seconds > 0 else None,
+    }
+    if result.draft_tokens:
+        stats["draft_tokens"] = result.draft_tokens
+        stats["accepted_draft_tokens"] = result.accepted_draft_tokens
+        stats["acceptance_rate"] = round(result.accepted_draft_tokens / result.draft_tokens, 4)
+    return stats
+
+def response_cache_key(req: ChatRequest, params: GenerationParams, namespace: str) -> Optional[str]:
+    """
+    応答キャッシュのキーを返す（キャッシュが無効、または決定的でないリクエストなら None）
+
+    Args:
+        req (ChatRequest): チャットリクエスト
+        params (GenerationParams): 生成パラメータ
+        namespace (str): 呼び出し元（/chat と /chat/stream は返す値の形式が違うので区別する）
+
+    Returns:
+        Optional[str]: キャッシュのキー
+    """
+    if response_cache is None:
+        return None
+    if not is_deterministic(params):
+        response_cache.skip()
+        return None
+    messages = [(msg.role, msg.content) for msg in req.messages]
+    # 思考モードの有無はプロンプトが変わるのでキーに含める
+    return cache_key(MODEL_ID, req.persona_index, messages, params, namespace, {"enable_thinking": req.enable_thinking})
+
+def request_deadline(req) -> Optional[float]:
+    """
+    リクエストの期限（イベントループの時刻）を返す（期限なしなら None）
+
+    timeout_seconds の指定があればそれを使うが、NEMO_REQUEST_TIMEOUT_SECONDS より長くはしない
+    （timeout_seconds のないリクエストは NEMO_REQUEST_TIMEOUT_SECONDS）。
+    """
+    timeouts = [t for t in (getattr(req, "timeout_seconds", None), REQUEST_TIMEOUT_SECONDS) if t is not None and t > 0]
+    return asyncio.get_running_loop().time() + min(timeouts) if timeouts else None
+
+async def admit(deadline: Optional[float]):
+    """
+    生成の実行枠を得る（待ち行列が埋まっていれば429、期限までに空かなければ503）
+
+    Args:
+        deadline (Optional[float]): リクエストの期限
+
+    Returns:
+        AdmissionSlot: 実行枠（生成が終わったら release() する）
+    """
+    timeout = None if deadline is None else max(0.0, deadline - asyncio.get_running_loop().time())
+    try:
+        return await admission.acquire(timeout)
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=429, detail="Too many requests", headers={"Retry-After": str(e.retry_after)})
+    except DeadlineExceeded as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(admission.retry_after())})
+
+async def admit_batch_item():
+    """
+    一括生成の1件分の実行枠を得る（期限なし）
+
+    待ち行列が埋まっている場合は断らずに Retry-After の秒数だけ待ってから並ぶ
+    （一括生成が待ち行列を埋め続けて /chat が429になるのを避ける。拒否の件数にも数えない）。
+
+    Returns:
+        AdmissionSlot: 実行枠（生成が終わったら release() する）
+    """
+    while admission.queue_full():
+        await asyncio.sleep(admission.retry_after())
+    return await admission.acquire(None)
+
+async def guarded(request: Request, awaitable, deadline: Optional[float]):
+    """
+    クライアントの切断と期限を監視しながら生成を待つ（どちらかが起きたら生成を取り消す）
+
+    切断は 499（クライアントには届かないが、メトリクスで区別する）、期限切れは 504 にする。
+    """
+    try:
+        return await watch_request(request, awaitable, deadline)
+    except ClientDisconnected:
+        raise HTTPException(status_code=499, detail="Client disconnected")
+    except DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=str(e))
 
 @app.post("/chat", response_model=ChatResponse)
-async def chat(req: ChatRequest):
+async def chat(req: ChatRequest, request: Request, response: Response):
     """
     メインのチャットエンドポイント
     ユーザーのメッセージを受け取り、指定されたペルソナでAIが返答する
 
+    段階ごとの所要時間は /metrics に記録され、NEMO_SERVER_TIMING=1 なら
+    Server-Timing ヘッダーでも返す。
+
+    同時実行数を超えたリクエストは待ち行列で待ち、待ち行列も埋まっていれば429を返す。
+    期限を過ぎた場合やクライアントが切断した場合は、生成を途中で取り消す。
+
     Args:
         req (ChatRequest): チャットリクエスト（会話履歴、ペルソナID、生成パラメータなど）
+        request (Request): 切断の検出用のリクエスト
+        response (Response): ヘッダー設定用のレスポンス
 
     Returns:
         ChatResponse: AIの返答とペルソナ情報
     """
+    timer = metrics.timer("chat")
+    deadline = request_deadline(req)
     try:
         # =================================================================
         # ステップ1: システム状態とリクエストの妥当性チェック
         # =================================================================
-
-        # サーバー起動時にエラーが発生していないかチェック
-        if startup_error:
-            raise HTTPException(status_code=503, detail=f"System not ready: {startup_error}")
-
-        # ペルソナデータが存在し、指定されたペルソナIDが有効かチェック
-        if not personas or req.persona_index >= len(personas):
-            raise HTTPException(status_code=400, detail="Invalid persona index")
-
-        # 指定されたペルソナのデータを取得
-        persona_data = personas[req.persona_index]
+        with timer.stage("persona"):
+            persona_data = get_chat_persona(req)
 
         # =================================================================
         # ステップ2: モデル未読み込み時のフォールバック処理
         # =================================================================
+        if model is None or tokenizer is None:
+            return fallback_reply(persona_data)
+
+        # 決定的なリクエストで、同じ内容の返答を保存済みならそれを返す
+        params = generation_params(req)
+        with timer.stage("cache"):
+            key = response_cache_key(req, params, "chat")
+            cached = response_cache.get(key) if key is not None else None
+        if cached is not None:
+            timer.finish()
+            if SERVER_TIMING:
+                response.headers["Server-Timing"] = timer.server_timing()
+            return ChatResponse(reply=cached["reply"], persona_info=build_persona_info(persona_data))
+
+        # 生成の実行枠を得る（空くまで待ち行列で待つ）
+        with timer.stage("admission"):
+            slot = await admit(deadline)
+        try:
+            # =================================================================
+            # ステップ3: プロンプトの構築とトークン化
+            # =================================================================
+            with timer.stage("encode"):
+                input_ids, prefix_len = await encode_conversation(req, persona_data)
+
+            # =================================================================
+            # ステップ4: AIによるテキスト生成
+            # =================================================================
+
+            # スケジューラに投入し、他のリクエストと同じバッチでデコードされるのを待つ
+            # （システムプロンプト部分はペルソナごとのKVキャッシュを再利用する。
+            #   クライアントが切断したり期限を過ぎたりしたら生成を取り消す）
+            result = await guarded(request, scheduler.generate(
+                input_ids,
+                params,
+                prefix_key=req.persona_index,
+                prefix_len=prefix_len
+            ), deadline)
+            timer.add_generation(result.timings)
+        finally:
+            slot.release()
+
+        # 生成されたトークン（プロンプトは含めない）を人間が読める文字列に変換
+        with timer.stage("detokenize"):
+            generated_text = await asyncio.to_thread(
+                tokenizer.decode, result.token_ids, skip_special_tokens=True
+            )
+
+        # =================================================================
+        # ステップ5: レスポンスの後処理
+        # =================================================================
+
+        with timer.stage("postprocess"):
+            reply = strip_think(generated_text)
+
+        if key is not None:
+            response_cache.put(key, {"reply": reply})
+        timer.finish()
+        if SERVER_TIMING:
+            response.headers["Server-Timing"] = timer.server_timing()
+
+        # ChatResponse形式でレスポンスを返す
+        return ChatResponse(
+            reply=reply,  # AIの返答
+            persona_info=build_persona_info(persona_data),  # ペルソナ詳細
+            generation=generation_stats(result)  # 生成の統計
+        )
+
+    except HTTPException as e:
+        # 読み込み中（503）や不正なペルソナ番号（400）はそのまま返す
+        timer.finish(str(e.status_code))
+        raise
+    except Exception as e:
+        # エラーが発生した場合のハンドリング
+        timer.finish("error")
+        logger.error(f"Chat error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/chat/stream")
+async def chat_stream(req: ChatRequest, request: Request):
+    """
+    ストリーミング版のチャットエンドポイント（Server-Sent Events）
+    生成されたトークンをその都度送るので、最初の文字が表示されるまでの時間が短くなる
+
+    送信するイベント:
+        persona: ペルソナ情報（最初に1回）
+        token: 返答テキストの差分 {"text": "..."}（<think>部分は除去済み）
+        done: 生成終了 {"finish_reason": "...", "generated_tokens": N}（応答キャッシュから返した場合は "cached": true 付き）
+        error: エラー発生時・期限切れ時 {"detail": "..."}
+
+    同時実行数と待ち行列が埋まっている場合は、ストリームを始めずに429を返す。
+    /chat と同じく、スケジューラの待ち行列や prefill の間も期限と切断を監視し、
+    期限を過ぎたら error イベントを送って生成を取り消す。
 
-        # モデルまたはトークナイザーが読み込まれていない場合の簡易応答
+    Args:
+        req (ChatRequest): チャットリクエスト（/chat と同じ形式）
+        request (Request): 切断の検出用のリクエスト
+
+    Returns:
+        StreamingResponse: text/event-stream 形式のレスポンス
+    """
+    # 妥当性チェック・応答キャッシュの確認・実行枠の確保はストリーム開始前に行い、
+    # 通常のHTTPエラー（400・429・503など）として返す
+    timer = metrics.timer("chat_stream")
+    deadline = request_deadline(req)
+    with timer.stage("persona"):
+        persona_data = get_chat_persona(req)
+
+    # 決定的なリクエストで、同じ内容の返答を保存済みならまとめて1回で送る（実行枠は不要）
+    params = generation_params(req)
+    with timer.stage("cache"):
+        key = response_cache_key(req, params, "chat_stream")
+        cached = response_cache.get(key) if key is not None else None
+
+    slot = None
+    if cached is None and model is not None and tokenizer is not None:
+        with timer.stage("admission"):
+            try:
+                slot = await admit(deadline)
+            except HTTPException as e:
+                timer.finish(str(e.status_code))
+                raise
+
+    def release_slot():
+        if slot is not None:
+            slot.release()
+
+    async def events():
+        yield "persona", build_persona_info(persona_data)
+
+        # モデル未読み込み時は簡易応答を1回で送る
         if model is None or tokenizer is None:
-            persona_text = persona_data.get("persona", "日本人です")
-            reply = f"{persona_text[:100]}... こんにちは！何かお手伝いできることはありますか？"
-            return ChatResponse(
-                reply=reply,
-                persona_info={"persona": persona_text[:200]}
+            yield "token", {"text": fallback_reply(persona_data).reply}
+            yield "done", {"finish_reason": "fallback", "generated_tokens": 0}
+            return
+
+        status = "cancelled"
+        try:
+            if cached is not None:
+                if cached["text"]:
+                    yield "token", {"text": cached["text"]}
+                yield "done", {"finish_reason": cached["finish_reason"], "generated_tokens": cached["generated_tokens"], "cached": True}
+                status = "ok"
+                return
+
+            with timer.stage("encode"):
+                input_ids, prefix_len = await encode_conversation(req, persona_data)
+            decoder = IncrementalDecoder(tokenizer)
+            think_filter = ThinkTagFilter()
+            generated_tokens = 0
+            detokenize_seconds = 0.0
+            finish_reason = "length"
+            pieces = []  # 送ったテキスト（応答キャッシュに保存する用）
+
+            # トークンが生成されるたびに差分テキストを送る
+            # （クライアントが切断するとこのループが中断され、生成も取り消される）
+            stream = scheduler.stream(
+                input_ids,
+                params,
+                prefix_key=req.persona_index,
+                prefix_len=prefix_len
             )
+            async with aclosing(stream) as tokens:
+                while True:
+                    # 次のトークンを待つ間も期限と切断を監視する（待ち行列や prefill で止まっていても打ち切り、
+                    # 生成も取り消される）
+                    try:
+                        token = await watch_request(request, tokens.__anext__(), deadline)
+                    except StopAsyncIteration:
+                        break
+                    generated_tokens += 1
+                    if token in scheduler.eos_token_ids:
+                        finish_reason = "stop"
+                    started = time.perf_counter()
+                    text = think_filter.feed(decoder.push(token))
+                    detokenize_seconds += time.perf_counter() - started
+                    if text:
+                        pieces.append(text)
+                        yield "token", {"text": text}
+
+            rest = think_filter.flush()
+            timer.add("detokenize", detokenize_seconds)
+            if rest:
+                pieces.append(rest)
+                yield "token", {"text": rest}
+            if key is not None:
+                response_cache.put(key, {"text": "".join(pieces), "finish_reason": finish_reason, "generated_tokens": generated_tokens})
+            yield "done", {"finish_reason": finish_reason, "generated_tokens": generated_tokens}
+            status = "ok"
+
+        except DeadlineExceeded as e:
+            status = "504"
+            yield "error", {"detail": str(e)}
+        except ClientDisconnected:
+            status = "499"
+        except Exception as e:
+            status = "error"
+            logger.error(f"Chat stream error: {e}")
+            yield "error", {"detail": str(e)}
+        finally:
+            # クライアントが途中で切断した場合は cancelled として記録
+            release_slot()
+            timer.finish(status)
+
+    # sse-starlette があれば使い（keep-alive の ping 付き）、なければ自前で整形する
+    # （ストリームが始まる前に切断された場合も、background で実行枠を返す）
+    if EventSourceResponse is not None:
+        return EventSourceResponse(
+            ({"event": event, "data": json.dumps(data, ensure_ascii=False)}
+             async for event, data in events()),
+            background=BackgroundTask(release_slot)
+        )
+    return StreamingResponse(
+        (format_sse(event, data) async for event, data in events()),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=BackgroundTask(release_slot)
+    )
 
-        # ペルソナ情報の抽出
+# =============================================================================
+# 一括生成API（評価用データなど、大量のリクエストをまとめて処理）
+# =============================================================================
 
-        # ペルソナデータから各項目を取得（存在しない場合は空文字）
-        persona_description = persona_data.get("persona", "")  # 人物の詳細説明
-        occupation = persona_data.get("occupation", "")  # 職業
-        age = persona_data.get("age", "")  # 年齢
-        region = persona_data.get("region", "")  # 出身・居住地
+def parse_batch_line(line: str) -> Tuple[Optional[ChatRequest], Optional[str], Optional[dict]]:
+    """
+    /chat/batch の1行（ChatRequest の JSON、任意で "id" 付き）を解析する
 
-        # ペルソナプロンプトの構築
+    Args:
+        line (str): JSONL の1行
 
-        # 存在するペルソナ情報のみをリストに追加
-        persona_parts = []
-        if persona_description:
-            persona_parts.append(f"人物像：{persona_description}")
-        if occupation:
-            persona_parts.append(f"職業：{occupation}")
-        if age:
-            persona_parts.append(f"年齢：{age}歳")
-        if region:
-            persona_parts.append(f"出身・居住地：{region}")
+    Returns:
+        Tuple[Optional[ChatRequest], Optional[str], Optional[dict]]: リクエスト、id、エラー（解析できなかった場合）
+    """
+    try:
+        data = json.loads(line)
+    except json.JSONDecodeError as e:
+        return None, None, {"status": 400, "detail": f"Invalid JSON: {e}"}
+    if not isinstance(data, dict):
+        return None, None, {"status": 400, "detail": "Each line must be a JSON object"}
+    item_id = data.pop("id", None)
+    try:
+        return ChatRequest.model_validate(data), item_id, None
+    except ValidationError as e:
+        detail = [{"loc": list(err["loc"]), "msg": err["msg"]} for err in e.errors()]
+        return None, item_id, {"status": 422, "detail": detail}
 
-        # ペルソナ情報を改行で結合（情報がない場合はデフォルト）
-        persona_info_text = "\n".join(persona_parts) if persona_parts else "一般的な日本人"
+async def prepare_batch_item(req: ChatRequest) -> dict:
+    """
+    一括生成の1件分について、ペルソナの取得・応答キャッシュの確認・トークン化を行う
 
-        # AIに与えるシステムプロンプトを作成
-        persona_prompt = f"""あなたは以下のペルソナの人物として、その人になりきって自然な日本語で返答してください。メタ的な説明や分析は一切せず、その人物そのものとして話してください。
+    Returns:
+        dict: {"persona_data", "params", "key", "cached"} と、キャッシュになければ {"input_ids", "prefix_len"}
+    """
+    persona_data = get_chat_persona(req)
+    params = generation_params(req)
+    key = response_cache_key(req, params, "chat")
+    item = {"persona_data": persona_data, "params": params, "key": key, "cached": None}
+    item["cached"] = response_cache.get(key) if key is not None else None
+    if item["cached"] is None:
+        item["input_ids"], item["prefix_len"] = await encode_conversation(req, persona_data)
+    return item
+
+async def run_batch_item(req: ChatRequest, item: dict) -> dict:
+    """
+    一括生成の1件分を生成し、/chat と同じ形式の返答にする
 
-【あなたの人物像】
-{persona_info_text}
+    Returns:
+        dict: {"reply", "persona_info", "finish_reason", "prompt_tokens", "generated_tokens", "tokens_per_second", ...}
+        （推測デコードを使った場合は draft_tokens・accepted_draft_tokens・acceptance_rate も含む）
+    """
+    persona_info = build_persona_info(item["persona_data"])
+    if item["cached"] is not None:
+        return {"reply": item["cached"]["reply"], "persona_info": persona_info, "cached": True}
+
+    result = await scheduler.generate(
+        item["input_ids"],
+        item["params"],
+        prefix_key=req.persona_index,
+        prefix_len=item["prefix_len"]
+    )
+    generated_text = await asyncio.to_thread(
+        tokenizer.decode, result.token_ids, skip_special_tokens=True
+    )
+    reply = strip_think(generated_text)
+    if item["key"] is not None:
+        response_cache.put(item["key"], {"reply": reply})
+    return {
+        "reply": reply,
+        "persona_info": persona_info,
+        **generation_stats(result),
+    }
 
-この人物として、自然な口調と視点で会話してください。その人の経験、価値観、話し方で返答してください。"""
+def batch_error(e: Exception) -> dict:
+    """一括生成の1件分のエラーを返す形式にする"""
+    if isinstance(e, HTTPException):
+        return {"status": e.status_code, "detail": e.detail}
+    return {"status": 500, "detail": str(e)}
 
-        # 会話履歴の構築
+@app.post("/chat/batch")
+async def chat_batch(request: Request):
+    """
+    一括生成エンドポイント（JSONL で受け取り、NDJSON で返す）
 
-        # メッセージリストを初期化し、まずシステムプロンプトを追加
-        messages = []
-        messages.append({"role": "system", "content": persona_prompt})
+    1行に1つの ChatRequest（任意で "id" を付けられる）を受け取り、全件をトークン化してから
+    プロンプトの長さ順に並べ、同時に最大 NEMO_MAX_BATCH_SIZE 件ずつスケジューラに投入する
+    （長さの近いシーケンスが同じバッチに入るので、パディングの無駄が少ない）。
+    1件ずつ /chat と同じ実行枠を得てから生成するので、同時実行数の上限は一括生成にも効く。
 
-        # リクエストから過去の会話履歴を追加
-        # これによりAIが会話の文脈を理解し、ペルソナを一貫して維持できる
-        for msg in req.messages:
-            if msg.role == "user":
-                messages.append({"role": "user", "content": msg.content})
-            else:
-                messages.append({"role": "assistant", "content": msg.content})
-
-        # Qwen3専用フォーマットへの変換
-
-        # Qwen3が理解できる特殊トークン形式に変換
-        # <|im_start|>と<|im_end|>はQwen3の会話形式で必要な区切り文字
-        conversation = ""
-        for msg in messages:
-            if msg["role"] == "system":
-                conversation += f"<|im_start|>system\n{msg['content']}<|im_end|>\n"
-            elif msg["role"] == "user":
-                conversation += f"<|im_start|>user\n{msg['content']}<|im_end|>\n"
-            elif msg["role"] == "assistant":
-                conversation += f"<|im_start|>assistant\n{msg['content']}<|im_end|>\n"
-
-        # AIの返答を促すための開始タグを追加
-        conversation += "<|im_start|>assistant\n"
-
-        # テキストのトークン化
-
-        # 会話テキストをモデルが理解できる数値（トークン）に変換
-        inputs = tokenizer.encode(
-            conversation,
-            return_tensors="pt",  # PyTorchテンソル形式で返す
-            max_length=1024,  # 最大1024トークンまで（Qwen3-1.7Bに合わせて調整）
-            truncation=True  # 長すぎる場合は切り詰める
-        ).to(model.device)  # モデルと同じデバイス（GPU/CPU）に配置
-
-        # AIによるテキスト生成
-
-        # 推論モード（勾配計算なし）でメモリ効率よく生成
-        with torch.inference_mode():
-            outputs = model.generate(
-                inputs,
-                max_new_tokens=req.max_new_tokens,  # 新しく生成するトークン数の上限
-                do_sample=True,  # ランダムサンプリングを有効にする
-                temperature=req.temperature,  # 生成の創造性（0.0-1.0）
-                top_p=req.top_p,  # nucleus sampling（語彙選択幅）
-                pad_token_id=tokenizer.pad_token_id,  # パディング用トークン
-                eos_token_id=tokenizer.eos_token_id,  # 終了トークン
-                repetition_penalty=1.1,  # 同じ表現の繰り返しを軽減
-                no_repeat_ngram_size=2  # 2語の組み合わせの繰り返しを防止
-            )
+    結果は入力の順番で、1行に1件ずつ返す（前の行が終わりしだい送る）:
+        {"index": 0, "id": ..., "reply": "...", "persona_info": {...}, "finish_reason": "...",
+         "prompt_tokens": N, "generated_tokens": M, "tokens_per_second": T}
+    1件の失敗で全体は止めず、その行だけエラーを返す:
+        {"index": 1, "id": ..., "error": {"status": 400, "detail": "..."}}
 
-        # 生成結果のデコード
+    Args:
+        request (Request): 本文が JSONL のリクエスト
 
-        # 生成されたトークンを人間が読める文字列に変換
-        generated_text = tokenizer.decode(outputs[0], skip_special_tokens=True)
+    Returns:
+        StreamingResponse: application/x-ndjson 形式のレスポンス
+    """
+    require_chat_ready()
+    if model is None or tokenizer is None:
+        raise HTTPException(status_code=503, detail="Model is not loaded")
+
+    lines = []
+    async for chunk in request.stream():
+        lines.append(chunk)
+    lines = [line for line in b"".join(lines).decode("utf-8").splitlines() if line.strip()]
+    if len(lines) > MAX_BATCH_REQUESTS:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_BATCH_REQUESTS} requests per batch")
+
+    async def results():
+        timer = metrics.timer("chat_batch")
+        parsed = [parse_batch_line(line) for line in lines]
+        outputs: dict = {}  # 入力の番号 → 結果の行
+        items: dict = {}  # 入力の番号 → 生成の準備ができた項目
+        done = asyncio.Queue()  # 終わった入力の番号
+
+        # ペルソナの取得とトークン化（エラーの行はこの時点で結果が決まる）
+        with timer.stage("encode"):
+            for index, (req, item_id, error) in enumerate(parsed):
+                if error is None:
+                    try:
+                        items[index] = await prepare_batch_item(req)
+                    except Exception as e:
+                        error = batch_error(e)
+                if error is not None:
+                    outputs[index] = {"index": index, "id": item_id, "error": error}
+
+        # プロンプトの短い順に、同時に MAX_BATCH_SIZE 件までスケジューラに投入する
+        order = sorted(items, key=lambda i: len(items[i].get("input_ids", ())))
+        pending = iter(order)
+
+        async def worker():
+            for index in pending:
+                req, item_id, _ = parsed[index]
+                try:
+                    # キャッシュにない項目は /chat と同じ実行枠を得てから生成する
+                    slot = await admit_batch_item() if items[index]["cached"] is None else None
+                    try:
+                        output = await run_batch_item(req, items[index])
+                    finally:
+                        if slot is not None:
+                            slot.release()
+                    outputs[index] = {"index": index, "id": item_id, **output}
+                except Exception as e:
+                    logger.error(f"Batch item {index} failed: {e}")
+                    outputs[index] = {"index": index, "id": item_id, "error": batch_error(e)}
+                done.put_nowait(index)
+
+        workers = [asyncio.create_task(worker()) for _ in range(min(MAX_BATCH_SIZE, len(order)))]
+        status = "cancelled"
+        try:
+            # 入力の順番で、次の行の結果が出そろいしだい送る
+            for index in range(len(parsed)):
+                while index not in outputs:
+                    await done.get()
+                yield json.dumps(outputs.pop(index), ensure_ascii=False) + "\n"
+            status = "ok"
+        finally:
+            # クライアントが切断した場合は残りの生成を取り消す
+            for task in workers:
+                task.cancel()
+            timer.finish(status)
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
 
+# =============================================================================
+# 会話セッションAPI（サーバー側で履歴とKVキャッシュを保持）
+# =============================================================================
 
-        # レスポンスの後処理
+def get_session_or_404(session_id: str):
+    """セッションを取得する（存在しない場合は404エラー）"""
+    session = sessions.get(session_id) if sessions else None
+    if session is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    return session
+
+def session_info(session, persona_info: Optional[dict] = None) -> SessionInfo:
+    """セッションの状態をレスポンス形式にまとめる"""
+    return SessionInfo(
+        session_id=session.session_id,
+        persona_index=session.persona_index,
+        turns=len(session.turns),
+        context_tokens=len(session.token_ids),
+        kv_cached=session.kv is not None,
+        persona_info=persona_info
+    )
+
+@app.post("/sessions", response_model=SessionInfo)
+async def create_session(req: SessionCreateRequest):
+    """
+    会話セッションを作成するエンドポイント
+    以降は /sessions/{session_id}/messages に新しい発言だけを送ればよい
 
-        # まず<think>タグとその内容を除去
-        import re
-        cleaned_text = re.sub(r'<think>.*?</think>', '', generated_text, flags=re.DOTALL)
-        cleaned_text = re.sub(r'</?think[^>]*>', '', cleaned_text)
+    Args:
+        req (SessionCreateRequest): 使用するペルソナ
 
-        # assistant以降の部分のみを抽出
-        if "assistant" in cleaned_text:
-            # 最後のassistantの位置を探す
-            assistant_parts = cleaned_text.split("assistant")
-            if len(assistant_parts) > 1:
-                # 最後のassistant以降の部分を取得
-                reply = assistant_parts[-1].strip()
-            else:
-                reply = cleaned_text
-        else:
-            reply = cleaned_text
+    Returns:
+        SessionInfo: 作成したセッションの情報（session_id を含む）
+    """
+    persona_data = get_chat_persona(req)
+    if model is None or tokenizer is None or sessions is None:
+        raise HTTPException(status_code=503, detail="Model not loaded")
 
+    # システムプロンプト部分を先にトークン化しておく（/chat と同じトークン列になる）
+    system_ids = await asyncio.to_thread(persona_system_ids, req.persona_index, persona_data)
+    session = sessions.create(req.persona_index, system_ids)
+    return session_info(session, build_persona_info(persona_data))
 
-        # レスポンス情報の構築
+@app.get("/sessions/{session_id}", response_model=SessionInfo)
+async def get_session(session_id: str):
+    """
+    セッションの状態を取得するエンドポイント
 
-        # フロントエンドに返すペルソナ情報を整理
-        persona_info = {
-            "persona": persona_description[:200],  # 説明文は200文字以内に制限
-            "occupation": occupation,  # 職業
-            "age": age,  # 年齢
-            "region": region  # 出身・居住地
-        }
+    Args:
+        session_id (str): セッションID
 
-        # ChatResponse形式でレスポンスを返す
-        return ChatResponse(
-            reply=reply,  # AIの返答
-            persona_info=persona_info  # ペルソナ詳細
+    Returns:
+        SessionInfo: ターン数、保持しているトークン数など
+    """
+    return session_info(get_session_or_404(session_id))
+
+@app.delete("/sessions/{session_id}")
+async def delete_session(session_id: str):
+    """
+    セッションを削除するエンドポイント（保持しているKVキャッシュも解放される）
+
+    Args:
+        session_id (str): セッションID
+    """
+    if not sessions or not sessions.delete(session_id):
+        raise HTTPException(status_code=404, detail="Session not found")
+    return {"deleted": session_id}
+
+@app.post("/sessions/{session_id}/messages", response_model=SessionMessageResponse)
+async def session_message(session_id: str, req: SessionMessageRequest, request: Request, response: Response):
+    """
+    セッションにユーザーの発言を追加し、AIの返答を返すエンドポイント
+
+    前のターンまでのトークン列とKVキャッシュはサーバーが保持しているので、
+    prefill するのは今回のユーザー発言（と返答開始タグ）の部分だけになる。
+
+    Args:
+        session_id (str): セッションID
+        req (SessionMessageRequest): ユーザーの発言と生成パラメータ
+        request (Request): 切断の検出用のリクエスト
+        response (Response): ヘッダー設定用のレスポンス
+
+    Returns:
+        SessionMessageResponse: AIの返答と、今回 prefill したトークン数など
+    """
+    require_chat_ready()
+    if model is None or tokenizer is None:
+        raise HTTPException(status_code=503, detail="Model not loaded")
+    session = get_session_or_404(session_id)
+    timer = metrics.timer("session_message")
+    deadline = request_deadline(req)
+
+    try:
+        # 同じセッションへの発言は1つずつ順番に処理する
+        async with session.lock:
+            user_block = f"<|im_start|>user\n{req.content}<|im_end|>\n" + generation_prompt(req.enable_thinking)
+            with timer.stage("encode"):
+                if len(session.token_ids) > session.system_len:
+                    # 前の返答の続き（上限で止まった場合は <|im_end|> を補って閉じる）
+                    closing = "" if session.token_ids[-1] == tokenizer.convert_tokens_to_ids("<|im_end|>") else "<|im_end|>"
+                    new_ids = await asyncio.to_thread(tokenizer.encode, closing + "\n" + user_block)
+                else:
+                    new_ids = await asyncio.to_thread(tokenizer.encode, user_block)
+            prompt_ids = session.token_ids + new_ids
+            past = session.kv
+            dropped = 0
+
+            # 会話が長くなりすぎた場合は、/chat と同じ上限に収まるよう古い発言を捨てて組み立て直す（KVは作り直し）
+            if len(prompt_ids) + req.max_new_tokens > SESSION_MAX_TOKENS:
+                turns = [(t["role"], t["content"]) for t in session.turns] + [("user", req.content)]
+                prompt_ids, dropped = await asyncio.to_thread(
+                    history_compactor.compact, session.token_ids[:session.system_len], turns, req.enable_thinking
+                )
+                logger.info(f"Session {session_id} exceeded {SESSION_MAX_TOKENS} tokens, dropping {dropped} oldest turns")
+                past = None
+
+            # 計算済みのKVがあればその続きから、なければペルソナのプレフィックスキャッシュを使う
+            # （切断・期限切れで取り消した場合、セッションの状態は変えない）
+            with timer.stage("admission"):
+                slot = await admit(deadline)
+            try:
+                result = await guarded(request, scheduler.generate(
+                    prompt_ids,
+                    generation_params(req),
+                    prefix_key=session.persona_index,
+                    prefix_len=session.system_len,
+                    past=past,
+                    return_cache=True
+                ), deadline)
+            finally:
+                slot.release()
+            timer.add_generation(result.timings)
+
+            # 次のターンのために会話全体のトークン列とKVを保存（組み立て直した場合は捨てた発言も削除）
+            session.token_ids = prompt_ids + result.token_ids
+            session.kv = result.cache
+            session.turns = session.turns[dropped:]
+
+            # 生成部分だけをデコードし、<think>部分を除去
+            with timer.stage("detokenize"):
+                generated_text = await asyncio.to_thread(
+                    tokenizer.decode, result.token_ids, skip_special_tokens=True
+                )
+            with timer.stage("postprocess"):
+                reply = strip_think(generated_text)
+
+            session.turns.append({"role": "user", "content": req.content})
+            session.turns.append({"role": "assistant", "content": reply})
+
+        # アイドル状態のセッションやメモリ上限を超えたKVを整理
+        sessions.evict()
+
+        timer.finish()
+        if SERVER_TIMING:
+            response.headers["Server-Timing"] = timer.server_timing()
+        return SessionMessageResponse(
+            reply=reply,
+            session_id=session_id,
+            turns=len(session.turns),
+            context_tokens=len(session.token_ids),
+            prefilled_tokens=len(prompt_ids) - (kv_length(past) if past else 0),
+            generation=generation_stats(result)
         )
 
+    except HTTPException as e:
+        # 混雑（429）・期限切れ（504）・切断（499）はそのまま返す
+        timer.finish(str(e.status_code))
+        raise
     except Exception as e:
-        # エラーが発生した場合のハンドリング
-        logger.error(f"Chat error: {e}")
+        timer.finish("error")
+        logger.error(f"Session chat error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/health")
@@ -333,57 +1623,101 @@ async def health_check():
     外部監視システムやロードバランサーから定期的に呼び出される
 
     Returns:
-        dict: サーバーの状態情報（healthy/unhealthy, モデル読み込み状況など）
+        dict: サーバーの状態情報（healthy/starting/unhealthy, モデル読み込み状況など）
     """
+    error = startup_error or readiness.failed
     return {
-        "status": "unhealthy" if startup_error else "healthy",  # 全体的な健康状態
+        "status": "unhealthy" if error else ("healthy" if readiness.ready else "starting"),  # 全体的な健康状態
+        "live": True,  # プロセスが応答できるか（応答できていれば常に True）
+        "ready": readiness.ready and not error,  # チャットを受け付けられるか
+        "startup": readiness.stats(),  # 部品ごとの読み込み状態と所要時間
         "model": MODEL_ID,  # 使用モデル名
         "model_loaded": model is not None,  # モデルが読み込まれているか
         "personas_loaded": personas is not None,  # ペルソナが読み込まれているか
         "total_personas": len(personas) if personas else 0,  # ペルソナ総数
-        "startup_error": startup_error  # 起動エラーの詳細（あれば）
+        "startup_error": error,  # 起動エラーの詳細（あれば）
+        "scheduler": scheduler.stats() if scheduler else None,  # バッチ生成の稼働状況（集計トークン/秒など）
+        "admission": admission.stats(),  # 実行中・待機中のリクエスト数と、拒否（429）・期限切れの件数
+        "prefix_cache": prefix_cache.stats() if prefix_cache else None,  # システムプロンプトKVキャッシュのヒット率など
+        "response_cache": response_cache.stats() if response_cache else None,  # 決定的な生成の応答キャッシュのヒット率など
+        "sessions": sessions.stats() if sessions else None,  # 会話セッション数とKVキャッシュ使用量
+        "history": history_compactor.stats() if history_compactor else None,  # 履歴圧縮のキャッシュヒット率など
+        "persona_vectors": persona_vectors.stats() if persona_vectors else None,  # 類似検索用ベクトルの件数・IVF設定
+        "persona_prompts": persona_prompts.stats() if persona_prompts else None,  # トークン化済みシステムプロンプトの件数
+        "persona_store": persona_store.stats() if persona_store else None  # ペルソナの列指向ストアの件数とサイズ
     }
 
+@app.get("/metrics")
+async def get_metrics():
+    """
+    Prometheus 形式のメトリクスを返すエンドポイント
+
+    - nemo_stage_seconds: エンドポイント・段階（persona, cache, admission, encode, queue, prefill, decode, detokenize, postprocess）ごとの所要時間
+    - nemo_request_seconds / nemo_requests_total: リクエスト全体の所要時間と件数
+    - nemo_time_to_first_token_seconds, nemo_queue_wait_seconds: 生成ごとの最初のトークンまでの時間とキュー待ち
+    - nemo_decode_tokens_per_second, nemo_prompt_tokens, nemo_generated_tokens: 生成ごとの速度とトークン数
+    - nemo_in_flight_generations, nemo_queued_generations: 実行中・待機中の生成数
+    """
+    if not metrics.enabled:
+        raise HTTPException(status_code=404, detail="Metrics are disabled (NEMO_METRICS=0)")
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/health/live")
+async def liveness():
+    """
+    liveness チェック（プロセスが応答できれば常に200）
+    読み込み中でも200を返すので、起動に時間がかかってもコンテナを再起動させない
+    """
+    return {"live": True}
+
+@app.get("/health/ready")
+async def readiness_check():
+    """
+    readiness チェック（チャットを受け付けられる場合のみ200、それ以外は503）
+    ロードバランサーはこの結果を見てリクエストを振り分ける
+    """
+    error = startup_error or readiness.failed
+    body = {"ready": readiness.ready and not error, "startup_error": error, "startup": readiness.stats()}
+    return JSONResponse(body, status_code=200 if body["ready"] else 503)
+
 @app.get("/stats")
-async def get_stats():
+async def get_stats(
+    region: Optional[str] = None,
+    prefecture: Optional[str] = None,
+    occupation: Optional[str] = None,
+    sex: Optional[str] = None,
+    age_min: Optional[int] = None,
+    age_max: Optional[int] = None
+):
     """
     ペルソナデータセットの統計情報を取得するエンドポイント
     データセット内の職業分布、地域分布、年齢分布などを返す
 
+    条件を指定しない場合は起動時に計算済みの統計をそのまま返す。
+    条件を指定した場合は一致するペルソナだけを列単位で集計する
+    （例: GET /stats?region=関東&age_min=20&age_max=29）。
+
+    Args:
+        region, prefecture, occupation, sex (Optional[str]): 完全一致で絞り込む条件
+        age_min, age_max (Optional[int]): 年齢の範囲（両端を含む）
+
     Returns:
         dict: 統計情報（職業TOP10、地域分布、年齢層分布など）
     """
     # ペルソナデータが読み込まれているかチェック
-    if not personas:
+    require_ready("stats", "Personas are still loading")
+    if not personas or persona_stats is None or persona_stats.overall is None:
         raise HTTPException(status_code=503, detail="Personas not loaded")
 
-    # 統計用の辞書を初期化
-    occupations = {}  # 職業別カウント
-    regions = {}      # 地域別カウント
-    ages = {}         # 年齢層別カウント
-
-    # 全ペルソナを処理して統計を作成
-    for persona in personas:
-        # 職業情報を取得・集計
-        occ = persona.get("occupation", "不明")
-        occupations[occ] = occupations.get(occ, 0) + 1
-
-        # 地域情報を取得・集計
-        reg = persona.get("region", "不明")
-        regions[reg] = regions.get(reg, 0) + 1
+    equals = {"region": region, "prefecture": prefecture, "occupation": occupation, "sex": sex}
+    if all(v is None for v in equals.values()) and age_min is None and age_max is None:
+        return persona_stats.overall
 
-        # 年齢情報を取得・年代別に集計
-        age = persona.get("age")
-        if age:
-            age_group = f"{age//10*10}代"  # 20代、30代など
-            ages[age_group] = ages.get(age_group, 0) + 1
-
-    return {
-        "total_personas": len(personas),  # 総ペルソナ数
-        "top_occupations": sorted(occupations.items(), key=lambda x: x[1], reverse=True)[:10],  # 職業TOP10
-        "regions": dict(sorted(regions.items(), key=lambda x: x[1], reverse=True)),  # 地域分布（多い順）
-        "age_groups": dict(sorted(ages.items()))  # 年齢層分布（年代順）
-    }
+    # 条件付きの統計は列単位で計算（イベントループを止めないようにスレッドで実行）
+    try:
+        return await asyncio.to_thread(persona_stats.filtered, age_min=age_min, age_max=age_max, **equals)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 # =============================================================================
 # メイン実行部分
@@ -0,0 +1,156 @@
+# =============================================================================
+# サーバー側の会話セッション管理
+# =============================================================================
+# クライアントが毎回会話履歴を丸ごと送る代わりに、サーバーがセッションごとに
+#   - これまでの会話のトークンID
+#   - そのトークン列に対応するKVキャッシュ
+# を保持する。次のターンでは新しいユーザー発言の部分だけを prefill すればよい。
+#
+# 一定時間使われていないセッションは削除し、KVキャッシュと履歴の合計がメモリ上限を
+# 超えた場合は最も長く使われていないセッションのKVから捨てる（捨てたセッションは
+# 次のターンで会話全体を prefill し直す）。KVを捨てても上限を超えている場合や、
+# セッション数が上限を超えた場合は、最も長く使われていないセッションごと削除する。
+# =============================================================================
+import asyncio  # セッション単位の排他制御用
+import time  # 最終アクセス時刻の記録用
+import uuid  # セッションIDの生成用
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from prefix_cache import kv_nbytes  # KVキャッシュのメモリ量計算
+from scheduler import KVTensors  # レイヤーごとの (key, value) テンソル
+
+TOKEN_ID_BYTES = 36  # token_ids の1要素のメモリ量の目安（list のポインタ8バイト＋int オブジェクト28バイト）
+
+@dataclass
+class ChatSession:
+    """
+    1つの会話セッションの状態
+    """
+    session_id: str  # セッションID
+    persona_index: int  # 使用するペルソナのインデックス
+    system_len: int  # token_ids のうちシステムプロンプト部分のトークン数
+    token_ids: List[int]  # これまでの会話全体のトークンID（最後の生成トークンまで）
+    kv: Optional[KVTensors] = None  # token_ids の先頭部分のKV（捨てられた場合は None）
+    turns: List[dict] = field(default_factory=list)  # 会話履歴（role, content）
+    last_access: float = field(default_factory=time.monotonic)  # 最終アクセス時刻
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)  # 同じセッションのターンを順番に処理する
+
+    @property
+    def kv_bytes(self) -> int:
+        """保持しているKVキャッシュのメモリ量（バイト）"""
+        return kv_nbytes(self.kv) if self.kv else 0
+
+    @property
+    def history_bytes(self) -> int:
+        """トークンIDと会話履歴のメモリ量の目安（バイト）"""
+        return len(self.token_ids) * TOKEN_ID_BYTES + sum(len(turn["content"].encode("utf-8")) for turn in self.turns)
+
+class SessionStore:
+    """
+    会話セッションを保持し、アイドル時間とメモリ上限に応じて削除するストア
+    """
+
+    def __init__(self, max_bytes: int, idle_seconds: float, max_sessions: int = 10000):
+        """
+        Args:
+            max_bytes (int): 全セッションのKVキャッシュと履歴（トークンID・発言）の合計上限（バイト）
+            idle_seconds (float): この秒数アクセスがなければセッションを削除する
+            max_sessions (int): 保持するセッション数の上限（超えたら使われていない順に削除する）
+        """
+        self.max_bytes = max_bytes
+        self.idle_seconds = idle_seconds
+        self.max_sessions = max_sessions
+        self._sessions: Dict[str, ChatSession] = {}
+
+        # 統計情報
+        self.expired = 0  # アイドルで削除したセッション数
+        self.kv_evictions = 0  # メモリ上限のためにKVを捨てた回数
+        self.evicted = 0  # セッション数・メモリの上限のために削除したセッション数
+
+    def create(self, persona_index: int, system_ids: List[int]) -> ChatSession:
+        """
+        新しいセッションを作る
+
+        Args:
+            persona_index (int): 使用するペルソナのインデックス
+            system_ids (List[int]): システムプロンプト部分のトークンID
+
+        Returns:
+            ChatSession: 作成したセッション
+        """
+        self.evict(reserve=1)
+        session = ChatSession(
+            session_id=uuid.uuid4().hex,
+            persona_index=persona_index,
+            system_len=len(system_ids),
+            token_ids=list(system_ids),
+        )
+        self._sessions[session.session_id] = session
+        return session
+
+    def get(self, session_id: str) -> Optional[ChatSession]:
+        """セッションを取得し、最終アクセス時刻を更新する（見つからなければ None）"""
+        session = self._sessions.get(session_id)
+        if session is not None:
+            session.last_access = time.monotonic()
+        return session
+
+    def delete(self, session_id: str) -> bool:
+        """セッションを削除する（存在した場合は True）"""
+        return self._sessions.pop(session_id, None) is not None
+
+    def evict(self, reserve: int = 0):
+        """
+        アイドル時間を過ぎたセッションを削除し、上限を超えた分のKV（足りなければセッションごと）を捨てる
+
+        Args:
+            reserve (int): これから追加するセッション数（その分だけセッション数の上限に空きを作る）
+        """
+        now = time.monotonic()
+        for session_id, session in list(self._sessions.items()):
+            if now - session.last_access > self.idle_seconds and not session.lock.locked():
+                del self._sessions[session_id]
+                self.expired += 1
+
+        # 使われていない順に処理する（処理中のセッションは対象外）
+        idle = [s for s in sorted(self._sessions.values(), key=lambda s: s.last_access) if not s.lock.locked()]
+        while idle and len(self._sessions) + reserve > self.max_sessions:
+            self._drop(idle.pop(0))
+
+        total = sum(s.kv_bytes + s.history_bytes for s in self._sessions.values())
+        if total <= self.max_bytes:
+            return
+        # まずKVを捨てる（履歴が残っていれば、次のターンで prefill し直せる）
+        for session in idle:
+            if total <= self.max_bytes:
+                return
+            if session.kv is not None:
+                total -= session.kv_bytes
+                session.kv = None
+                self.kv_evictions += 1
+        # 履歴だけでも上限を超えている場合は、セッションごと削除する
+        while idle and total > self.max_bytes:
+            session = idle.pop(0)
+            total -= session.history_bytes
+            self._drop(session)
+
+    def _drop(self, session: ChatSession):
+        """上限のためにセッションを削除する"""
+        del self._sessions[session.session_id]
+        self.evicted += 1
+
+    def stats(self) -> Dict[str, float]:
+        """セッション数とKVキャッシュ・履歴のメモリ使用量を返す"""
+        return {
+            "sessions": len(self._sessions),
+            "sessions_with_kv": sum(1 for s in self._sessions.values() if s.kv is not None),
+            "max_sessions": self.max_sessions,
+            "kv_bytes": sum(s.kv_bytes for s in self._sessions.values()),
+            "history_bytes": sum(s.history_bytes for s in self._sessions.values()),
+            "max_bytes": self.max_bytes,
+            "idle_seconds": self.idle_seconds,
+            "expired_sessions": self.expired,
+            "evicted_sessions": self.evicted,
+            "kv_evictions": self.kv_evictions,
+        }
@@ -0,0 +1,178 @@
+# =============================================================================
+# 推測デコード（Speculative Decoding）
+# =============================================================================
+# 通常のデコードは1トークンごとに本体モデルのフォワードを1回行う。
+# 推測デコードでは、小さな下書きモデル（同じトークナイザーのもの）に数トークン先まで
+# 提案させ、本体モデルは提案をまとめて1回のフォワードで検証する。
+#   - 下書きの i 番目のトークン d は、本体の確率 p(d) と下書きの確率 q(d) から
+#     min(1, p(d) / q(d)) の確率で採用する
+#   - 採用されなかった位置では max(0, p - q) を正規化した分布から選び直し、そこで打ち切る
+#   - すべて採用されたら、本体の最後の位置の分布からもう1トークン選ぶ
+# この手順で選ばれるトークンの分布は、本体モデルだけでサンプリングした場合と同じになる
+# （グリーディなら、本体の argmax と一致する間だけ採用する）。
+#
+# スケジューラは、バッチが1シーケンスだけで待っているリクエストもないとき
+# （負荷が低くレイテンシが問題になるとき）にだけ推測デコードを使い、
+# 複数のシーケンスがある間は通常のバッチデコードに戻る。
+# =============================================================================
+import threading  # 統計の排他制御用
+import time  # 所要時間の計測用
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import torch  # PyTorch（下書きモデルの実行・採否の判定）
+
+from logits_processors import SequenceRepetition, warp_scores  # 繰り返しの制御と temperature / top_k / top_p（本体のサンプリングと同じ加工）
+
+class SpeculativeDecoder:
+    """
+    下書きモデルとその KV キャッシュ（直近に推測デコードした1シーケンス分）を持つ
+
+    スケジューラの推論スレッドからだけ使う（stats() は別スレッドから呼んでよい）。
+    """
+
+    def __init__(self, draft_model, num_tokens: int = 4):
+        """
+        Args:
+            draft_model: 下書きに使う小さな CausalLM（本体と同じ語彙であること）
+            num_tokens (int): 1回に提案するトークン数
+        """
+        self.model = draft_model
+        self.num_tokens = num_tokens
+        self._owner = None  # KV キャッシュがどのシーケンスのものか
+        self._cache = None  # 下書きモデルの KV キャッシュ
+        self._length = 0  # KV キャッシュに入っているトークン数
+        self._lock = threading.Lock()
+        # 統計情報
+        self.rounds = 0
+        self.proposed = 0
+        self.accepted = 0
+        self.emitted = 0  # 推測デコードで進んだトークン数（採用＋選び直し・追加の1トークン）
+        self.draft_seconds = 0.0
+
+    def propose(
+        self,
+        owner,
+        ids: Sequence[int],
+        num_tokens: int,
+        temperature: float,
+        top_p: float,
+        top_k: int = 0,
+        repetition: Optional[SequenceRepetition] = None,
+    ) -> Tuple[List[int], Optional[torch.Tensor]]:
+        """
+        続きのトークンを下書きモデルで提案する
+
+        Args:
+            owner: シーケンス（KV キャッシュを使い回せるかの判定に使う）
+            ids (Sequence[int]): これまでのトークンID（プロンプト＋生成済み。最後はまだ本体に入力していないトークン）
+            num_tokens (int): 提案するトークン数
+            temperature (float): 0以下ならグリーディ
+            top_p (float): nucleus sampling の閾値
+            top_k (int): 確率の上位 k 語彙に絞る（0で絞らない）
+            repetition (SequenceRepetition): シーケンスの繰り返しの制御（本体と同じ制御の下で提案し、採用率を上げる）
+
+        Returns:
+            Tuple[List[int], Optional[torch.Tensor]]: 提案したトークンと、それぞれを選んだ分布 [num_tokens, vocab]
+            （グリーディなら None）
+        """
+        started = time.perf_counter()
+        if owner is not self._owner or self._length >= len(ids):
+            self.reset()
+            self._owner = owner
+        new_ids = list(ids[self._length:])
+        tokens: List[int] = []
+        probs: List[torch.Tensor] = []
+        warp = (torch.tensor([temperature]), torch.tensor([top_p]), torch.tensor([top_k]))
+        for _ in range(num_tokens):
+            outputs = self.model(
+                input_ids=torch.tensor([new_ids], device=self.model.device),
+                past_key_values=self._cache,
+                use_cache=True,
+                logits_to_keep=1,
+            )
+            self._cache = outputs.past_key_values
+            self._length += len(new_ids)
+            logits = outputs.logits[:, -1, :].float()
+            if repetition is not None:
+                logits = repetition.lookahead(logits, tokens)
+            if temperature <= 0:
+                token = int(logits.argmax(dim=-1))
+            else:
+                dist = warp_scores(logits, *(w.to(logits.device) for w in warp)).softmax(dim=-1)[0]
+                token = int(torch.multinomial(dist, num_samples=1))
+                probs.append(dist)
+            tokens.append(token)
+            new_ids = [token]
+        self.draft_seconds += time.perf_counter() - started
+        return tokens, (torch.stack(probs) if probs else None)
+
+    def accept(
+        self, scores: torch.Tensor, token: int, draft_probs: Optional[torch.Tensor], temperature: float, top_p: float, top_k: int = 0
+    ) -> Tuple[int, bool]:
+        """
+        下書きのトークンを本体の分布で採否判定する
+
+        Args:
+            scores (torch.Tensor): [vocab] 本体のロジット（繰り返しの制御は適用済み）
+            token (int): 下書きのトークン
+            draft_probs (Optional[torch.Tensor]): [vocab] 下書きがそのトークンを選んだ分布（グリーディなら None）
+            temperature (float): 0以下ならグリーディ
+            top_p (float): nucleus sampling の閾値
+            top_k (int): 確率の上位 k 語彙に絞る（0で絞らない）
+
+        Returns:
+            Tuple[int, bool]: 出力するトークンと、下書きを採用したかどうか（不採用なら選び直したトークン）
+        """
+        if temperature <= 0:
+            target = int(scores.argmax())
+            return target, target == token
+        probs = warp_scores(
+            scores.unsqueeze(0),
+            torch.tensor([temperature], device=scores.device),
+            torch.tensor([top_p], device=scores.device),
+            torch.tensor([top_k], device=scores.device),
+        ).softmax(dim=-1)[0]
+        draft_probs = draft_probs.to(probs.device)
+        if float(torch.rand(())) * float(draft_probs[token]) <= float(probs[token]):
+            return token, True
+        residual = (probs - draft_probs).clamp_min(0)
+        if float(residual.sum()) <= 0:
+            residual = probs
+        return int(torch.multinomial(residual / residual.sum(), num_samples=1)), False
+
+    def rollback(self, length: int):
+        """KV キャッシュを先頭 length トークン分に切り詰める（採用されなかった提案を捨てる）"""
+        if self._cache is not None and self._length > length:
+            # 負の値は末尾から取り除くトークン数（正の値で長さを指定する形は非推奨）
+            self._cache.crop(length - self._cache.get_seq_length())
+            self._length = length
+
+    def release(self, owner):
+        """シーケンスが終わったら、その KV キャッシュを捨てる"""
+        if owner is self._owner:
+            self.reset()
+
+    def reset(self):
+        """KV キャッシュを捨てる"""
+        self._owner, self._cache, self._length = None, None, 0
+
+    def record(self, proposed: int, accepted: int, emitted: int):
+        """1回分の提案数・採用数を記録する"""
+        with self._lock:
+            self.rounds += 1
+            self.proposed += proposed
+            self.accepted += accepted
+            self.emitted += emitted
+
+    def stats(self) -> Dict[str, float]:
+        """提案・採用の累計と採用率を返す"""
+        with self._lock:
+            return {
+                "num_tokens": self.num_tokens,
+                "rounds": self.rounds,
+                "proposed_tokens": self.proposed,
+                "accepted_tokens": self.accepted,
+                "acceptance_rate": round(self.accepted / self.proposed, 4) if self.proposed else 0.0,
+                "tokens_per_round": round(self.emitted / self.rounds, 2) if self.rounds else 0.0,
+                "draft_seconds": round(self.draft_seconds, 3),
+            }
@@ -0,0 +1,159 @@
+# =============================================================================
+# ストリーミング応答用ユーティリティ
+# =============================================================================
+# トークンを1つずつ受け取りながら、
+#   - 文字化けしないように差分テキストへ変換する（IncrementalDecoder）
+#   - <think>...</think> の思考部分を逐次取り除く（ThinkTagFilter、まとまったテキストには strip_think）
+#   - Server-Sent Events 形式の文字列を組み立てる（format_sse）
+# =============================================================================
+import json  # SSEのdata部分をJSONにする用
+from typing import List
+
+class IncrementalDecoder:
+    """
+    生成トークンを1つずつ受け取り、新しく確定した文字列だけを返すデコーダ
+
+    日本語は1文字が複数トークンにまたがることがあるため、デコード結果が
+    不完全なUTF-8（置換文字 U+FFFD）で終わる間は出力を保留する。
+    """
+
+    def __init__(self, tokenizer, skip_special_tokens: bool = True):
+        """
+        Args:
+            tokenizer: Hugging Face のトークナイザー
+            skip_special_tokens (bool): 特殊トークンを出力から除くかどうか
+        """
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.ids: List[int] = []
+        self._prefix_offset = 0  # 差分計算の基準にする区間の開始位置
+        self._read_offset = 0  # ここまでのトークンは出力済み
+
+    def push(self, token_id: int) -> str:
+        """
+        トークンを1つ追加し、新たに確定したテキストを返す
+
+        Args:
+            token_id (int): 生成されたトークンID
+
+        Returns:
+            str: 新しく出力できるテキスト（まだ確定しない場合は空文字）
+        """
+        self.ids.append(token_id)
+        prefix_text = self._decode(self.ids[self._prefix_offset:self._read_offset])
+        new_text = self._decode(self.ids[self._prefix_offset:])
+        if len(new_text) > len(prefix_text) and not new_text.endswith("\ufffd"):
+            self._prefix_offset = self._read_offset
+            self._read_offset = len(self.ids)
+            return new_text[len(prefix_text):]
+        return ""
+
+    def _decode(self, ids: List[int]) -> str:
+        return self.tokenizer.decode(ids, skip_special_tokens=self.skip_special_tokens)
+
+class ThinkTagFilter:
+    """
+    <think>...</think> で囲まれた思考部分を取り除くストリーミングフィルタ
+
+    テキストを任意の位置で分割して feed() しても、タグが途中で切れている
+    部分は次の入力が来るまで保留するので、正しく取り除ける。
+    """
+
+    OPEN_TAG = "<think>"
+    CLOSE_TAG = "</think>"
+
+    def __init__(self):
+        self._buffer = ""  # タグの途中かもしれない未処理テキスト
+        self._inside = False  # <think> の中にいるかどうか
+        self._started = False  # 返答本文を1文字でも出力したかどうか
+
+    def feed(self, text: str) -> str:
+        """
+        テキスト断片を受け取り、表示してよい部分だけを返す
+
+        Args:
+            text (str): デコード済みのテキスト断片
+
+        Returns:
+            str: 思考部分を除いたテキスト
+        """
+        self._buffer += text
+        output = []
+        while self._buffer:
+            tag = self.CLOSE_TAG if self._inside else self.OPEN_TAG
+            pos = self._buffer.find(tag)
+            if pos >= 0:
+                if not self._inside:
+                    output.append(self._buffer[:pos])
+                self._buffer = self._buffer[pos + len(tag):]
+                self._inside = not self._inside
+                continue
+            # 対応しない閉じタグ（</think> だけが出力された場合）は捨てる
+            if not self._inside and self.CLOSE_TAG in self._buffer:
+                pos = self._buffer.find(self.CLOSE_TAG)
+                output.append(self._buffer[:pos])
+                self._buffer = self._buffer[pos + len(self.CLOSE_TAG):]
+                continue
+            # 末尾がタグの先頭と一致する場合はタグの途中かもしれないので保留する
+            keep = _partial_tag_length(self._buffer, (tag, self.CLOSE_TAG))
+            if not self._inside:
+                output.append(self._buffer[:len(self._buffer) - keep])
+            self._buffer = self._buffer[len(self._buffer) - keep:]
+            break
+        return self._emit("".join(output))
+
+    def flush(self) -> str:
+        """
+        入力の終わりに呼び、保留していたテキストを返す
+
+        Returns:
+            str: 残りの表示テキスト（思考の途中で終わった場合は空文字）
+        """
+        rest = "" if self._inside else self._buffer
+        self._buffer = ""
+        return self._emit(rest)
+
+    def _emit(self, text: str) -> str:
+        # 返答の先頭の空白・改行（</think> の直後など）は出力しない
+        if not self._started:
+            text = text.lstrip()
+            self._started = bool(text)
+        return text
+
+def strip_think(text: str) -> str:
+    """
+    まとまったテキストから思考部分を取り除く（ストリーミングと同じ ThinkTagFilter で1回走査する）
+
+    思考の途中で終わったテキスト（閉じタグがない）は、思考部分をすべて捨てる。
+
+    Args:
+        text (str): 生成部分だけをデコードしたテキスト
+
+    Returns:
+        str: 前後の空白を除いた返答
+    """
+    think_filter = ThinkTagFilter()
+    return (think_filter.feed(text) + think_filter.flush()).strip()
+
+def _partial_tag_length(text: str, tags) -> int:
+    """text の末尾が tags のいずれかの先頭部分と一致する最大の長さを返す"""
+    longest = 0
+    for tag in tags:
+        for n in range(min(len(tag) - 1, len(text)), 0, -1):
+            if text.endswith(tag[:n]):
+                longest = max(longest, n)
+                break
+    return longest
+
+def format_sse(event: str, data: dict) -> str:
+    """
+    Server-Sent Events 形式の1イベント分の文字列を作る
+
+    Args:
+        event (str): イベント名（token, done, error など）
+        data (dict): JSONとして送るデータ
+
+    Returns:
+        str: "event: ...\\ndata: ...\\n\\n" 形式の文字列
+    """
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"